@@ -1,19 +1,6 @@
 # %%
 import json
-import pandas as pd
 from pathlib import Path
-import logging
-import torch
-
-from HOME.ML_prediction.preprocessing import (
-    step_01_tile_generation,
-    step_02_make_text_file,
-)
-from HOME.ML_prediction.prediction import predict
-
-from HOME.visualization.ML_prediction.visual_inspection.plot_prediction_input import (
-    plot_prediction_input,
-)
 
 # from src.ML_prediction.postprocessing import (
 #     step_01_reassembling_tiles,
@@ -30,13 +17,19 @@ data_path = get_data_path(root_dir)
 # print(data_path)
 
 
-def main(list_of_projects: list):
+def main(list_of_projects: list, pipelined: bool = False):
     """
     Main function to run the prediction pipeline
 
     Arguments:
     list_of_projects: list, list of project names to run the prediction pipeline
+    pipelined: bool, run the stages of different projects concurrently (see
+        pipeline.run_pipeline), which also polygonizes the predictions
     """
+    if pipelined:
+        from HOME.ML_prediction.pipeline import run_pipeline
+
+        return run_pipeline(list_of_projects)
 
     # root_dir = Path(__file__).parents[2]
 
@@ -55,6 +48,21 @@ def main(list_of_projects: list):
             projects_to_run.append(project_name)
         pred_res = project_details[project_name]["resolution"]
 
+    if not projects_to_run:
+        print("No downloaded projects to predict.")
+        return
+
+    # the stages pull in pandas, GDAL, cv2 and torch: only import them if needed
+    import pandas as pd
+    from HOME.ML_prediction.preprocessing import (
+        step_01_tile_generation,
+        step_02_make_text_file,
+    )
+    from HOME.ML_prediction.prediction import predict
+    from HOME.visualization.ML_prediction.visual_inspection.plot_prediction_input import (  # noqa
+        plot_prediction_input,
+    )
+
     # load prediction mask
     prediction_mask = pd.read_csv(
         data_path / f"ML_prediction/prediction_mask/prediction_mask_{pred_res}.csv",
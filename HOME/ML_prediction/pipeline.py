@@ -0,0 +1,302 @@
+"""
+Runs the prediction pipeline for many projects with overlapping stages.
+
+`main.main` runs tiling, prediction and status update strictly one after the other
+per project, so the GPU idles while a project is tiled. Here every stage has its own
+pool of worker threads (the work itself happens in GDAL/cv2, torch and shapely, which
+release the GIL, or in the pools of the stages), and the stages are connected by
+bounded queues:
+
+    tile (+ text file) -> predict -> polygonize
+
+so project N+1 is tiled while N is predicted and N-1 is polygonized. A full queue
+blocks the stage before it, so tiling never runs far ahead of the GPU.
+
+The last completed stage of every project is kept in
+`ML_prediction/project_log/pipeline_state.json`. A restarted run continues every
+project after its last completed stage; projects that failed are retried from the
+stage that failed.
+"""
+
+# %% Imports
+import os
+import json
+import queue
+import argparse
+import threading
+import traceback
+from pathlib import Path
+from functools import lru_cache
+
+from HOME.get_data_path import get_data_path
+from HOME.utils.metrics import metrics
+
+# Get the root directory of the project
+root_dir = Path(__file__).resolve().parents[2]
+# print(root_dir)
+# get the data path (might change)
+data_path = get_data_path(root_dir)
+
+project_details_path = data_path / "ML_prediction/project_log/project_details.json"
+pipeline_state_path = data_path / "ML_prediction/project_log/pipeline_state.json"
+
+# stages in order, named after the state of a project once they are done
+stages = ("tiled", "predicted", "polygonized")
+
+_details_lock = threading.Lock()
+
+
+# %% state
+def _write_json(path: Path, content: dict) -> None:
+    """
+    Writes a json file via a temporary file, so it is never left half written.
+    """
+    tmp_path = Path(path).with_suffix(".tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(content, file, indent=4)
+    os.replace(tmp_path, path)
+
+
+class PipelineState:
+    """
+    Last completed stage (and last error) of every project, saved after each change.
+    """
+
+    def __init__(self, path: Path = pipeline_state_path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.state = {}
+        if self.path.exists():
+            with open(self.path, "r") as file:
+                self.state = json.load(file)
+
+    def completed(self, project_name: str) -> str:
+        """
+        Last completed stage of a project, None if it has not started.
+        """
+        return self.state.get(project_name, {}).get("completed")
+
+    def update(self, project_name: str, **entries) -> None:
+        with self.lock:
+            self.state.setdefault(project_name, {}).update(entries)
+            os.makedirs(self.path.parent, exist_ok=True)
+            _write_json(self.path, self.state)
+
+
+def set_project_status(project_name: str, status: str) -> None:
+    """
+    Sets the status of a project in project_details.json (re-read before writing,
+    so updates from other stages are not lost).
+    """
+    with _details_lock:
+        with open(project_details_path, "r") as file:
+            project_details = json.load(file)
+        project_details[project_name]["status"] = status
+        _write_json(project_details_path, project_details)
+
+
+@lru_cache(maxsize=None)
+def load_prediction_mask(res: float):
+    """
+    Prediction mask of a resolution (loaded once, and only if something is tiled).
+    """
+    import pandas as pd
+
+    prediction_mask = pd.read_csv(
+        data_path / f"ML_prediction/prediction_mask/prediction_mask_{res}.csv",
+        index_col=0,
+    )
+    prediction_mask.columns = prediction_mask.columns.astype(int)
+    prediction_mask.index = prediction_mask.index.astype(int)
+    return prediction_mask
+
+
+# %% stages
+def project_parameters(details: dict) -> tuple[float, str, bool]:
+    """
+    Resolution, compression folder and BW flag of a project from its details.
+    """
+    compression = f"i_{details['compression_name']}_{details['compression_value']}"
+    return details["resolution"], compression, details["channels"] == "BW"
+
+
+def run_tiling(project_name: str, details: dict) -> None:
+    from HOME.ML_prediction.preprocessing import (
+        step_01_tile_generation,
+        step_02_make_text_file,
+    )
+
+    res, compression, _ = project_parameters(details)
+    step_01_tile_generation.tile_generation(
+        project_name=project_name,
+        res=res,
+        compression=compression,
+        prediction_mask=load_prediction_mask(res),
+    )
+    step_02_make_text_file.make_text_file(
+        project_name=project_name, res=res, compression=compression
+    )
+
+
+def run_prediction(project_name: str, details: dict) -> None:
+    from HOME.ML_prediction.prediction import predict
+
+    res, compression, BW = project_parameters(details)
+    predict.predict(project_name=project_name, res=res, compression=compression, BW=BW)
+    set_project_status(project_name, "predicted")
+
+
+def run_polygonization(project_name: str, details: dict) -> None:
+    from HOME.ML_prediction.postprocessing.step_03_polygonization import (
+        polygonize_project,
+    )
+
+    res, compression, _ = project_parameters(details)
+    polygonize_project(project_name, res, compression)
+
+
+stage_functions = {
+    "tiled": run_tiling,
+    "predicted": run_prediction,
+    "polygonized": run_polygonization,
+}
+
+
+# %% orchestration
+def _stage_worker(stage, in_queue, out_queue, project_details, state):
+    """
+    Takes projects from in_queue until it gets None, runs the stage on them and
+    hands the successful ones to out_queue.
+    """
+    while True:
+        project_name = in_queue.get()
+        metrics.set_gauge("queue_depth", in_queue.qsize(), queue=stage)
+        if project_name is None:
+            return
+        print(f"Starting stage '{stage}' for {project_name}")
+        try:
+            with metrics.stage(f"pipeline_{stage}", project=project_name):
+                stage_functions[stage](project_name, project_details[project_name])
+        except Exception as e:  # noqa
+            traceback.print_exc()
+            state.update(project_name, failed=stage, error=repr(e))
+            continue
+        state.update(project_name, completed=stage, failed=None, error=None)
+        if out_queue is not None:
+            with metrics.timer("queue_wait_seconds", stage=stage):
+                out_queue.put(project_name)
+
+
+def first_stage(project_name: str, details: dict, state: PipelineState) -> int:
+    """
+    Index of the first stage still to run for a project (len(stages) if it is done).
+    """
+    completed = state.completed(project_name)
+    if completed is None and details["status"] == "predicted":
+        completed = "predicted"  # predicted before the pipeline kept its state
+    return 0 if completed is None else stages.index(completed) + 1
+
+
+def run_pipeline(
+    list_of_projects: list,
+    n_workers: dict = None,
+    queue_size: int = 1,
+    state_path: Path = pipeline_state_path,
+) -> dict:
+    """
+    Runs the stages for all projects, overlapping the stages of different projects.
+
+    Arguments:
+    - list_of_projects: project names, or ["all"]
+    - n_workers: concurrent projects per stage, default
+        {"tiled": 1, "predicted": 1, "polygonized": 1}
+    - queue_size: projects that can wait between two stages
+    - state_path: json file with the stage of every project
+
+    Returns:
+    - the pipeline state of the projects
+    """
+    n_workers = {**{stage: 1 for stage in stages}, **(n_workers or {})}
+    with open(project_details_path, "r") as file:
+        project_details = json.load(file)
+    if list_of_projects == ["all"]:
+        list_of_projects = list(project_details.keys())
+    state = PipelineState(state_path)
+
+    # projects with something left to do, and where they continue
+    start_stages = {}
+    for project_name in list_of_projects:
+        details = project_details[project_name]
+        if details["status"] not in ("downloaded", "predicted"):
+            continue
+        start = first_stage(project_name, details, state)
+        if start < len(stages):
+            start_stages[project_name] = start
+    if not start_stages:
+        print("Nothing to run.")
+        return {}
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    workers = []
+    for i, stage in enumerate(stages):
+        out_queue = queues[i + 1] if i + 1 < len(stages) else None
+        stage_workers = [
+            threading.Thread(
+                target=_stage_worker,
+                args=(stage, queues[i], out_queue, project_details, state),
+                name=f"{stage}_{k}",
+            )
+            for k in range(n_workers[stage])
+        ]
+        for worker in stage_workers:
+            worker.start()
+        workers.append(stage_workers)
+
+    # feed the projects in order, blocking while the first queue is full
+    for project_name, start in start_stages.items():
+        queues[start].put(project_name)
+
+    # shut the stages down in order: once a stage has stopped, nothing more can
+    # arrive in the queue of the next one
+    for i, stage_workers in enumerate(workers):
+        for _ in stage_workers:
+            queues[i].put(None)
+        for worker in stage_workers:
+            worker.join()
+
+    return {project_name: state.state[project_name] for project_name in start_stages}
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the prediction pipeline with overlapping stages"
+    )
+    parser.add_argument("--projects", nargs="+", required=False, default=["all"])
+    parser.add_argument("--tile_workers", required=False, type=int, default=1)
+    parser.add_argument("--predict_workers", required=False, type=int, default=1)
+    parser.add_argument("--polygonize_workers", required=False, type=int, default=1)
+    parser.add_argument("--queue_size", required=False, type=int, default=1)
+    parser.add_argument("--metrics_jsonl", required=False, type=str, default=None)
+    parser.add_argument("--metrics_port", required=False, type=int, default=None)
+    parser.add_argument(
+        "--profile", required=False, choices=["cprofile", "py-spy"], default=None
+    )
+    args = parser.parse_args()
+    metrics.configure(
+        jsonl_path=args.metrics_jsonl,
+        prometheus_port=args.metrics_port,
+        profile=args.profile,
+    )
+
+    project_states = run_pipeline(
+        args.projects,
+        n_workers={
+            "tiled": args.tile_workers,
+            "predicted": args.predict_workers,
+            "polygonized": args.polygonize_workers,
+        },
+        queue_size=args.queue_size,
+    )
+    for project_name, project_state in project_states.items():
+        print(project_name, project_state)
@@ -7,8 +7,8 @@ process in one go.
 # %% imports
 import numpy as np
 import cv2
-import rasterio
 from rasterio.transform import from_origin
+import os
 import json
 
 from pathlib import Path
@@ -16,6 +16,9 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 from typing import Dict
 
+from HOME.utils.metrics import metrics
+from HOME.utils.raster_io import write_raster
+
 # %% functions
 
 
@@ -156,11 +159,13 @@ def assemble_large_tile(
         [col, row] = extract_tile_numbers(tile)
         # now the pixel coordinates within the large tile:
         # px_x_tl = (bottom_right[0] - col - 1) * tile_size_px # tested to work, don't know why
-        px_x_tl = (col - top_left[0]) * tile_size_p  # tested to work, don't know why
+        px_x_tl = (col - top_left[0]) * tile_size_px  # tested to work, don't know why
         px_y_tl = (top_left[1] - row + 1) * tile_size_px
         # px_y_tl = (row - bottom_right[1]) * tile_size_px
         # read the small tile
-        small_tile = cv2.imread(tile)
+        with metrics.timer("decode_seconds", stage="reassembly"):
+            small_tile = cv2.imread(tile)
+        metrics.inc("tiles_read", stage="reassembly")
         # add the small tile to the large tile
         large_tile[
             px_y_tl - tile_size_px : px_y_tl,
@@ -241,26 +246,23 @@ def reassemble_tiles(
         top_left = get_EPSG25833_coords(coords[0][1], coords[0][0], tile_size, res)[0]
         # get the affine transformation to go from pixel coordinates to EPSG:25833
         transform = from_origin(top_left[0], top_left[1], res, res)
-        metadata = {
-            "driver": "GTiff",
-            "dtype": "uint8",
-            "count": tif_channels,
-            "height": assembled_tile.shape[0],
-            "width": assembled_tile.shape[1],
-            "transform": transform,
-            "crs": "EPSG:25833",
-        }
         # save the assembled tile
         tile_name = f"{tile_name_base}_{lt_name}.tif"
-        # write the assembled tile to disk
-        with rasterio.open(save_path / tile_name, "w", **metadata) as dst:
-            if tif_channels == 1:
-                # For single-band images (not yet tested!)
-                dst.write(assembled_tile, 1)
-            else:
-                # For multi-band images (e.g., RGB)
-                for i in range(1, tif_channels + 1):
-                    dst.write(assembled_tile[:, :, i - 1], i)
+        # write the assembled tile to disk, as COG with overviews for low-zoom reads
+        # (the tiles were read by cv2, so the channels are in BGR order)
+        with metrics.timer("encode_seconds", stage="reassembly"):
+            write_raster(
+                save_path / tile_name,
+                assembled_tile[:, :, 0] if tif_channels == 1 else assembled_tile,
+                transform,
+                predictor="horizontal",
+                overviews=True,
+                resampling="nearest" if tif_channels == 1 else "average",
+            )
+        metrics.inc("large_tiles_written", stage="reassembly")
+        metrics.inc(
+            "bytes_written", os.path.getsize(save_path / tile_name), stage="reassembly"
+        )
     return
 
 
@@ -274,7 +276,6 @@ if __name__ == "__main__":
     # print(root_dir)
     # get the data path (might change)
     data_path = get_data_path(root_dir)
-    data_path = root_dir / "data"
     with open(
         data_path / "ML_prediction/project_log/project_details.json", "r"
     ) as file:
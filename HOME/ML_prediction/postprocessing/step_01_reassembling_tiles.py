@@ -4,11 +4,13 @@ import os
 from osgeo import gdal
 import numpy as np
 from pathlib import Path
+from HOME.get_data_path import get_data_path
 import json
 
 # %%
 
 root_dir = Path(__file__).parents[3]
+data_path = get_data_path(root_dir)
 current_dir = Path(__file__).parents[0]
 
 # Parameters
@@ -277,7 +279,7 @@ def stitch_tiles_together(
 
 if __name__ == "__main__":
 
-    project_dict_path = root_dir / "data/ML_prediction/project_log/project_details.json"
+    project_dict_path = data_path / "ML_prediction/project_log/project_details.json"
     # Open and read the JSON file
     with open(project_dict_path, "r") as file:
         project_dict = json.load(file)
@@ -288,21 +290,21 @@ if __name__ == "__main__":
     compression_value = project_dict[project_name]["compression_value"]
 
     # path to the prediction tiles
-    # input_dir = root_dir / f"data/ML_prediction/predictions/res_{resolution}/{project_name}/i_{compression_name}_{compression_value}"
+    # input_dir = data_path / f"ML_prediction/predictions/res_{resolution}/{project_name}/i_{compression_name}_{compression_value}"
     # path to the og tiles
     input_dir_og = (
-        root_dir
-        / f"data/ML_prediction/topredict/image/res_{resolution}/{project_name}/i_{compression_name}_{compression_value}"
+        data_path
+        / f"ML_prediction/topredict/image/res_{resolution}/{project_name}/i_{compression_name}_{compression_value}"
     )
     input_dir = input_dir_og
     # output location for the reassembled tile: in a diff folder
     # output for og tiles (for testing purposes)
     output_dir = (
-        root_dir
-        / f"data/ML_prediction/topredict/image/res_{resolution}/{project_name}/reassembled_tiles"
+        data_path
+        / f"ML_prediction/topredict/image/res_{resolution}/{project_name}/reassembled_tiles"
     )
     # output for prediction tiles
-    # output_dir = root_dir / f"data/ML_prediction/predictions/res_{resolution}/{project_name}/reassembled_tiles"
+    # output_dir = data_path / f"ML_prediction/predictions/res_{resolution}/{project_name}/reassembled_tiles"
 
     # assuming we keep the same format for tile names (include row and column)
     # Use glob to find all .tif files in the directory
@@ -9,6 +9,7 @@ import matplotlib.pyplot as plt
 import os
 from shapely.ops import unary_union
 from pathlib import Path
+from HOME.get_data_path import get_data_path
 import pandas as pd
 import pickle
 import glob
@@ -21,11 +22,12 @@ import matplotlib.pyplot as plt
 #%%
 # Set the paths
 root_dir = Path(__file__).parents[3]
+data_path = get_data_path(root_dir)
 
 # Parameters
 project_name = "trondheim_kommune_2020"  # Example project name
 
-project_dict_path = root_dir / "data/ML_prediction/project_log/project_details.json"
+project_dict_path = data_path / "ML_prediction/project_log/project_details.json"
 # Open and read the JSON file
 with open(project_dict_path, 'r') as file:
     project_dict = json.load(file)
@@ -36,7 +38,7 @@ compression_name = project_dict[project_name]['compression_name']
 compression_value = project_dict[project_name]['compression_value']
 
 # path to the reassembled tiles
-tile_dir = root_dir / f"data/ML_prediction/predictions/res_{resolution}/{project_name}/reassembled_tiles"
+tile_dir = data_path / f"ML_prediction/predictions/res_{resolution}/{project_name}/reassembled_tiles"
 
 def process_project_tiles(files_info):
 
@@ -149,7 +151,7 @@ def process_project_tiles(files_info):
 
 if __name__ == '__main__':
 
-    project_dict_path = root_dir / "data/ML_prediction/project_log/project_details.json"
+    project_dict_path = data_path / "ML_prediction/project_log/project_details.json"
     # Open and read the JSON file
     with open(project_dict_path, 'r') as file:
         project_dict = json.load(file)
@@ -159,8 +161,8 @@ if __name__ == '__main__':
     compression_name = project_dict[project_name]['compression_name']
     compression_value = project_dict[project_name]['compression_value']
     
-    folder_path = root_dir / f"data/ML_prediction/predictions/res_{resolution}/{project_name}/reassembled_tiles"
-    original_folder_path = root_dir / f"data/ML_prediction/topredict/image/res_{resolution}/{project_name}/reassembled_tiles"
+    folder_path = data_path / f"ML_prediction/predictions/res_{resolution}/{project_name}/reassembled_tiles"
+    original_folder_path = data_path / f"ML_prediction/topredict/image/res_{resolution}/{project_name}/reassembled_tiles"
     # Regular expression to match the file format
     file_pattern = re.compile(r'^stitched_tif_(?P<project_name>.+)_(?P<col>\d+)_(?P<row>\d+)\.tif$')
 
@@ -201,23 +203,18 @@ if __name__ == '__main__':
 
 #%%
 
-from pyproj import Transformer
 import folium
-from shapely.ops import transform
+from HOME.utils.crs import transform_geometries
 
 # Set the CRS for combined_gdf to UTM 33N if it's not already set
 if combined_gdf.crs is not({'init': 'epsg:32633'}):
     combined_gdf.set_crs('epsg:32633', inplace=True)
 
-# Create a transformer to convert from UTM 33N (EPSG:32633) to WGS84 (EPSG:4326)
-transformer = Transformer.from_crs('epsg:32633', 'epsg:4326', always_xy=True)
-
-# Function to apply the transformation to a geometry
+# Convert all geometries from UTM 33N (EPSG:32633) to WGS84 (EPSG:4326) at once
 def apply_transformation(geom):
-    return transform(lambda x, y: transformer.transform(x, y), geom)
+    return transform_geometries(geom, 'epsg:32633', 'epsg:4326')
 
-# Apply the transformation to each geometry in the GeoDataFrame
-combined_gdf['geometry'] = combined_gdf['geometry'].apply(apply_transformation)
+combined_gdf['geometry'] = apply_transformation(combined_gdf['geometry'])
 
 def plot_gdf_on_map(gdf, polygon_index=0):
     polygon = gdf.iloc[polygon_index].geometry
@@ -0,0 +1,219 @@
+"""
+Polygonizes the predicted tiles of a project directly, without reassembling them first.
+
+The prediction tiles are georeferenced COGs (`HOME.utils.raster_io.write_tile`), and
+the transform is read from each file. Tiles of older runs were written by cv2 without
+georeferencing; for them the transform follows from the grid cell in the name
+(`..._<grid_x>_<grid_y>.tif`, see `HOME.utils.tile_grid`). The building pixels of
+each tile are vectorized, filtered, simplified and rounded like in
+`step_02_regularization.py`, in a process pool, and all polygons of the project are
+saved as one GeoParquet file.
+
+If the project was predicted into a bit-packed `TileStore` (`predict --output store`),
+the chunks of the store are unpacked and polygonized as whole mosaics instead, so
+buildings on the border between two tiles of a chunk are not cut.
+"""
+
+# %% Imports
+import os
+import argparse
+import warnings
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import geopandas as gpd
+import rasterio
+import rasterio.features
+from rasterio.errors import NotGeoreferencedWarning, RasterioIOError
+from shapely.geometry import shape
+from tqdm import tqdm
+
+from HOME.utils.tile_grid import tile_name_to_grid, get_tile_transform
+from HOME.utils.tile_store import TileStore, store_path
+from HOME.get_data_path import get_data_path
+from HOME.config import get_config
+
+# Get the root directory of the project
+root_dir = Path(__file__).resolve().parents[3]
+# print(root_dir)
+# get the data path (might change)
+data_path = get_data_path(root_dir)
+
+crs = "EPSG:25833"
+
+
+# %% function definitions
+def polygonize_tile(
+    tile_path: Path,
+    res: float,
+    tile_size: int = 512,
+    min_area: float = 5 * 5,
+    max_area: float = 450 * 450,
+    tolerance: float = 5,
+) -> list:
+    """
+    Polygons of the building pixels of one prediction tile (run in a worker).
+
+    Arguments:
+    - tile_path: path of the prediction tile (0/255)
+    - res: resolution of the tile in m
+    - tile_size: size of the tile in pixels (for tiles without georeferencing)
+    - min_area, max_area: polygons outside this range (m^2) are dropped
+    - tolerance: tolerance of the simplification in m
+
+    Returns:
+    - list of shapely polygons in EPSG:25833
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", NotGeoreferencedWarning)
+            with rasterio.open(tile_path) as src:
+                prediction = src.read(1)
+                transform = src.transform if src.crs is not None else None
+    except RasterioIOError:
+        return []
+    if not prediction.any():
+        return []
+    if transform is None:
+        # written by cv2 (older runs): the grid cell of the name gives the transform
+        grid_x, grid_y = tile_name_to_grid(Path(tile_path).name)
+        transform = get_tile_transform(grid_x, grid_y, res, tile_size)
+    return polygonize_mask(prediction, transform, min_area, max_area, tolerance)
+
+
+def polygonize_chunk(
+    chunk: tuple[int, int],
+    store_dir: Path,
+    min_area: float = 5 * 5,
+    max_area: float = 450 * 450,
+    tolerance: float = 5,
+) -> list:
+    """
+    Polygons of one chunk of a prediction TileStore (run in a worker).
+    """
+    store = TileStore(store_dir)
+    mask, _ = store.read_chunk(chunk)
+    if not mask.any():
+        return []
+    return polygonize_mask(
+        mask.view(np.uint8),
+        store.chunk_transform(chunk),
+        min_area,
+        max_area,
+        tolerance,
+    )
+
+
+def polygonize_mask(
+    prediction: np.ndarray,
+    transform,
+    min_area: float = 5 * 5,
+    max_area: float = 450 * 450,
+    tolerance: float = 5,
+) -> list:
+    """
+    Filtered and simplified polygons of the building pixels (> 0) of a mask.
+    """
+    polygons = []
+    for geometry, _ in rasterio.features.shapes(
+        prediction, mask=prediction > 0, transform=transform
+    ):
+        polygon = shape(geometry)
+        if not min_area < polygon.area < max_area:
+            continue
+        polygon = polygon.simplify(tolerance, preserve_topology=True)
+        polygons.append(polygon.buffer(1, join_style=3, single_sided=True))
+    return polygons
+
+
+def polygons_path(
+    project_name: str, res: float, compression: str, data_root: Path = None
+) -> Path:
+    """
+    Path of the GeoParquet file with the polygons of a project.
+    """
+    if data_root is None:
+        data_root = data_path
+    return (
+        data_root
+        / f"ML_prediction/polygons/res_{res}/{project_name}/{compression}.parquet"
+    )
+
+
+def polygonize_project(
+    project_name: str,
+    res: float,
+    compression: str,
+    n_workers: int = None,
+    chunk_size: int = 64,
+    data_root: Path = None,
+    **polygon_kwargs,
+) -> gpd.GeoDataFrame:
+    """
+    Polygonizes all prediction tiles of a project and saves them as GeoParquet.
+
+    Arguments:
+    - project_name, res, compression: the project (as in `predict.predict`)
+    - n_workers: number of worker processes (default: cpu_workers of the config)
+    - chunk_size: tiles per task sent to a worker
+    - data_root: data folder to use instead of data_path (e.g. for benchmarks)
+    - polygon_kwargs: passed to `polygonize_tile` (min_area, max_area, tolerance)
+
+    Returns:
+    - GeoDataFrame with the polygons and the tile (or store chunk) they come from
+    """
+    if data_root is None:
+        data_root = data_path
+    if n_workers is None:
+        n_workers = get_config().cpu_workers
+    store_dir = store_path(
+        "prediction_store", project_name, res, compression, data_root
+    )
+    if (store_dir / "store.json").exists():
+        # the chunks of the store are large, so they are sent one by one
+        units = TileStore(store_dir).chunks()
+        names = [f"chunk_{cx}_{cy}" for cx, cy in units]
+        function = partial(polygonize_chunk, store_dir=store_dir, **polygon_kwargs)
+        chunk_size = 1
+    else:
+        prediction_dir = (
+            data_root
+            / f"ML_prediction/predictions/res_{res}/{project_name}/{compression}"
+        )
+        units = sorted(prediction_dir.glob("*.tif"))
+        names = [tile_path.stem for tile_path in units]
+        function = partial(polygonize_tile, res=res, **polygon_kwargs)
+
+    tiles, geometries = [], []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = executor.map(function, units, chunksize=chunk_size)
+        for name, polygons in tqdm(
+            zip(names, results),
+            total=len(units),
+            desc=f"Polygonizing {project_name}",
+        ):
+            tiles.extend([name] * len(polygons))
+            geometries.extend(polygons)
+
+    gdf = gpd.GeoDataFrame({"tile": tiles, "geometry": geometries}, crs=crs)
+    output_path = polygons_path(project_name, res, compression, data_root)
+    os.makedirs(output_path.parent, exist_ok=True)
+    gdf.to_parquet(output_path)
+    return gdf
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Polygonize the predicted tiles of a project"
+    )
+    parser.add_argument("--project_name", required=True, type=str)
+    parser.add_argument("--res", required=False, type=float, default=0.3)
+    parser.add_argument("--compression", required=False, type=str, default="i_lzw_25")
+    parser.add_argument("--n_workers", required=False, type=int, default=None)
+    args = parser.parse_args()
+    polygonize_project(
+        args.project_name, args.res, args.compression, n_workers=args.n_workers
+    )
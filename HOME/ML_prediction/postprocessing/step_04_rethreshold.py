@@ -0,0 +1,188 @@
+"""
+Re-thresholds and ensembles stored probabilities, without running the network again.
+
+`predict --probabilities` keeps the quantized sigmoid of the building head in an 8 bit
+`TileStore` (ML_prediction/probability_store/...). From it
+- `rethreshold` writes the binary prediction store for another threshold (0.5 gives
+    back the masks of the network, since q >= 128 is exactly logit >= 0)
+- `ensemble` combines the probabilities of several stores on the same grid (e.g. runs
+    of different models, or the projects of several years of an area) by their mean,
+    max or min, where each store has a prediction
+
+The stores are processed chunk by chunk, with vectorized numpy on the unpacked chunks.
+Polygonization (`step_03_polygonization.py`) picks up the binary store of a project.
+"""
+
+# %% Imports
+import argparse
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from HOME.utils.tile_store import (
+    TileStore,
+    store_path,
+    quantize_probability,
+    dequantize_probability,
+    quantized_threshold,
+)
+from HOME.get_data_path import get_data_path
+
+# Get the root directory of the project
+root_dir = Path(__file__).resolve().parents[3]
+# print(root_dir)
+# get the data path (might change)
+data_path = get_data_path(root_dir)
+
+
+# %% function definitions
+def _create_like(store: TileStore, path: Path, bits: int) -> TileStore:
+    return TileStore(
+        path,
+        res=store.res,
+        tile_size=store.tile_size,
+        bits=bits,
+        chunk_cells=store.chunk_cells,
+    )
+
+
+def rethreshold(
+    probability_store: TileStore, output_path: Path, threshold: float = 0.5
+) -> TileStore:
+    """
+    Binary store of the pixels with probability >= threshold.
+
+    Arguments:
+    - probability_store: 8 bit store with quantized probabilities
+    - output_path: folder of the binary store (existing tiles are overwritten)
+    - threshold: probability threshold
+
+    Returns:
+    - the binary store
+    """
+    output = _create_like(probability_store, output_path, bits=1)
+    q_threshold = quantized_threshold(threshold)
+    t = probability_store.tile_size
+    for chunk in tqdm(probability_store.chunks(), desc="Re-thresholding"):
+        quantized, valid = probability_store.read_chunk(chunk)
+        output.write_chunk(chunk, quantized >= q_threshold, valid[::t, ::t])
+    output.flush()
+    return output
+
+
+def ensemble(
+    probability_stores: list[TileStore],
+    output_path: Path,
+    method: str = "mean",
+    weights: list[float] = None,
+) -> TileStore:
+    """
+    Combines the probabilities of several stores with the same layout.
+
+    Arguments:
+    - probability_stores: 8 bit stores with quantized probabilities
+    - output_path: folder of the combined 8 bit store
+    - method: "mean" (weighted by weights), "max" or "min"
+    - weights: weight per store for the mean (default: equal)
+
+    Returns:
+    - the combined probability store
+    """
+    first = probability_stores[0]
+    for store in probability_stores:
+        layout = (store.res, store.tile_size, store.chunk_cells, store.bits)
+        if layout != (first.res, first.tile_size, first.chunk_cells, 8):
+            raise ValueError(f"Store {store.path} does not match {first.path}")
+    if weights is None:
+        weights = [1.0] * len(probability_stores)
+
+    output = _create_like(first, output_path, bits=8)
+    chunks = sorted({chunk for store in probability_stores for chunk in store.chunks()})
+    t = first.tile_size
+    for chunk in tqdm(chunks, desc=f"Ensembling ({method})"):
+        combined, any_valid = None, None
+        weight_sum = None
+        for store, weight in zip(probability_stores, np.float32(weights)):
+            quantized, valid = store.read_chunk(chunk)
+            if not valid.any():
+                continue
+            if method == "mean":
+                probability = dequantize_probability(quantized) * (weight * valid)
+                if combined is None:
+                    combined, weight_sum = probability, weight * valid
+                else:
+                    combined += probability
+                    weight_sum += weight * valid
+            elif method in ("max", "min"):
+                # outside the valid area the store must not win
+                fill = 0 if method == "max" else 255
+                quantized = np.where(valid, quantized, fill).astype(np.uint8)
+                if combined is None:
+                    combined = quantized
+                else:
+                    reduce = np.maximum if method == "max" else np.minimum
+                    combined = reduce(combined, quantized)
+            else:
+                raise ValueError(f"Unknown method {method}")
+            any_valid = valid if any_valid is None else any_valid | valid
+        if combined is None:
+            continue
+        if method == "mean":
+            combined = quantize_probability(combined / np.maximum(weight_sum, 1e-9))
+        output.write_chunk(chunk, combined, any_valid[::t, ::t])
+    output.flush()
+    return output
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-threshold or ensemble the stored probabilities of projects"
+    )
+    parser.add_argument("--projects", nargs="+", required=True, type=str)
+    parser.add_argument("--res", required=False, type=float, default=0.3)
+    parser.add_argument("--compression", required=False, type=str, default="i_lzw_25")
+    parser.add_argument("--threshold", required=False, type=float, default=0.5)
+    parser.add_argument(
+        "--method", required=False, choices=["mean", "max", "min"], default="mean"
+    )
+    parser.add_argument("--weights", nargs="+", required=False, type=float)
+    parser.add_argument(
+        "--output_name",
+        required=False,
+        type=str,
+        default=None,
+        help="project name of the result (default: the only project)",
+    )
+    args = parser.parse_args()
+
+    stores = [
+        TileStore(
+            store_path(
+                "probability_store", project, args.res, args.compression, data_path
+            )
+        )
+        for project in args.projects
+    ]
+    output_name = args.output_name or args.projects[0]
+    if len(stores) > 1:
+        if args.output_name is None:
+            parser.error("--output_name is needed to ensemble several projects")
+        probability_store = ensemble(
+            stores,
+            store_path(
+                "probability_store", output_name, args.res, args.compression, data_path
+            ),
+            method=args.method,
+            weights=args.weights,
+        )
+    else:
+        probability_store = stores[0]
+    rethreshold(
+        probability_store,
+        store_path(
+            "prediction_store", output_name, args.res, args.compression, data_path
+        ),
+        threshold=args.threshold,
+    )
@@ -64,9 +64,10 @@ plt.show()
 
 # %% plot reassembled tiles in reference map
 from pathlib import Path
+from HOME.get_data_path import get_data_path
 
 root_dir = Path(__file__).resolve().parents[3]
-data_path = root_dir / "data"
+data_path = get_data_path(root_dir)
 
 reassambled_tiles = data_path / "temp/test_assembly"
 # all files in the directory
@@ -1,15 +1,16 @@
 # %%
-import torch
-import matplotlib
 import os
 import logging
 import sys
 from pathlib import Path
-from torch.utils.data import DataLoader
-import cv2
 from tqdm import tqdm
 import argparse
 from HOME.get_data_path import get_data_path
+from HOME.config import get_config
+from HOME.utils.metrics import metrics
+from HOME.utils.raster_io import write_raster, write_tile
+from HOME.utils.tile_grid import tile_name_to_grid
+from HOME.utils.tile_store import TileStore, store_path
 
 # Get the root directory of the project
 root_dir = Path(__file__).resolve().parents[3]
@@ -20,16 +21,12 @@ data_path = get_data_path(root_dir)
 grandparent_dir = Path(__file__).parents[4]
 sys.path.append(str(grandparent_dir))
 sys.path.append(str(grandparent_dir / "ISPRS_HD_NET"))
-from ISPRS_HD_NET.utils.sync_batchnorm.batchnorm import convert_model  # type: ignore # noqa
-from ISPRS_HD_NET.model.HDNet import HighResolutionDecoupledNet  # type: ignore # noqa
-from ISPRS_HD_NET.utils.dataset import BuildingDataset  # type: ignore # noqa
-from ISPRS_HD_NET.eval.eval_HDNet import eval_net  # type: ignore # noqa
-
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
-matplotlib.use("tkagg")
+# torch and HDNet are imported in the functions, so importing this module (e.g.
+# from the pipeline or for --help) stays cheap
 
 # %%
-data_dir = data_path / "ML_prediction/"
+# tiles and text files are on the fast storage (the data folder by default)
+data_dir = get_config().fast("ML_prediction/")
 predict = True
 
 
@@ -46,7 +43,28 @@ def predict_and_eval(
     num_workers=8,
     batchsize=16,
     read_name="",
+    res=None,
+    mask_store=None,
+    write_tiles=True,
+    probability_store=None,
+    boundary_store=None,
+    context_margin=0,
+    block_cells=4,
+    blend="center",
 ):
+    # res: resolution of the tiles, to georeference the predictions (None: without)
+    # mask_store: TileStore that also gets the (bit-packed) predictions
+    # write_tiles: write every prediction as a tif (False: only to the store)
+    # probability_store, boundary_store: 8 bit TileStores for the quantized sigmoid
+    #   of the building and the boundary head, to re-threshold without the network
+    # context_margin: predict blocks of block_cells x block_cells tiles with this
+    #   margin from the neighbouring tiles, blended "center" or "cosine" (see
+    #   context_inference.py); 0 predicts every tile on its own
+    import torch
+    from torch.utils.data import DataLoader
+    from ISPRS_HD_NET.utils.dataset import BuildingDataset  # type: ignore # noqa
+    from ISPRS_HD_NET.eval.eval_HDNet import eval_net  # type: ignore # noqa
+
     dataset = BuildingDataset(
         dataset_dir=data_dir,
         training=False,
@@ -55,6 +73,25 @@ def predict_and_eval(
         image_folder=image_folder,
         predict=predict,
     )
+    blender = None
+    if predict and context_margin > 0:
+        from HOME.ML_prediction.prediction.context_inference import (
+            ContextBlockDataset,
+            ContextBlender,
+            read_names,
+        )
+
+        if boundary_store is not None:
+            raise ValueError("The boundary head is not stored with context_margin")
+        dataset = ContextBlockDataset(
+            dataset,
+            read_names(os.path.join(data_dir, "dataset", txt_name)),
+            block_cells=block_cells,
+            margin=context_margin,
+        )
+        blender = ContextBlender(dataset, blend=blend)
+        # the batch size counts tiles, a window holds block_cells^2 of them
+        batchsize = max(1, batchsize // block_cells**2)
 
     loader = DataLoader(
         dataset,
@@ -64,26 +101,80 @@ def predict_and_eval(
         drop_last=False,
     )
 
+    def quantize(logits):
+        # uint8 like HOME.utils.tile_store.quantize_probability, on the device
+        quantized = torch.floor(torch.sigmoid(logits) * 256).clamp_(max=255)
+        return quantized.to(torch.uint8).reshape(-1, *logits.shape[-2:]).cpu().numpy()
+
+    n_written = 0
+
+    def write_outputs(names, logits, boundary_logits=None):
+        # names: tile paths (.../res/project/compression/tile), logits: building head
+        nonlocal n_written
+        if len(names) == 0:
+            return
+        n_written += len(names)
+        label_pred = (logits > 0).to(torch.uint8).reshape(-1, *logits.shape[-2:])
+        label_pred = label_pred.cpu().numpy() * 255
+        stores = []
+        if mask_store is not None:
+            stores.append((mask_store, label_pred))
+        if probability_store is not None:
+            stores.append((probability_store, quantize(logits)))
+        if boundary_store is not None:
+            stores.append((boundary_store, quantize(boundary_logits)))
+
+        cells = [tile_name_to_grid(os.path.basename(name)) for name in names]
+        for store, tiles in stores:
+            with metrics.timer("store_seconds", stage="prediction"):
+                store.write_tiles(cells, tiles)
+        for i in range(len(names) if write_tiles else 0):
+            img_name = "/".join(names[i].split("/")[-4:])
+            img_path = os.path.join(save_path, img_name)
+            os.makedirs(os.path.dirname(img_path), exist_ok=True)
+            with metrics.timer("encode_seconds", stage="prediction"):
+                if res is None:
+                    write_raster(img_path, label_pred[i])
+                else:
+                    write_tile(img_path, label_pred[i], res)
+        metrics.inc("tiles_predicted", len(names), stage="prediction")
+
     if predict:
         save_path = os.path.join(data_dir, prediction_folder)
         print("Saving predictions in ", save_path)
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        for batch in tqdm(loader):
+        batches = iter(tqdm(loader))
+        while True:
+            # time spent waiting for the DataLoader (reading and decoding tiles)
+            with metrics.timer("data_wait_seconds", stage="prediction"):
+                batch = next(batches, None)
+            if batch is None:
+                break
             imgs = batch["image"]
             imgs = imgs.to(device=device, dtype=torch.float32)
 
             with torch.no_grad():
-                pred = net(imgs)
-                pred1 = (pred[0] > 0).float()
-                label_pred = pred1.squeeze().cpu().int().numpy().astype("uint8") * 255
-
-                for i in range(len(pred1)):
-                    img_name = "/".join(batch["name"][i].split("/")[-4:])
-                    img_path = os.path.join(save_path, img_name)
-                    os.makedirs(os.path.dirname(img_path), exist_ok=True)
-                    wr = cv2.imwrite(img_path, label_pred[i])
-                    if not wr:
-                        print("Save failed!")
+                # includes the transfer back to the cpu, which waits for the GPU
+                with metrics.timer("forward_seconds", stage="prediction"):
+                    pred = net(imgs)
+                    if blender is None:
+                        names, logits = batch["name"], pred[0].cpu()
+                    else:
+                        names, logits = blender.add(batch["block"].tolist(), pred[0])
+                    boundary_logits = (
+                        pred[1].cpu() if boundary_store is not None else None
+                    )
+                write_outputs(names, logits, boundary_logits)
+        if blender is not None:
+            write_outputs(*blender.finish())
+            # every name gets its prediction, also several tiles of the same cell
+            if n_written != len(dataset.names):
+                raise RuntimeError(
+                    f"Predicted {n_written} of {len(dataset.names)} tiles"
+                )
+        for store in (mask_store, probability_store, boundary_store):
+            if store is not None:
+                store.flush()
     else:
         best_score = eval_net(
             net, loader, device, savename=Dataset + "_" + read_name
@@ -91,7 +182,35 @@ def predict_and_eval(
         print("Best iou:", best_score)
 
 
-def predict(project_name, res=0.3, compression="i_lzw_25", BW=False):
+def predict(
+    project_name,
+    res=0.3,
+    compression="i_lzw_25",
+    BW=False,
+    output="tiles",
+    probabilities=False,
+    boundary=False,
+    context_margin=0,
+    block_cells=4,
+    blend="center",
+    checkpoint=None,
+):
+    # checkpoint: weights (.pth) to use instead of the default run of BW/RGB, e.g.
+    #   a run trained with `train.py --augment`
+    # output: "tiles" (a tif per tile), "store" (bit-packed TileStore) or "both"
+    # probabilities, boundary: also store the quantized probabilities of the building
+    #   (and boundary) head, see postprocessing/step_04_rethreshold.py
+    # context_margin, block_cells, blend: inference on context-padded blocks, see
+    #   context_inference.py
+    # before torch initializes CUDA
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "0")
+    import torch
+    from ISPRS_HD_NET.utils.sync_batchnorm.batchnorm import (  # type: ignore # noqa
+        convert_model,
+    )
+    from ISPRS_HD_NET.model.HDNet import (  # type: ignore # noqa
+        HighResolutionDecoupledNet,
+    )
 
     logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -105,13 +224,15 @@ def predict(project_name, res=0.3, compression="i_lzw_25", BW=False):
         dir_checkpoint = data_path / "ML_model/save_weights/run_7/"
         Dataset = "NOCI"
         read_name = f"HDNet_NOCI_{res}_best"
+    if checkpoint is not None:
+        dir_checkpoint, read_name = Path(checkpoint).parent, Path(checkpoint).stem
 
     pred_name = f"pred_{project_name}_{res}_{compression}.txt"
     # prediction_folder = "predictions/test/"
 
     prediction_folder = data_path / "ML_prediction/predictions"
     batchsize = 16
-    num_workers = 8
+    num_workers = get_config().loader_workers
 
     image_folder = "topredict/image/"
 
@@ -132,19 +253,50 @@ def predict(project_name, res=0.3, compression="i_lzw_25", BW=False):
 
     print("Number of parameters: ", sum(p.numel() for p in net.parameters()))
 
-    predict_and_eval(
-        net=net,
-        device=device,
-        data_dir=data_dir,
-        predict=True,
-        prediction_folder=prediction_folder,
-        image_folder=image_folder,
-        txt_name=pred_name,
-        num_workers=num_workers,
-        Dataset=Dataset,
-        batchsize=batchsize,
-        read_name=read_name,
-    )
+    mask_store = None
+    if output in ("store", "both"):
+        mask_store = TileStore(
+            store_path("prediction_store", project_name, res, compression, data_path),
+            res=res,
+        )
+    probability_store, boundary_store = None, None
+    if probabilities:
+        probability_store = TileStore(
+            store_path(
+                "probability_store", project_name, res, compression, data_path
+            ),
+            res=res,
+            bits=8,
+        )
+    if boundary:
+        boundary_store = TileStore(
+            store_path("boundary_store", project_name, res, compression, data_path),
+            res=res,
+            bits=8,
+        )
+
+    with metrics.stage("prediction", project=project_name, device=str(device)):
+        predict_and_eval(
+            net=net,
+            device=device,
+            data_dir=data_dir,
+            predict=True,
+            prediction_folder=prediction_folder,
+            image_folder=image_folder,
+            txt_name=pred_name,
+            num_workers=num_workers,
+            Dataset=Dataset,
+            batchsize=batchsize,
+            read_name=read_name,
+            res=res,
+            mask_store=mask_store,
+            write_tiles=output in ("tiles", "both"),
+            probability_store=probability_store,
+            boundary_store=boundary_store,
+            context_margin=context_margin,
+            block_cells=block_cells,
+            blend=blend,
+        )
 
 
 if __name__ == "__main__":
@@ -158,10 +310,28 @@ if __name__ == "__main__":
         "-c", "--compression", required=False, type=str, default="i_lzw_25"
     )
     parser.add_argument("-bw", "--BW", required=False, type=bool, default=False)
+    parser.add_argument(
+        "--output", required=False, choices=["tiles", "store", "both"], default="tiles"
+    )
+    parser.add_argument("--probabilities", action="store_true")
+    parser.add_argument("--boundary", action="store_true")
+    parser.add_argument("--checkpoint", required=False, type=str, default=None)
+    parser.add_argument("--context_margin", required=False, type=int, default=0)
+    parser.add_argument("--block_cells", required=False, type=int, default=4)
+    parser.add_argument(
+        "--blend", required=False, choices=["center", "cosine"], default="center"
+    )
     args = parser.parse_args()
     predict(
         project_name=args.project_name,
         res=args.res,
         compression=args.compression,
         BW=args.BW,
+        output=args.output,
+        probabilities=args.probabilities,
+        boundary=args.boundary,
+        context_margin=args.context_margin,
+        block_cells=args.block_cells,
+        blend=args.blend,
+        checkpoint=args.checkpoint,
     )
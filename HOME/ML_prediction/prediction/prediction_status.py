@@ -4,16 +4,19 @@ Tracks he status based on the number of tiles in to_predict and predictions fold
 # %%
 import os
 from pathlib import Path
+from HOME.get_data_path import get_data_path
+from HOME.config import get_config
 import shutil
 import numpy as np
 import json
 
 root_dir = Path(__file__).parents[3]
+data_path = get_data_path(root_dir)
 
 # %%
 def prediciton_status(project_name):
     # Assuming root_dir is already defined and is a Path object
-    project_details_path = root_dir / "data/ML_prediction/project_log/project_details.json"
+    project_details_path = data_path / "ML_prediction/project_log/project_details.json"
 
     # Open the file and load its contents into a variable
     with open(project_details_path, 'r') as file:
@@ -24,8 +27,8 @@ def prediciton_status(project_name):
             project_details[project_name]["compression_value"],
         )
     # to predict and prediction folder
-    to_predict_folder = root_dir / f"data/ML_prediction/topredict/image/res_{res}/{project_name}/i_{compression_name}_{compression_value}"
-    prediction_folder = root_dir / f"data/ML_prediction/predictions/res_{res}/{project_name}/i_{compression_name}_{compression_value}"
+    to_predict_folder = get_config().fast_root / f"ML_prediction/topredict/image/res_{res}/{project_name}/i_{compression_name}_{compression_value}"
+    prediction_folder = data_path / f"ML_prediction/predictions/res_{res}/{project_name}/i_{compression_name}_{compression_value}"
 
     # count the number of tiles in to_predict and predictions folders
     to_predict_tiles = len(os.listdir(to_predict_folder))
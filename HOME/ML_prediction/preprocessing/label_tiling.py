@@ -0,0 +1,232 @@
+"""
+Makes FKB labels for the prediction tiles of a project, one grid cell at a time.
+
+Only the grid cells that have an image tile in `topredict/image` are rasterized, so a
+sparse project never allocates a label image over its whole bbox. The cells are
+rasterized in parallel (the buildings of a cell are found with an STRtree query) and
+cached on disk keyed by (grid_x, grid_y, res, tile_size, cutoff_year): evaluating
+several projects from the same year, or the same area against FKB of another year,
+reuses the cells that were already rasterized. `step_01_tile_generation.tile_labels`
+makes its labels through this cache.
+"""
+
+# %%
+import os
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+
+import numpy as np
+import pandas as pd
+from shapely import STRtree, box
+from rasterio.features import geometry_mask
+from tqdm import tqdm
+
+os.environ["OPENCV_IO_MAX_IMAGE_PIXELS"] = str(pow(2, 40))
+import cv2  # noqa
+
+from HOME.ML_training.preprocessing.get_label_data.label_store import (
+    get_label_store,
+    read_labels,
+)
+from HOME.utils.tile_grid import tile_name_to_grid, get_tile_bounds, get_tile_transform
+from HOME.utils.raster_io import write_tile
+from HOME.get_data_path import get_data_path
+from HOME.config import get_config
+
+# Get the root directory of the project
+root_dir = Path(__file__).resolve().parents[3]
+# print(root_dir)
+# get the data path (might change)
+data_path = get_data_path(root_dir)
+
+
+# %%
+def get_label_cache_dir(res: float, tile_size: int, cutoff_year: int) -> Path:
+    """
+    Folder of the cached label cells for a resolution, tile size and cutoff year.
+    """
+    return (
+        data_path
+        / f"ML_prediction/label_cache/res_{res}/tile_{tile_size}/cutoff_{cutoff_year}"
+    )
+
+
+def rasterize_cells(
+    cells: list[tuple[int, int]],
+    geometries: np.ndarray,
+    res: float,
+    tile_size: int,
+    cache_dir: Path,
+) -> int:
+    """
+    Rasterizes the labels of a list of grid cells and writes them to the cache
+    (run in a worker process).
+
+    Arguments:
+    - cells: list of (grid_x, grid_y)
+    - geometries: building geometries (EPSG:25833) that may intersect the cells
+    - res: resolution in m per pixel
+    - tile_size: tile size in pixels
+    - cache_dir: folder of the cache
+
+    Returns:
+    - number of cells written
+    """
+    tree = STRtree(geometries)
+    for grid_x, grid_y in cells:
+        cell_geometries = geometries[
+            tree.query(box(*get_tile_bounds(grid_x, grid_y, res, tile_size)))
+        ]
+        if len(cell_geometries) > 0:
+            label = geometry_mask(
+                cell_geometries,
+                transform=get_tile_transform(grid_x, grid_y, res, tile_size),
+                out_shape=(tile_size, tile_size),
+                invert=True,
+            ).astype(np.uint8)
+        else:
+            label = np.zeros((tile_size, tile_size), dtype=np.uint8)
+        # write and rename, so an interrupted run never leaves a broken cell behind
+        tmp_path = cache_dir / f"{grid_x}_{grid_y}.tmp.png"
+        cv2.imwrite(str(tmp_path), label)
+        os.replace(tmp_path, cache_dir / f"{grid_x}_{grid_y}.png")
+    return len(cells)
+
+
+def fill_label_cache(
+    cells: list[tuple[int, int]],
+    res: float,
+    cutoff_year: int,
+    tile_size: int = 512,
+    n_workers: int = None,
+    chunk_size: int = 256,
+) -> Path:
+    """
+    Makes sure all the given grid cells are in the label cache.
+
+    Arguments:
+    - cells: list of (grid_x, grid_y)
+    - res: resolution in m per pixel
+    - cutoff_year: only buildings registered (datafangstdato) before this year
+    - tile_size: tile size in pixels
+    - n_workers: number of worker processes (default: all cores)
+    - chunk_size: number of cells handed to a worker at once
+
+    Returns:
+    - the folder of the cache
+    """
+    cache_dir = get_label_cache_dir(res, tile_size, cutoff_year)
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = {
+        f[:-4]
+        for f in os.listdir(cache_dir)
+        if f.endswith(".png") and not f.endswith(".tmp.png")
+    }
+    missing = sorted(
+        {(x, y) for x, y in cells if f"{x}_{y}" not in cached},
+        key=lambda cell: (-cell[1], cell[0]),
+    )
+    if not missing:
+        return cache_dir
+    print(f"Rasterizing {len(missing)} of {len(cells)} label cells")
+
+    # all buildings for the missing cells, read from the label store once
+    missing_array = np.array(missing)
+    grid_size_m = res * tile_size
+    bbox = [
+        missing_array[:, 0].min() * grid_size_m,
+        (missing_array[:, 1].min() - 1) * grid_size_m,
+        (missing_array[:, 0].max() + 1) * grid_size_m,
+        missing_array[:, 1].max() * grid_size_m,
+    ]
+    cutoff_date = pd.to_datetime(cutoff_year, format="%Y").tz_localize("UTC")
+    buildings = read_labels(
+        get_label_store(data_path), bbox, cutoff_date=cutoff_date, columns=["geometry"]
+    )
+    geometries = buildings.geometry.to_numpy()
+    tree = STRtree(geometries)
+
+    # neighbouring cells go to the same worker, together with only their buildings
+    chunks = [missing[i : i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = []
+        for chunk in chunks:
+            chunk_array = np.array(chunk)
+            chunk_box = box(
+                chunk_array[:, 0].min() * grid_size_m,
+                (chunk_array[:, 1].min() - 1) * grid_size_m,
+                (chunk_array[:, 0].max() + 1) * grid_size_m,
+                chunk_array[:, 1].max() * grid_size_m,
+            )
+            futures.append(
+                executor.submit(
+                    rasterize_cells,
+                    chunk,
+                    geometries[tree.query(chunk_box)],
+                    res,
+                    tile_size,
+                    cache_dir,
+                )
+            )
+        with tqdm(total=len(missing), desc="Rasterizing labels") as pbar:
+            for future in futures:
+                pbar.update(future.result())
+    return cache_dir
+
+
+def tile_labels_cached(
+    project_name: str,
+    res: float = 0.2,
+    compression: str = "i_lzw_25",
+    tile_size: int = 512,
+    n_workers: int = None,
+) -> None:
+    """
+    Writes a label tile for every image tile of a project, using (and filling) the
+    label cache. Labels are 0/1 and have the same name as their image tile.
+
+    Arguments:
+    - project_name: name of the project, the last part is the year used as cutoff
+    - res: resolution in m per pixel
+    - compression: compression of the project (folder name)
+    - tile_size: tile size in pixels
+    - n_workers: number of worker processes (default: all cores)
+    """
+    cutoff_year = int(project_name.split("_")[-1])
+    # the tiles to predict are on the fast storage (see HOME.config)
+    dir_images = get_config().fast(
+        f"ML_prediction/topredict/image/res_{res}/{project_name}/{compression}/"
+    )
+    output_dir_labels = get_config().fast(
+        f"ML_prediction/topredict/label/res_{res}/{project_name}/{compression}/"
+    )
+    os.makedirs(output_dir_labels, exist_ok=True)
+
+    image_tiles = [f for f in os.listdir(dir_images) if f.endswith(".tif")]
+    cells = [tile_name_to_grid(image_tile) for image_tile in image_tiles]
+    cache_dir = fill_label_cache(cells, res, cutoff_year, tile_size, n_workers)
+
+    for image_tile, (grid_x, grid_y) in tqdm(
+        zip(image_tiles, cells), total=len(cells), desc="Writing labels"
+    ):
+        label_tile = cv2.imread(
+            str(cache_dir / f"{grid_x}_{grid_y}.png"), cv2.IMREAD_GRAYSCALE
+        )
+        write_tile(output_dir_labels / image_tile, label_tile, res, tile_size)
+    return
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Make FKB labels for the prediction tiles of a project"
+    )
+    parser.add_argument("--project_name", required=True, type=str)
+    parser.add_argument("--res", required=False, type=float, default=0.2)
+    parser.add_argument("--compression", required=False, type=str, default="i_lzw_25")
+    parser.add_argument("--n_workers", required=False, type=int, default=None)
+    args = parser.parse_args()
+    tile_labels_cached(
+        args.project_name, args.res, args.compression, n_workers=args.n_workers
+    )
@@ -11,15 +11,12 @@ from tqdm import tqdm
 from pathlib import Path
 import shutil
 import argparse
-from osgeo import gdal
 import pandas as pd
-import geopandas as gpd
-from HOME.ML_training.preprocessing.get_label_data.get_labels import get_labels
 
-# Increase the maximum number of pixels OpenCV can handle
-os.environ["OPENCV_IO_MAX_IMAGE_PIXELS"] = str(pow(2, 40))
-import cv2  # noqa
 from HOME.get_data_path import get_data_path
+from HOME.config import get_config
+from HOME.utils.metrics import metrics
+from HOME.utils.raster_io import write_tile
 
 # Get the root directory of the project
 root_dir = Path(__file__).resolve().parents[3]
@@ -46,6 +43,14 @@ def tile_images_no_labels(
     north and east. The tiles are only created if the corresponding grid cell is in the
     prediction_mask.
     """
+    # imported here, so importing this module (e.g. for tile_labels) stays cheap
+    from osgeo import gdal
+
+    # Increase the maximum number of pixels OpenCV can handle (only has an effect
+    # before the first import of cv2 in the process)
+    os.environ["OPENCV_IO_MAX_IMAGE_PIXELS"] = str(pow(2, 40))
+    import cv2
+
     # Load the prediction mask we have premade if no other is provided
     if prediction_mask is None:
         prediction_mask = pd.read_csv(
@@ -75,8 +80,9 @@ def tile_images_no_labels(
     for image_file in image_files:
         image_path = os.path.join(input_dir_images, image_file)
         # Load the image
-        dataset = gdal.Open(image_path)
-        geotransform = dataset.GetGeoTransform()
+        with metrics.timer("decode_seconds", stage="tiling"):
+            dataset = gdal.Open(image_path)
+            geotransform = dataset.GetGeoTransform()
 
         # Calculate the coordinates of the top left corner
         top_left_x = geotransform[0]
@@ -93,7 +99,9 @@ def tile_images_no_labels(
         offset_y_px = (coordgrid_top_left_y * grid_size_m - top_left_y) / res
 
         # Pad the image to ensure that the top right point lies on the grid
-        image = cv2.imread(image_path)
+        with metrics.timer("decode_seconds", stage="tiling"):
+            image = cv2.imread(image_path)
+        metrics.inc("pixels_read", image.shape[0] * image.shape[1], stage="tiling")
         image = cv2.copyMakeBorder(
             image,
             int(np.round(offset_y_px)),
@@ -155,13 +163,28 @@ def tile_images_no_labels(
                             image_tile_path = os.path.join(
                                 output_dir_images, image_tile_filename
                             )
-                            cv2.imwrite(image_tile_path, image_tile)
+                            with metrics.timer("encode_seconds", stage="tiling"):
+                                write_tile(
+                                    image_tile_path,
+                                    image_tile,
+                                    res,
+                                    tile_size,
+                                    predictor="horizontal",
+                                )
+                            metrics.inc("tiles_written", stage="tiling")
+                            metrics.inc(
+                                "bytes_written",
+                                os.path.getsize(image_tile_path),
+                                stage="tiling",
+                            )
 
                         else:
                             skipped_tiles += 1
+                            metrics.inc("tiles_skipped", stage="tiling", reason="empty")
 
                     else:  # no need to write a tile outside the prediction mask
                         skipped_tiles += 1
+                        metrics.inc("tiles_skipped", stage="tiling", reason="mask")
                     pbar.update(1)
 
             # Move the processed image to the archive directory
@@ -191,88 +214,16 @@ def tile_labels(
     overlap_rate=0.00,
     image_size=None,
 ):
+    """
+    Makes labels for the tiles of a project (0/1, named like the image tiles). Only
+    the grid cells with an image tile are rasterized, and they are cached, see
+    `label_tiling.tile_labels_cached`.
+    """
+    from HOME.ML_prediction.preprocessing.label_tiling import tile_labels_cached
 
-    year = int(project_name.split("_")[-1])
-    year_dt_utc = pd.to_datetime(year, format="%Y").tz_localize("UTC")
-
-    ### Makes label for a given project
-    dir_images = (
-        data_path
-        / f"ML_prediction/topredict/image/res_{res}/{project_name}/{compression}/"
-    )
-
-    output_dir_labels = (
-        data_path
-        / f"ML_prediction/topredict/label/res_{res}/{project_name}/{compression}/"
-    )
-
-    # Create output directories if they don't exist
-    os.makedirs(output_dir_labels, exist_ok=True)
-
-    # Get list of all image files in the input directory
-    image_tiles = [f for f in os.listdir(dir_images) if f.endswith(".tif")]
-
-    # Initialize min and max coordinates
-    min_coord_x = min_coord_y = float("inf")
-    max_coord_x = max_coord_y = float("-inf")
-
-    for image_tile in image_tiles:
-        # Split the filename on underscore
-        parts = image_tile.split(".")[0].split("_")
-
-        # Extract coord_x and coord_y
-        coord_x = int(parts[-2])
-        coord_y = int(parts[-1])
-
-        # Update min and max coordinates
-        min_coord_x = min(min_coord_x, coord_x)
-        min_coord_y = min(min_coord_y, coord_y)
-        max_coord_x = max(max_coord_x, coord_x)
-        max_coord_y = max(max_coord_y, coord_y)
-
-    effective_tile_size = int(tile_size * (1 - overlap_rate))
-    grid_size_m = res * effective_tile_size
-
-    path_label = (
-        data_path / "raw/FKB_bygning"
-        + "/Basisdata_0000_Norge_5973_FKB-Bygning_FGDB.gdb"
-    )
-    gdf_omrade = gpd.read_file(path_label, driver="FileGDB", layer="fkb_bygning_omrade")
-    gdf_omrade_subset = gdf_omrade[gdf_omrade["datafangstdato"] <= year_dt_utc]
-
-    bbox = (
-        np.array([min_coord_x, min_coord_y, max_coord_x + 1, max_coord_y + 1])
-        * grid_size_m
-    )
-
-    label, _ = get_labels(gdf_omrade_subset, bbox, res, in_degree=False)
-
-    # Calculate the image size if not given
-    total_iterations = len(image_tiles)
-
-    with tqdm(total=total_iterations, desc="Processing") as pbar:
-        for image_tile in image_tiles:
-
-            # Split the filename on underscore
-            parts = image_tile.split(".")[0].split("_")
-
-            # Extract coord_x and coord_y
-            coord_x = int(parts[-2])
-            coord_y = int(parts[-1])
-
-            x = (coord_x - min_coord_x) * effective_tile_size
-            y = (coord_y - min_coord_y) * effective_tile_size
-
-            label_tile = label[y : y + effective_tile_size, x : x + effective_tile_size]
-
-            # Save the label tile to the output directory
-            label_tile_filename = f"{project_name}_{parts[2]}_{coord_x}_{coord_y}.tif"
-            label_tile_path = os.path.join(output_dir_labels, label_tile_filename)
-
-            cv2.imwrite(label_tile_path, label_tile)
-
-            pbar.update(1)
-
+    if overlap_rate != 0:
+        raise ValueError("Labels are only made for tiles on the grid (no overlap)")
+    tile_labels_cached(project_name, res, compression, tile_size)
     return
 
 
@@ -282,9 +233,9 @@ def tile_generation(project_name, res, compression, prediction_mask=None):
     input_dir_images = (
         data_path / f"raw/orthophoto/res_{res}/{project_name}/{compression}/"
     )
-    output_dir_images = (
-        data_path
-        / f"ML_prediction/topredict/image/res_{res}/{project_name}/{compression}/"
+    # the tiles are read again right away for prediction: on the fast storage
+    output_dir_images = get_config().fast(
+        f"ML_prediction/topredict/image/res_{res}/{project_name}/{compression}/"
     )
 
     print(
@@ -292,15 +243,16 @@ def tile_generation(project_name, res, compression, prediction_mask=None):
         + f"compression {compression}"
     )
 
-    tile_images_no_labels(
-        input_dir_images,
-        output_dir_images,
-        tile_size=512,
-        overlap_rate=0.00,
-        project_name=project_name,
-        res=res,
-        prediction_mask=prediction_mask,
-    )
+    with metrics.stage("tiling", project=project_name):
+        tile_images_no_labels(
+            input_dir_images,
+            output_dir_images,
+            tile_size=512,
+            overlap_rate=0.00,
+            project_name=project_name,
+            res=res,
+            prediction_mask=prediction_mask,
+        )
     return
 
 
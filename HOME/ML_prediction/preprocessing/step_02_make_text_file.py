@@ -6,6 +6,7 @@ import argparse
 # %%
 current_dir = Path(__file__).parents[0]
 from HOME.get_data_path import get_data_path
+from HOME.config import get_config
 
 # Get the root directory of the project
 root_dir = Path(__file__).resolve().parents[3]
@@ -14,14 +15,17 @@ root_dir = Path(__file__).resolve().parents[3]
 data_path = get_data_path(root_dir)
 
 
-def make_text_file(project_name, res=0.3, compression="i_lzw_25"):
+def make_text_file(project_name, res=0.3, compression="i_lzw_25", data_root=None):
+    # data_root: data folder to use instead of the fast root (e.g. for benchmarks)
+    if data_root is None:
+        data_root = get_config().fast_root
     dir_images = (
-        data_path
+        data_root
         / f"ML_prediction/topredict/image/res_{res}/{project_name}/{compression}/"
     )
 
     pred_file = open(
-        data_path
+        data_root
         / f"ML_prediction/dataset/pred_{project_name}_{res}_{compression}.txt",
         "w",
     )
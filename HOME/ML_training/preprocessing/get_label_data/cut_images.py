@@ -1,9 +1,72 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import rasterio
 from rasterio.windows import Window
 import numpy as np
 from pathlib import Path
-from HOME.utils.bbox_to_meters import convert_bbox_to_meters  # noqa
-from pathlib import Path
+from HOME.utils.bbox_to_meters import (  # noqa
+    convert_bbox_to_meters,
+    convert_bboxes_to_meters,
+)
+
+target_crs = "EPSG:25833"
+# tiled and compressed outputs, so the tiling can read windows of them cheaply
+output_profile = {
+    "tiled": True,
+    "blockxsize": 256,
+    "blockysize": 256,
+    "compress": "lzw",
+}
+
+
+def bbox_window(src, bbox_m: list, pixel_size: float) -> Window:
+    """
+    Window of a bbox (in meters, EPSG:25833) in an opened raster, truncated to the
+    raster (empty if the bbox is outside of it).
+    """
+    left, bottom, right, top = bbox_m
+    width = int((right - left) / pixel_size)
+    height = int((top - bottom) / pixel_size)
+    # src.index gives (row, col), the window wants (col_off, row_off)
+    top_row, left_col = src.index(left, top)
+    col_start, row_start = max(left_col, 0), max(top_row, 0)
+    col_end = min(left_col + width, src.width)
+    row_end = min(top_row + height, src.height)
+    return Window(
+        col_start, row_start, max(col_end - col_start, 0), max(row_end - row_start, 0)
+    )
+
+
+def read_block_aligned(src, window: Window, indexes=(1, 2, 3)) -> np.ndarray:
+    """
+    Reads a window (inside the raster, see `bbox_window`) by reading the surrounding
+    window aligned to the internal blocks of the raster (so no block is decoded for
+    two partial reads) and cropping it. The aligned window is truncated at the right
+    and bottom edge of the raster, so the read never needs rasterio's (much slower)
+    boundless mode.
+    """
+    block_height, block_width = src.block_shapes[0]
+    col_off, row_off = int(window.col_off), int(window.row_off)
+    width, height = int(window.width), int(window.height)
+    if width <= 0 or height <= 0:
+        return np.zeros((len(indexes), max(height, 0), max(width, 0)), np.uint8)
+    aligned_col = (col_off // block_width) * block_width
+    aligned_row = (row_off // block_height) * block_height
+    aligned_width = -(-(col_off + width - aligned_col) // block_width) * block_width
+    aligned_height = -(-(row_off + height - aligned_row) // block_height) * block_height
+    aligned = src.read(
+        list(indexes),
+        window=Window(
+            aligned_col,
+            aligned_row,
+            min(aligned_width, src.width - aligned_col),
+            min(aligned_height, src.height - aligned_row),
+        ),
+    )
+    row, col = row_off - aligned_row, col_off - aligned_col
+    return aligned[:, row : row + height, col : col + width]
 
 
 def cut_geotiff(geotiff_path, bbox: list, pixel_size: float) -> np.array:
@@ -18,12 +81,8 @@ def cut_geotiff(geotiff_path, bbox: list, pixel_size: float) -> np.array:
     Returns:
     np.array : subset of the image
     """
-    target_crs = "EPSG:25833"
     # Define the bounding box and the resolution
-    [left, bottom, right, top] = convert_bbox_to_meters(bbox)
-
-    width = int((right - left) / pixel_size)
-    height = int((top - bottom) / pixel_size)
+    bbox_m = convert_bbox_to_meters(bbox)
 
     # Read the GeoTIFF file
     with rasterio.open(geotiff_path) as src:
@@ -32,25 +91,75 @@ def cut_geotiff(geotiff_path, bbox: list, pixel_size: float) -> np.array:
         assert (
             src.crs == target_crs
         ), f"The crs of the geotiff is not ETRS89, but {src.crs}"
-        # Convert the bounding box to pixel coordinates
-        left_col, top_row = src.index(left, top)
-        right_col, bottom_row = src.index(right, bottom)
-        # print(left_col, top_row, right_col, bottom_row)
-
         # Make a window from the bounding box
-        window = Window(top_row, left_col, width, height)
+        window = bbox_window(src, bbox_m, pixel_size)
 
         # Calculate the transform for the subset
         subset_transform = src.window_transform(window)
 
         # Read a subset of the GeoTIFF data
-        subset = src.read([1, 2, 3], window=window)
+        subset = read_block_aligned(src, window)
 
         # Rearrange the dimensions of the array
         # subset = np.transpose(subset, (1, 2, 0))
     return subset, subset_transform
 
 
+def cut_geotiffs(
+    geotiff_path,
+    bboxes: list,
+    file_names: list,
+    pixel_size: float,
+    save_folder: str = "data/temp/pretrain/images/",
+    n_workers: int = 4,
+) -> list:
+    """
+    Cuts many bboxes from the same geotiff and saves them (tiled, LZW). The bboxes are
+    converted to meters at once and cut concurrently, every thread keeps its own
+    handle of the geotiff.
+
+    Arguments:
+    geotiff_path : str : path to the geotiff file
+    bboxes : list : [left, bottom, right, top] in EPSG:4326 for every cut
+    file_names : list : file name (without .tif) for every cut
+    pixel_size : float : size of the pixels in m
+    save_folder : str : folder for the cuts, relative to the root of the repo
+    n_workers : int : number of threads
+
+    Returns:
+    list : the file names of the cuts that were saved (empty cuts are skipped)
+    """
+    bboxes_m = convert_bboxes_to_meters(bboxes)
+    with rasterio.open(geotiff_path) as src:
+        assert (
+            src.crs == target_crs
+        ), f"The crs of the geotiff is not ETRS89, but {src.crs}"
+
+    local = threading.local()
+    handles = []
+
+    def cut(bbox_m, file_name):
+        if not hasattr(local, "src"):
+            local.src = rasterio.open(geotiff_path)
+            handles.append(local.src)
+        window = bbox_window(local.src, bbox_m, pixel_size)
+        subset = read_block_aligned(local.src, window)
+        if subset.size == 0:
+            return None
+        save_cut_geotiff(
+            subset, file_name, local.src.window_transform(window), save_folder
+        )
+        return file_name
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            saved = list(executor.map(cut, bboxes_m, file_names))
+    finally:
+        for handle in handles:
+            handle.close()
+    return [file_name for file_name in saved if file_name is not None]
+
+
 def save_cut_geotiff(
     data: np.ndarray,
     file_name: str,
@@ -76,10 +185,11 @@ def save_cut_geotiff(
         "height": data.shape[1],
         "crs": "EPSG:25833",
         "transform": transform,
-        # 'transform': transform # lets pray it doens't need a transform
+        **output_profile,
     }
     root_dir = Path(__file__).parents[4]
     file_path = root_dir / save_folder / f"{file_name}.tif"
+    os.makedirs(file_path.parent, exist_ok=True)
     # Write the data to a new GeoTIFF file
     with rasterio.open(file_path, "w", **meta) as dst:
         dst.write(data)
@@ -14,7 +14,7 @@ def get_labels(
 
     Arguments:
     fkb_omrade_gdf: GeoDataFrame containing ALL the building footprints for
-    the area
+    the area (e.g. read for the bbox from the label store with `read_labels`)
     bbox: list, the bounding box of the area of interest - coordinates in the
               form [left, bottom, right, top] in WGS84 (EPSG:4326)
     pixel_size: float, the size of the pixel in meters
@@ -40,7 +40,9 @@ def get_labels(
     # Create an empty array of the same size as the GeoTIFF
     data = np.zeros((height, width), dtype=rasterio.uint8)
 
-    fkb_omrade_gdf = fkb_omrade_gdf.to_crs(target_crs)
+    # the label store (see label_store.py) is already in the target crs
+    if fkb_omrade_gdf.crs != target_crs:
+        fkb_omrade_gdf = fkb_omrade_gdf.to_crs(target_crs)
     # filter the gdf for the selection:
     fkb_omrade_gdf_filtered = fkb_omrade_gdf.cx[left:right, bottom:top]
 
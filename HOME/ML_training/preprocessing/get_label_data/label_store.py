@@ -0,0 +1,205 @@
+"""
+Spatially partitioned store of the FKB-Bygning building footprints.
+
+The national FileGDB is converted once into a hive-partitioned GeoParquet dataset in
+EPSG:25833. Every feature is assigned to the partition (square of partition_size_m)
+containing the lower left corner of its bounding box, and the bounding box is kept as
+columns. Reading a bbox then only touches the partitions (and row groups) that can
+intersect it, and filtering on `datafangstdato` is pushed down to parquet as well - so
+labels for one city never need the whole country in memory.
+"""
+
+# %% imports
+import os
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import fiona
+import pyarrow as pa
+import pyarrow.dataset as ds
+from tqdm import tqdm
+
+target_crs = "EPSG:25833"
+store_info_file = "_store_info.json"  # "_" so parquet dataset discovery skips it
+
+
+# %% functions
+def build_label_store(
+    gdb_path: Path,
+    store_dir: Path,
+    layer: str = "fkb_bygning_omrade",
+    partition_size_m: float = 10_000,
+    chunk_size: int = 250_000,
+    overwrite: bool = False,
+) -> None:
+    """
+    Converts a layer of the FKB-Bygning FileGDB into the partitioned label store.
+    The GDB is read in chunks, so the conversion does not need the layer in memory.
+
+    Arguments:
+    - gdb_path: path to the FileGDB
+    - store_dir: folder for the store (created)
+    - layer: layer of the FileGDB to convert
+    - partition_size_m: edge length of the partitions in meters
+    - chunk_size: number of features read from the GDB at once
+    - overwrite: remove an existing store first
+
+    Returns:
+    - None
+    """
+    store_dir = Path(store_dir)
+    if store_dir.exists():
+        if not overwrite:
+            raise FileExistsError(f"Label store {store_dir} exists already")
+        shutil.rmtree(store_dir)
+    os.makedirs(store_dir)
+
+    with fiona.open(gdb_path, layer=layer) as src:
+        n_features = len(src)
+    max_extent = 0.0
+    for chunk_index, start in enumerate(
+        tqdm(range(0, n_features, chunk_size), desc="Converting FKB")
+    ):
+        gdf = gpd.read_file(
+            gdb_path, layer=layer, rows=slice(start, start + chunk_size)
+        )
+        gdf = gdf[gdf.geometry.notnull()]
+        if gdf.crs != target_crs:
+            gdf = gdf.to_crs(target_crs)
+        bounds = gdf.geometry.bounds
+        gdf["minx"], gdf["miny"] = bounds["minx"], bounds["miny"]
+        gdf["maxx"], gdf["maxy"] = bounds["maxx"], bounds["maxy"]
+        gdf["partition_x"] = np.floor(gdf["minx"] / partition_size_m).astype(np.int32)
+        gdf["partition_y"] = np.floor(gdf["miny"] / partition_size_m).astype(np.int32)
+        max_extent = max(
+            max_extent,
+            float((gdf["maxx"] - gdf["minx"]).max()),
+            float((gdf["maxy"] - gdf["miny"]).max()),
+        )
+        for (partition_x, partition_y), partition in gdf.groupby(
+            ["partition_x", "partition_y"]
+        ):
+            partition_dir = (
+                store_dir / f"partition_x={partition_x}" / f"partition_y={partition_y}"
+            )
+            os.makedirs(partition_dir, exist_ok=True)
+            # sorted rows give row groups with tight bbox statistics to skip on
+            partition = partition.sort_values(["miny", "minx"])
+            partition.drop(columns=["partition_x", "partition_y"]).to_parquet(
+                partition_dir / f"part_{chunk_index:05d}.parquet",
+                index=False,
+                row_group_size=10_000,
+            )
+
+    with open(store_dir / store_info_file, "w") as f:
+        json.dump(
+            {
+                "layer": layer,
+                "crs": target_crs,
+                "partition_size_m": partition_size_m,
+                "max_feature_extent_m": max_extent,
+                "n_features": n_features,
+            },
+            f,
+        )
+    return
+
+
+def _cutoff_value(store_dir: Path, cutoff_date) -> object:
+    """
+    The cutoff date in the type of the stored datafangstdato column, so the parquet
+    filter compares like with like (pyarrow raises on tz-aware vs tz-naive).
+    Tz-aware dates are converted to UTC before dropping the timezone.
+    """
+    cutoff = pd.Timestamp(cutoff_date)
+    schema = ds.dataset(store_dir, format="parquet", partitioning="hive").schema
+    column_type = schema.field("datafangstdato").type
+    if pa.types.is_timestamp(column_type):
+        if column_type.tz is None:
+            if cutoff.tzinfo is not None:
+                cutoff = cutoff.tz_convert("UTC").tz_localize(None)
+        elif cutoff.tzinfo is None:
+            cutoff = cutoff.tz_localize("UTC").tz_convert(column_type.tz)
+        else:
+            cutoff = cutoff.tz_convert(column_type.tz)
+        return cutoff
+    if pa.types.is_date(column_type):
+        return cutoff.date()
+    # dates stored as ISO strings sort like the dates
+    if cutoff.tzinfo is not None:
+        cutoff = cutoff.tz_convert("UTC").tz_localize(None)
+    return cutoff.isoformat()
+
+
+def read_labels(
+    store_dir: Path,
+    bbox: list,
+    cutoff_date: pd.Timestamp = None,
+    columns: list = None,
+) -> gpd.GeoDataFrame:
+    """
+    Reads the features intersecting a bbox (by bounding box) from the label store.
+
+    Arguments:
+    - store_dir: folder of the store made with `build_label_store`
+    - bbox: [left, bottom, right, top] in EPSG:25833
+    - cutoff_date: only keep features with datafangstdato <= cutoff_date (optional,
+        tz-aware or naive, matched to the type of the stored column)
+    - columns: columns to read (geometry is always read)
+
+    Returns:
+    - GeoDataFrame in EPSG:25833 with the features in the bbox
+    """
+    store_dir = Path(store_dir)
+    with open(store_dir / store_info_file, "r") as f:
+        store_info = json.load(f)
+    partition_size_m = store_info["partition_size_m"]
+    left, bottom, right, top = bbox
+
+    # a feature lives in the partition of its lower left corner, so features from
+    # partitions left/below the bbox can still reach into it
+    reach = store_info["max_feature_extent_m"]
+    filters = [
+        ("partition_x", ">=", int(np.floor((left - reach) / partition_size_m))),
+        ("partition_x", "<=", int(np.floor(right / partition_size_m))),
+        ("partition_y", ">=", int(np.floor((bottom - reach) / partition_size_m))),
+        ("partition_y", "<=", int(np.floor(top / partition_size_m))),
+        ("minx", "<=", right),
+        ("maxx", ">=", left),
+        ("miny", "<=", top),
+        ("maxy", ">=", bottom),
+    ]
+    if cutoff_date is not None:
+        filters.append(
+            ("datafangstdato", "<=", _cutoff_value(store_dir, cutoff_date))
+        )
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + ["geometry"]))
+
+    gdf = gpd.read_parquet(store_dir, columns=columns, filters=filters)
+    if gdf.crs is None:
+        gdf = gdf.set_crs(target_crs)
+    return gdf.drop(
+        columns=["partition_x", "partition_y"], errors="ignore"
+    ).reset_index(drop=True)
+
+
+def get_label_store(
+    data_path: Path,
+    gdb_name: str = "Basisdata_0000_Norge_5973_FKB-Bygning_FGDB.gdb",
+    layer: str = "fkb_bygning_omrade",
+) -> Path:
+    """
+    Path to the label store for a FKB-Bygning GDB in data/raw/FKB_bygning, the store
+    is built on first use.
+    """
+    fkb_dir = Path(data_path) / "raw/FKB_bygning"
+    store_dir = fkb_dir / f"{Path(gdb_name).stem}_{layer}_store"
+    if not (store_dir / store_info_file).exists():
+        print(f"Building label store at {store_dir} (only needed once)")
+        build_label_store(fkb_dir / gdb_name, store_dir, layer=layer, overwrite=True)
+    return store_dir
@@ -1,14 +1,35 @@
-from requests.auth import _basic_auth_str
-from requests.auth import _basic_auth_str
+import base64
+import os
+from pathlib import Path
+
 import suds
+import suds.transport.https
+from suds.cache import ObjectCache
 from suds.client import Client
-import base64
 
-# clients for everything else:
-def prepare_clients(username:str, password:str)->tuple[Client]:
+matrikkel_url = "https://matrikkel.no"
+# parsed WSDLs are kept on disk, so starting a client does not download them again
+default_wsdl_cache_dir = Path.home() / ".cache" / "matrikkel_wsdl"
+
+
+def make_client(service: str, username: str, password: str,
+                base_url: str = matrikkel_url,
+                cache_dir: Path = default_wsdl_cache_dir,
+                cache_days: int = 30) -> Client:
+    """
+    Authenticated suds client for one matrikkel service (e.g. "BygningService"),
+    with the parsed WSDL cached on disk.
+
+    Arguments:
+    - service: name of the service in the matrikkel documentation
+    - username, password: matrikkel credentials
+    - base_url: matrikkel.no, or the url of a local stub for testing
+    - cache_dir: folder for the WSDL cache
+    - cache_days: days a cached WSDL is used before it is fetched again
+    """
     base64string = base64.b64encode(("{0}:{1}".format(username, password).encode('utf-8'))).decode()
     authentication_header = {
-                "WWW-Authenticate": "https://matrikkel.no",
+                "WWW-Authenticate": base_url,
                 "Authorization": "Basic %s" % base64string
             }
     #you need your own transport line for each client
@@ -16,37 +37,23 @@ def prepare_clients(username:str, password:str)->tuple[Client]:
                 username=username,
                 password=password
             )
-    transport2 = suds.transport.https.HttpAuthenticated(
-                username=username,
-                password=password
-            )
-    transportKode = suds.transport.https.HttpAuthenticated(
-                username=username,
-                password=password
-            )
-    transportKommune = suds.transport.https.HttpAuthenticated(
-                username=username,
-                password=password
-            )
-    transportMatrikkelUnit = suds.transport.https.HttpAuthenticated(
-                username=username,
-                password=password
-            )
+    os.makedirs(cache_dir, exist_ok=True)
+    client = Client(f"{base_url}/matrikkelapi/wsapi/v1/{service}WS?WSDL",
+                    transport=transport,
+                    cache=ObjectCache(location=str(cache_dir), days=cache_days))
+    client.set_options(headers=authentication_header)
+    return client
 
-    #one client per webpage on matrikkel documentation
-    client_buildings = Client("https://matrikkel.no/matrikkelapi/wsapi/v1/BygningServiceWS?WSDL", transport=transport)
-    client_buildings.set_options(headers=authentication_header)
-
-    client_objects = Client("https://matrikkel.no/matrikkelapi/wsapi/v1/StoreServiceWS?WSDL", transport=transport2)
-    client_objects.set_options(headers=authentication_header)
-
-    clientKodelister = Client("http://matrikkel.no/matrikkelapi/wsapi/v1/KodelisteServiceWS?WSDL", transport=transportKode)
-    clientKodelister.set_options(headers=authentication_header)
 
-    clientKommune = Client("https://matrikkel.no/matrikkelapi/wsapi/v1/KommuneServiceWS?WSDL", transport=transportKommune)
-    clientKommune.set_options(headers=authentication_header)
-
-    client_matrikkel_unit = Client("http://matrikkel.no/matrikkelapi/wsapi/v1/MatrikkelenhetServiceWS?WSDL", transport = transportMatrikkelUnit)
-    client_matrikkel_unit.set_options(headers=authentication_header)
+# clients for everything else:
+def prepare_clients(username: str, password: str,
+                    base_url: str = matrikkel_url,
+                    cache_dir: Path = default_wsdl_cache_dir) -> tuple[Client]:
+    #one client per webpage on matrikkel documentation
+    client_buildings = make_client("BygningService", username, password, base_url, cache_dir)
+    client_objects = make_client("StoreService", username, password, base_url, cache_dir)
+    clientKodelister = make_client("KodelisteService", username, password, base_url, cache_dir)
+    clientKommune = make_client("KommuneService", username, password, base_url, cache_dir)
+    client_matrikkel_unit = make_client("MatrikkelenhetService", username, password, base_url, cache_dir)
 
     return [client_buildings, client_objects, clientKodelister, clientKommune, client_matrikkel_unit]
@@ -1,51 +1,24 @@
 # %% Imports
-from PIL import Image, ImageEnhance, ImageStat
 from HOME.ML_training.preprocessing.step_06_mean_std_calculation import (
-    calculate_mean_std,
+    contrast_brightness_factors,
 )
+from HOME.ML_training.preprocessing.radiometric_matching import (
+    get_reference_histograms,
+    transform_directory,
+)
+from HOME.get_data_path import get_data_path
 from pathlib import Path
 import os
-from tqdm import tqdm
 
 # %%
 year_old = "1992"
 
 # %%
-
-
-def calculate_contrast_brightness(image):
-    # Convert the image to grayscale
-    grayscale = image.convert("L")
-
-    # Calculate the standard deviation of the pixel intensities
-    stat = ImageStat.Stat(grayscale)
-    return stat.stddev[0], stat.mean[0]
-
-
-def transform_image(image, contrast_factor, brightness_factor):
-    # Convert the image to grayscale
-    image = image.convert("L")
-
-    # Adjust the contrast
-    enhancer = ImageEnhance.Contrast(image)
-    image = enhancer.enhance(contrast_factor)
-
-    # Adjust the brightness
-    enhancer = ImageEnhance.Brightness(image)
-    image = enhancer.enhance(brightness_factor)
-
-    # Convert back to RGB
-    image = image.convert("RGB")
-
-    # Save the transformed image
-    return image
-
-
-# %%
-root_dir = Path(__file__).parents[2]
-path_old_data = root_dir / "data/model/topredict/train/image"
-path_txt_file = root_dir / "data/model/topredict/dataset/old.txt"
-input_dir = root_dir / "data/model/original/train/image"
+root_dir = Path(__file__).parents[3]
+data_path = get_data_path(root_dir)
+path_old_data = data_path / "model/topredict/train/image"
+path_txt_file = data_path / "model/topredict/dataset/old.txt"
+input_dir = data_path / "ML_training/train/image"
 
 
 # create txt file with all files in folder with 1937 in name
@@ -54,48 +27,42 @@ with open(path_txt_file, "w") as f:
         if year_old in file:
             f.write(file.replace(".tif", "") + "\n")
 
-# %%
-mean_old, std_old = calculate_mean_std(path_old_data, path_txt_file)
-mean_old, std_old = int(mean_old[0] * 255), int(std_old[0] * 255)
+# %% grayscale histograms (per source image) of the old and the training images,
+# cached so retuning the factors does not read the images again
+_, _, gray_hists_old = get_reference_histograms(path_old_data, path_txt_file)
 
-# %%
-input_dir_BW = root_dir / "data/model/original/train_BW/image"
-path_txt_train = root_dir / "data/model/original/dataset/train.txt"
-mean_train, std_train = calculate_mean_std(input_dir_BW, path_txt_train)
-mean_train, std_train = int(mean_train[0] * 255), int(std_train[0] * 255)
+# the same folder and split as `step_06_mean_std_calculation.py --BW`, so the
+# histograms it put into the cache are reused
+input_dir_BW = data_path / "ML_training/train_BW/image"
+path_txt_train = data_path / "ML_training/dataset/train.txt"
+_, _, gray_hists_train = get_reference_histograms(input_dir_BW, path_txt_train)
 
-contrast_factor = std_old / std_train
-brightness_factor = mean_old / mean_train
+contrast_factor, brightness_factor = contrast_brightness_factors(
+    gray_hists_train, gray_hists_old
+)
 
 # %% Make training images worse
-output_dir = root_dir / "data/model/original/train_poor/image"
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
-for filename in tqdm(os.listdir(input_dir)):
-    if filename.endswith((".tif")):
-        input_path = os.path.join(input_dir, filename)
-        output_path = os.path.join(output_dir, filename)
-        image = Image.open(input_path).convert("RGB")
-        image_poor = transform_image(image, contrast_factor, brightness_factor)
-        image_poor.save(output_path)
+output_dir = data_path / "ML_training/train_poor/image"
+transform_directory(
+    input_dir,
+    output_dir,
+    "pil",
+    {"contrast_factor": contrast_factor, "brightness_factor": brightness_factor},
+)
 # %% Make old images "better"
 
-contrast_factor = std_train / std_old
-brightness_factor = mean_train / mean_old
+contrast_factor, brightness_factor = contrast_brightness_factors(
+    gray_hists_old, gray_hists_train
+)
 
 input_dir = path_old_data
-output_dir = root_dir / "data/model/topredict/train_augmented/image"
-
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
-for filename in tqdm(os.listdir(input_dir)):
-    if filename.endswith((".tif")) and year_old in filename:
-        input_path = os.path.join(input_dir, filename)
-        output_path = os.path.join(output_dir, filename)
-        image_poor = Image.open(input_path).convert("RGB")
-        image = transform_image(image_poor, contrast_factor, brightness_factor)
-        image.save(output_path)
+output_dir = data_path / "model/topredict/train_augmented/image"
+transform_directory(
+    input_dir,
+    output_dir,
+    "pil",
+    {"contrast_factor": contrast_factor, "brightness_factor": brightness_factor},
+    name_filter=year_old,
+)
 
 # %%
@@ -0,0 +1,301 @@
+"""
+Radiometric normalization of whole folders of tiles, used to make training images look
+like old (black and white) orthophotos and the other way around.
+
+Every transform is a lookup table on the uint8 grayscale image, applied in NumPy:
+- "pil": the contrast/brightness enhancement `match_bad_quality.py` used to do with
+    PIL (convert("L"), ImageEnhance.Contrast, ImageEnhance.Brightness,
+    convert("RGB")), with the same rounding as PIL so the output is identical
+- "gain_offset": value * gain + offset
+- "histogram": matches the histogram of every image to a reference histogram
+
+The folders are processed in a process pool. Reference histograms (see
+`step_06_mean_std_calculation.compute_histograms`) are cached on disk, keyed by the
+folder and the names, sizes and modification times of its images, so retuning the
+factors does not read the reference images again.
+"""
+
+# %%
+import os
+import hashlib
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import cv2
+from tqdm import tqdm
+
+from HOME.ML_training.preprocessing.step_06_mean_std_calculation import (
+    compute_histograms,
+    save_histograms,
+    load_histograms,
+    contrast_brightness_factors,
+)
+from HOME.get_data_path import get_data_path
+
+# Get the root directory of the project
+root_dir = Path(__file__).resolve().parents[3]
+# print(root_dir)
+# get the data path (might change)
+data_path = get_data_path(root_dir)
+
+values = np.arange(256, dtype=np.float32)
+
+
+# %%
+def to_gray(image: np.ndarray) -> np.ndarray:
+    """
+    Grayscale version of a BGR image (as read by cv2), same as PIL's convert("L").
+    """
+    if image.ndim == 2:
+        return image
+    blue, green, red = (image[..., c].astype(np.uint32) for c in range(3))
+    return ((red * 19595 + green * 38470 + blue * 7471 + 0x8000) >> 16).astype(
+        np.uint8
+    )
+
+
+def _blend_lut(lut: np.ndarray, degenerate: np.ndarray, factor: float) -> np.ndarray:
+    """
+    PIL's Image.blend(degenerate, image, factor) as an operation on a lookup table:
+    computed in float32, truncated and clipped to uint8.
+    """
+    factor = np.float32(factor)
+    out = degenerate + factor * (lut.astype(np.float32) - degenerate)
+    return np.clip(np.trunc(out), 0, 255).astype(np.uint8)
+
+
+def pil_lut(
+    gray_hist: np.ndarray, contrast_factor: float, brightness_factor: float
+) -> np.ndarray:
+    """
+    Lookup table for ImageEnhance.Contrast followed by ImageEnhance.Brightness on a
+    grayscale image. Contrast blends with the (rounded) mean of the image, so the table
+    depends on the histogram of the image.
+
+    Arguments:
+    - gray_hist: (256,) histogram of the grayscale image
+    - contrast_factor: factor for ImageEnhance.Contrast
+    - brightness_factor: factor for ImageEnhance.Brightness
+
+    Returns:
+    - (256,) uint8 lookup table
+    """
+    mean = int((gray_hist * values).sum() / max(gray_hist.sum(), 1) + 0.5)
+    lut = _blend_lut(np.arange(256), np.float32(mean), contrast_factor)
+    return _blend_lut(lut, np.float32(0), brightness_factor)
+
+
+def gain_offset_lut(gain: float, offset: float = 0.0) -> np.ndarray:
+    """
+    Lookup table for value * gain + offset, rounded and clipped to uint8.
+    """
+    return np.clip(np.rint(values * gain + offset), 0, 255).astype(np.uint8)
+
+
+def histogram_matching_lut(
+    gray_hist: np.ndarray, reference_hist: np.ndarray
+) -> np.ndarray:
+    """
+    Lookup table that maps the values of an image to the values of the reference with
+    the same quantile.
+
+    Arguments:
+    - gray_hist: (256,) histogram of the image
+    - reference_hist: (256,) histogram of the reference (may be summed over images)
+
+    Returns:
+    - (256,) uint8 lookup table
+    """
+    cdf = np.cumsum(gray_hist) / max(gray_hist.sum(), 1)
+    reference_cdf = np.cumsum(reference_hist) / max(reference_hist.sum(), 1)
+    lut = np.searchsorted(reference_cdf, cdf, side="left")
+    return np.clip(lut, 0, 255).astype(np.uint8)
+
+
+def transform_image(image: np.ndarray, method: str, params: dict) -> np.ndarray:
+    """
+    Applies a radiometric transform to a BGR image, the result is a grayscale image
+    with three identical channels.
+
+    Arguments:
+    - image: BGR (or grayscale) uint8 image
+    - method: "pil", "gain_offset" or "histogram"
+    - params: parameters of the method - contrast_factor and brightness_factor (pil),
+        gain and offset (gain_offset), reference_hist (histogram)
+
+    Returns:
+    - transformed image (H, W, 3)
+    """
+    gray = to_gray(image)
+    if method == "pil":
+        lut = pil_lut(
+            np.bincount(gray.ravel(), minlength=256),
+            params["contrast_factor"],
+            params["brightness_factor"],
+        )
+    elif method == "gain_offset":
+        lut = gain_offset_lut(params["gain"], params.get("offset", 0.0))
+    elif method == "histogram":
+        lut = histogram_matching_lut(
+            np.bincount(gray.ravel(), minlength=256), params["reference_hist"]
+        )
+    else:
+        raise ValueError(f"Unknown method {method}")
+    return cv2.cvtColor(lut[gray], cv2.COLOR_GRAY2BGR)
+
+
+def _transform_files(
+    input_dir: Path, output_dir: Path, filenames: list[str], method: str, params: dict
+) -> int:
+    """
+    Transforms a chunk of files (run in a worker process).
+    """
+    for filename in filenames:
+        image = cv2.imread(str(input_dir / filename), cv2.IMREAD_COLOR)
+        cv2.imwrite(str(output_dir / filename), transform_image(image, method, params))
+    return len(filenames)
+
+
+def transform_directory(
+    input_dir: Path,
+    output_dir: Path,
+    method: str,
+    params: dict,
+    name_filter: str = None,
+    n_workers: int = None,
+    chunk_size: int = 64,
+) -> None:
+    """
+    Transforms all .tif images in a folder and writes them with the same name to
+    output_dir.
+
+    Arguments:
+    - input_dir: folder with the images
+    - output_dir: folder for the transformed images (created)
+    - method, params: see `transform_image`
+    - name_filter: only transform images with this string in the name (optional)
+    - n_workers: number of worker processes (default: all cores)
+    - chunk_size: number of images handed to a worker at once
+    """
+    input_dir, output_dir = Path(input_dir), Path(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    filenames = sorted(
+        f
+        for f in os.listdir(input_dir)
+        if f.endswith(".tif") and (name_filter is None or name_filter in f)
+    )
+    chunks = [
+        filenames[i : i + chunk_size] for i in range(0, len(filenames), chunk_size)
+    ]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(
+                _transform_files, input_dir, output_dir, chunk, method, params
+            )
+            for chunk in chunks
+        ]
+        with tqdm(total=len(filenames), desc=f"Transforming {input_dir.name}") as pbar:
+            for future in futures:
+                pbar.update(future.result())
+    return
+
+
+def get_reference_histograms(
+    img_dir: Path,
+    txt_path: Path = None,
+    name_filter: str = None,
+    cache_dir: Path = None,
+    n_workers: int = None,
+) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """
+    Histograms of a set of reference images (see `compute_histograms`), cached on disk.
+    The cache is invalidated when an image is added, removed or changed.
+
+    Arguments:
+    - img_dir: folder with the images
+    - txt_path: optional split file with the image names (without .tif)
+    - name_filter: only use images with this string in the name (optional)
+    - cache_dir: folder of the cache, defaults to ML_training/histogram_cache
+    - n_workers: number of worker processes (default: all cores)
+
+    Returns:
+    - names of the groups, (G, 3, 256) RGB and (G, 256) grayscale histograms
+    """
+    img_dir = Path(img_dir)
+    if cache_dir is None:
+        cache_dir = data_path / "ML_training/histogram_cache"
+    if txt_path is not None:
+        with open(txt_path, "r") as file:
+            img_names = [name + ".tif" for name in file.read().splitlines()]
+    else:
+        img_names = sorted(f for f in os.listdir(img_dir) if f.endswith(".tif"))
+    if name_filter is not None:
+        img_names = [name for name in img_names if name_filter in name]
+
+    key = hashlib.sha1(str(img_dir.resolve()).encode())
+    for name in img_names:
+        stat = os.stat(img_dir / name)
+        key.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    cache_file = Path(cache_dir) / f"{img_dir.parent.name}_{key.hexdigest()}.npz"
+    if cache_file.exists():
+        return load_histograms(cache_file)
+
+    groups, rgb_hists, gray_hists = compute_histograms(
+        img_dir, img_names=img_names, n_workers=n_workers
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    save_histograms(cache_file, groups, rgb_hists, gray_hists)
+    return groups, rgb_hists, gray_hists
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Match the radiometry of a folder of tiles to a reference"
+    )
+    parser.add_argument("--input_dir", required=True, type=str)
+    parser.add_argument("--output_dir", required=True, type=str)
+    parser.add_argument(
+        "--method", default="pil", choices=["pil", "gain_offset", "histogram"]
+    )
+    parser.add_argument("--reference_dir", required=False, type=str, default=None)
+    parser.add_argument("--reference_filter", required=False, type=str, default=None)
+    parser.add_argument("--name_filter", required=False, type=str, default=None)
+    parser.add_argument("--contrast", required=False, type=float, default=None)
+    parser.add_argument("--brightness", required=False, type=float, default=None)
+    parser.add_argument("--gain", required=False, type=float, default=1.0)
+    parser.add_argument("--offset", required=False, type=float, default=0.0)
+    parser.add_argument("--n_workers", required=False, type=int, default=None)
+    args = parser.parse_args()
+
+    params = {"gain": args.gain, "offset": args.offset}
+    if args.reference_dir is not None:
+        _, _, gray_hists_reference = get_reference_histograms(
+            args.reference_dir, name_filter=args.reference_filter
+        )
+        params["reference_hist"] = gray_hists_reference.sum(axis=0)
+        if args.method == "pil" and (args.contrast is None or args.brightness is None):
+            _, _, gray_hists_input = get_reference_histograms(
+                args.input_dir, name_filter=args.name_filter
+            )
+            contrast, brightness = contrast_brightness_factors(
+                gray_hists_input, gray_hists_reference
+            )
+            print(f"Contrast factor: {contrast:.4f}, brightness: {brightness:.4f}")
+            params["contrast_factor"] = contrast
+            params["brightness_factor"] = brightness
+    if args.contrast is not None:
+        params["contrast_factor"] = args.contrast
+    if args.brightness is not None:
+        params["brightness_factor"] = args.brightness
+
+    transform_directory(
+        args.input_dir,
+        args.output_dir,
+        args.method,
+        params,
+        name_filter=args.name_filter,
+        n_workers=args.n_workers,
+    )
@@ -1,20 +1,25 @@
 # %%
 from pathlib import Path
-import geopandas as gpd
 import json
 from HOME.ML_training.preprocessing.get_label_data.get_labels import (
     get_labels,
     save_labels,
 )  # noqa
+from HOME.ML_training.preprocessing.get_label_data.label_store import (
+    get_label_store,
+    read_labels,
+)  # noqa
+from HOME.utils.bbox_to_meters import convert_bbox_to_meters  # noqa
+from HOME.get_data_path import get_data_path  # noqa
 from HOME.ML_training.preprocessing.get_label_data.cut_images import (
-    cut_geotiff,
-    save_cut_geotiff,
+    cut_geotiffs,
 )  # noqa
 import os
 import argparse
 
 # %%
 root_dir = Path(__file__).parents[3]
+data_path = get_data_path(root_dir)
 current_dir = Path(__file__).parents[0]
 
 # Read bbox from bbox.json
@@ -23,15 +28,20 @@ with open(current_dir / "bbox.json", "r") as f:
 
 # get the labels
 cities = bbox.keys()
-path_label = (
-    root_dir / "data/raw/FKB_bygning" / "Basisdata_0000_Norge_5973_FKB-Bygning_FGDB.gdb"
-)
-gdf_omrade = gpd.read_file(path_label, driver="FileGDB", layer="fkb_bygning_omrade")
 
 # %%
 
 
-def make_training_data(city, res):
+def make_training_data(city, res, n_workers=4, label_store=None):
+    """
+    Cuts the labels and images of the training bboxes of a city at a resolution.
+    The label_store (see `get_label_store`) is looked up if not given.
+    """
+    if label_store is None:
+        # spatially partitioned copy of fkb_bygning_omrade, only the bboxes are read
+        label_store = get_label_store(data_path)
+    # the image cuts of all bboxes are made at once, per orthophoto mosaic
+    cuts = {}
     for i in range(len(bbox[city])):
         print(f"Processing {city} {i}")
         # Get the bounding box coordinates
@@ -55,29 +65,42 @@ def make_training_data(city, res):
                 if not os.path.exists(
                     root_dir / f"data/temp/pretrain/images/{filename}.tif"
                 ):
+                    gdf_omrade = read_labels(
+                        label_store,
+                        convert_bbox_to_meters(bbox_coordinates),
+                        columns=["geometry"],
+                    )
                     data, transform = get_labels(gdf_omrade, bbox_coordinates, res)
                     if data.size != 0:
                         save_labels(data, filename, transform)
 
                     geotiff_path = subfolders[0] / "i_lzw_25" / "Eksport-nib.tif"
-                    image, transform = cut_geotiff(geotiff_path, bbox_coordinates, res)
-                    if image.size != 0:
-                        save_cut_geotiff(image, filename, transform)
+                    cuts.setdefault(geotiff_path, []).append(
+                        (bbox_coordinates, filename)
+                    )
+
+    for geotiff_path, geotiff_cuts in cuts.items():
+        print(f"Cutting {len(geotiff_cuts)} images from {geotiff_path}")
+        bboxes, filenames = zip(*geotiff_cuts)
+        cut_geotiffs(geotiff_path, bboxes, filenames, res, n_workers=n_workers)
 
     return None
 
 
 # %% Make training data for each city
-
-parser = argparse.ArgumentParser(description="Tile generation")
-parser.add_argument(
-    "--res", default=0.2, type=float, help="resolution of the tiles in meters"
-)
-args = parser.parse_args()
-res = args.res
-
-for city in cities:
-    make_training_data(city, res)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tile generation")
+    parser.add_argument(
+        "--res", default=0.2, type=float, help="resolution of the tiles in meters"
+    )
+    parser.add_argument("--n_workers", default=4, type=int)
+    args = parser.parse_args()
+    res = args.res
+
+    # built on first use, only once for all cities
+    label_store = get_label_store(data_path)
+    for city in cities:
+        make_training_data(city, res, args.n_workers, label_store=label_store)
 
 
 # %%
@@ -1,26 +1,154 @@
+"""
+Cuts the downloaded orthophotos and their labels into training tiles.
+
+Every label is read once: the positive pixels of all tiles are counted at once with an
+integral image (padding counts as negative, like the padded arrays before). Only the
+windows of the tiles we keep are read from the orthophoto (with rasterio, padded with
+zeros outside the image), so the full image is never loaded. The orthophotos are
+processed in parallel, with a random generator per orthophoto, and the positive ratio
+of every written tile is saved in `tile_index.csv` next to the tiles.
+"""
+
 # %%
 import os
+import zlib
 import numpy as np
+import pandas as pd
 from tqdm import tqdm
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import shutil
-import random
 import argparse
+import rasterio
+from rasterio.windows import Window
 
 # Increase the maximum number of pixels OpenCV can handle
 os.environ["OPENCV_IO_MAX_IMAGE_PIXELS"] = str(pow(2, 40))
 import cv2  # noqa
 
+from HOME.utils.raster_io import write_raster  # noqa
+
 root_dir = str(Path(__file__).parents[3])
 
+
 # %%
+def tile_offsets(length, tile_size, effective_tile_size):
+    """
+    Start of the tiles along one axis (the last tile may reach into the padding).
+    """
+    num_tiles = int(np.ceil((length - tile_size) / (effective_tile_size))) + 1
+    return (np.arange(num_tiles) * effective_tile_size).astype(int)
+
+
+def tile_positive_counts(label, offsets_x, offsets_y, tile_size):
+    """
+    Number of positive label pixels in every tile (num_tiles_y, num_tiles_x), from the
+    integral image of the label.
+    """
+    integral = np.zeros((label.shape[0] + 1, label.shape[1] + 1), dtype=np.int64)
+    integral[1:, 1:] = (label > 0).cumsum(axis=0).cumsum(axis=1)
+    x0 = np.minimum(offsets_x, label.shape[1])
+    x1 = np.minimum(offsets_x + tile_size, label.shape[1])
+    y0 = np.minimum(offsets_y, label.shape[0])[:, None]
+    y1 = np.minimum(offsets_y + tile_size, label.shape[0])[:, None]
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+
+def read_window(src, x, y, tile_size):
+    """
+    Reads a tile from an opened raster as a BGR (like cv2.imread) uint8 array, zero
+    padded outside the image.
+    """
+    tile = src.read(
+        window=Window(x, y, tile_size, tile_size), boundless=True, fill_value=0
+    )
+    if tile.shape[0] >= 3:
+        tile = tile[2::-1]
+    else:
+        tile = np.repeat(tile[:1], 3, axis=0)
+    return np.ascontiguousarray(tile.transpose(1, 2, 0))
 
-parser = argparse.ArgumentParser(description="Tile generation")
-parser.add_argument(
-    "--res", default=0.2, type=float, help="resolution of the tiles in meters"
-)
-args = parser.parse_args()
-res = args.res
+
+def tile_image(
+    image_file,
+    input_dir_images,
+    input_dir_labels,
+    output_dir_images,
+    output_dir_labels,
+    tile_size=512,
+    overlap_rate=0.01,
+    imbalance_threshold=(0.005, 0.9),
+    keep_share=0.15,
+    seed=42,
+):
+    """
+    Cuts one orthophoto and its label into tiles (run in a worker process).
+
+    Arguments:
+    - image_file: file name of the orthophoto (and the label)
+    - input_dir_images, input_dir_labels: folders of the orthophoto and label
+    - output_dir_images, output_dir_labels: folders for the tiles
+    - tile_size: tile size in pixels
+    - overlap_rate: overlap of neighbouring tiles
+    - imbalance_threshold: (min, max) ratio of positive to negative pixels of a tile
+    - keep_share: share of the imbalanced tiles we keep anyway
+    - seed: seed, combined with the file name
+
+    Returns:
+    - number of tiles, number of skipped tiles, number of kept imbalanced tiles,
+      list of (tile name, ratio) of the written tiles
+    """
+    label = cv2.imread(os.path.join(input_dir_labels, image_file), cv2.IMREAD_GRAYSCALE)
+    height, width = label.shape
+    effective_tile_size = tile_size * (1 - overlap_rate)
+    offsets_x = tile_offsets(width, tile_size, effective_tile_size)
+    offsets_y = tile_offsets(height, tile_size, effective_tile_size)
+    n_tiles = len(offsets_x) * len(offsets_y)
+
+    # Skip this image if the ratio is above or below the threshold
+    num_positive_pixels = np.count_nonzero(label)
+    num_negative_pixels = label.size - num_positive_pixels
+    with np.errstate(divide="ignore"):
+        ratio = num_positive_pixels / num_negative_pixels
+    if ratio < imbalance_threshold[0] or ratio > imbalance_threshold[1]:
+        return n_tiles, n_tiles, 0, []
+
+    # ratio of positive to negative pixels of all tiles (padding is negative)
+    positive = tile_positive_counts(label, offsets_x, offsets_y, tile_size)
+    with np.errstate(divide="ignore"):
+        ratios = positive / (tile_size**2 - positive)
+    imbalanced = (ratios < imbalance_threshold[0]) | (ratios > imbalance_threshold[1])
+    rng = np.random.default_rng([zlib.crc32(image_file.encode()), seed])
+    keep = ~imbalanced | (rng.random(ratios.shape) <= keep_share)
+
+    padded_label = np.zeros(
+        (offsets_y[-1] + tile_size, offsets_x[-1] + tile_size), dtype=label.dtype
+    )
+    padded_label[:height, :width] = label
+    written = []
+    with rasterio.open(os.path.join(input_dir_images, image_file)) as src:
+        # i along x, j along y, as in the tile names
+        for j, i in zip(*np.nonzero(keep)):
+            x, y = offsets_x[i], offsets_y[j]
+            tile_filename = f"{image_file[:-4]}_{i}_{j}.tif"
+            transform = src.window_transform(Window(x, y, tile_size, tile_size))
+            write_raster(
+                os.path.join(output_dir_images, tile_filename),
+                read_window(src, x, y, tile_size),
+                transform,
+                src.crs,
+                predictor="horizontal",
+            )
+            write_raster(
+                os.path.join(output_dir_labels, tile_filename),
+                padded_label[y : y + tile_size, x : x + tile_size],
+                transform,
+                src.crs,
+            )
+            written.append((tile_filename, float(ratios[j, i])))
+    n_skipped = int((~keep).sum())
+    n_kept_imbalanced = int((keep & imbalanced).sum())
+    return n_tiles, n_skipped, n_kept_imbalanced, written
 
 
 def partition_and_crop_images(
@@ -30,9 +158,9 @@ def partition_and_crop_images(
     output_dir_labels,
     tile_size=512,
     overlap_rate=0.01,
-    image_size=None,
     imbalance_threshold=(0.005, 0.9),
     res=0.2,
+    n_workers=None,
 ):
     # Create output directories if they don't exist
     os.makedirs(output_dir_images, exist_ok=True)
@@ -48,133 +176,83 @@ def partition_and_crop_images(
     image_files = [f for f in os.listdir(input_dir_images) if f.endswith(".tif")]
 
     # Filter to keep only images of the good resolution
-    image_files = [f for f in image_files if str(res) in f]
-
-    effective_tile_size = tile_size * (1 - overlap_rate)
-
-    # Calculate the image size if not given
-    total_iterations = 0
-    if image_size is None:
-        for file in image_files:
-            label_path = os.path.join(input_dir_labels, file)
-            label = cv2.imread(label_path, cv2.IMREAD_GRAYSCALE)
-            height, width = label.shape
-
-            num_tiles_x = int(np.ceil((width - tile_size) / (effective_tile_size))) + 1
-            num_tiles_y = int(np.ceil((height - tile_size) / (effective_tile_size))) + 1
-            total_iterations += num_tiles_x * num_tiles_y
-    else:
-        height, width = image_size, image_size
+    image_files = sorted(f for f in image_files if str(res) in f)
 
     skipped = 0
     empty_tiles = 0
-    random.seed(42)
-
-    with tqdm(total=total_iterations, desc="Processing") as pbar:
-        for image_file in image_files:
-            # Load the label
-            label_path = os.path.join(input_dir_labels, image_file)
-            label = cv2.imread(label_path, cv2.IMREAD_GRAYSCALE)
-            height, width = label.shape
-            num_tiles_x = int(np.ceil((width - tile_size) / (effective_tile_size))) + 1
-            num_tiles_y = int(np.ceil((height - tile_size) / (effective_tile_size))) + 1
-
-            # Calculate the ratio of positive to negative pixels
-            num_positive_pixels = np.sum(label > 0)
-            num_negative_pixels = np.sum(label == 0)
-            ratio = num_positive_pixels / num_negative_pixels
-
-            # Skip this image if the ratio is above or below the threshold
-            if ratio < imbalance_threshold[0] or ratio > imbalance_threshold[1]:
-                skipped += num_tiles_x * num_tiles_y
-                pbar.update(num_tiles_x * num_tiles_y)
-                continue
-
-            # Load the image
-            image_path = os.path.join(input_dir_images, image_file)
-            image = cv2.imread(image_path)
-
-            # Calculate the required padding
-            padding_x = (num_tiles_x - 1) * effective_tile_size + tile_size - width
-            padding_y = (num_tiles_y - 1) * effective_tile_size + tile_size - height
-
-            # Pad the image and label
-            image = np.pad(image, ((0, int(padding_y)), (0, int(padding_x)), (0, 0)))
-            label = np.pad(label, ((0, int(padding_y)), (0, int(padding_x))))
-
-            # Iterate over each tile
-            for i in range(num_tiles_x):
-                for j in range(num_tiles_y):
-                    # Calculate the tile coordinates
-                    x = int(i * effective_tile_size)
-                    y = int(j * effective_tile_size)
-
-                    # Crop the tile from the label
-                    label_tile = label[y : y + tile_size, x : x + tile_size]
-
-                    # Calculate the ratio of positive to negative pixels
-                    num_positive_pixels = np.sum(label_tile > 0)
-                    num_negative_pixels = np.sum(label_tile == 0)
-                    ratio = num_positive_pixels / num_negative_pixels
-
-                    # Skip this image if the ratio is above or below the
-                    # threshold
-                    if ratio < imbalance_threshold[0] or (
-                        ratio > imbalance_threshold[1]
-                    ):
-                        if random.random() > 0.15:
-                            skipped += 1
-                            pbar.update(1)
-                            continue
-                        else:
-                            empty_tiles += 1
-
-                    # Crop the tile from the image
-                    image_tile = image[y : y + tile_size, x : x + tile_size]
-
-                    # Save the image tile to the output directory
-                    image_tile_filename = f"{image_file[:-4]}_{i}_{j}.tif"
-                    image_tile_path = os.path.join(
-                        output_dir_images, image_tile_filename
-                    )
-                    cv2.imwrite(image_tile_path, image_tile)
-
-                    # Save the label tile to the output directory
-                    label_tile_filename = f"{image_file[:-4]}_{i}_{j}.tif"
-                    label_tile_path = os.path.join(
-                        output_dir_labels, label_tile_filename
-                    )
-                    cv2.imwrite(label_tile_path, label_tile)
-                    pbar.update(1)
-
-            # Move the processed image and label to the archive directory
-            shutil.move(
-                os.path.join(input_dir_images, image_file),
-                os.path.join(archive_dir_images, image_file),
-            )
-            shutil.move(
-                os.path.join(input_dir_labels, image_file),
-                os.path.join(archive_dir_labels, image_file),
-            )
+    tile_index = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(
+                tile_image,
+                image_file,
+                input_dir_images,
+                input_dir_labels,
+                output_dir_images,
+                output_dir_labels,
+                tile_size,
+                overlap_rate,
+                imbalance_threshold,
+            ): image_file
+            for image_file in image_files
+        }
+        with tqdm(total=len(image_files), desc="Processing") as pbar:
+            for future, image_file in futures.items():
+                _, n_skipped, n_kept_imbalanced, written = future.result()
+                skipped += n_skipped
+                empty_tiles += n_kept_imbalanced
+                tile_index.extend(written)
+
+                # Move the processed image and label to the archive directory
+                shutil.move(
+                    os.path.join(input_dir_images, image_file),
+                    os.path.join(archive_dir_images, image_file),
+                )
+                shutil.move(
+                    os.path.join(input_dir_labels, image_file),
+                    os.path.join(archive_dir_labels, image_file),
+                )
+                pbar.update(1)
+
+    # append to the index of earlier runs, the tiles of a new run replace old ones
+    index_path = os.path.join(
+        os.path.dirname(os.path.normpath(output_dir_images)), "tile_index.csv"
+    )
+    tile_index = pd.DataFrame(tile_index, columns=["tile", "ratio"])
+    if os.path.exists(index_path):
+        tile_index = pd.concat([pd.read_csv(index_path), tile_index])
+        tile_index = tile_index.drop_duplicates("tile", keep="last")
+    tile_index.to_csv(index_path, index=False)
 
     print(f"Skipped {skipped} tiles due to class imbalance")
     print(f"Kept {empty_tiles} for training on no buildings")
 
 
-input_dir_images = root_dir + "/data/temp/pretrain/images/"
-input_dir_labels = root_dir + "/data/temp/pretrain/labels"
-output_dir_images = root_dir + f"/data/ML_training/train/image/"
-output_dir_labels = root_dir + f"/data/ML_training/train/label/"
-
-print("Partitioning and cropping images with labels")
-partition_and_crop_images(
-    input_dir_images,
-    input_dir_labels,
-    output_dir_images,
-    output_dir_labels,
-    tile_size=512,
-    overlap_rate=0.01,
-    res=res,
-)
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tile generation")
+    parser.add_argument(
+        "--res", default=0.2, type=float, help="resolution of the tiles in meters"
+    )
+    parser.add_argument("--n_workers", default=None, type=int)
+    args = parser.parse_args()
+    res = args.res
+
+    input_dir_images = root_dir + "/data/temp/pretrain/images/"
+    input_dir_labels = root_dir + "/data/temp/pretrain/labels"
+    output_dir_images = root_dir + f"/data/ML_training/train/image/"
+    output_dir_labels = root_dir + f"/data/ML_training/train/label/"
+
+    print("Partitioning and cropping images with labels")
+    partition_and_crop_images(
+        input_dir_images,
+        input_dir_labels,
+        output_dir_images,
+        output_dir_labels,
+        tile_size=512,
+        overlap_rate=0.01,
+        res=res,
+        n_workers=args.n_workers,
+    )
 
 # %%
@@ -1,64 +1,309 @@
+"""
+Splits the training tiles into train, validation and test sets.
+
+Neighbouring tiles overlap (and show the same buildings), so shuffling single tiles puts
+almost the same image into train and test. Instead the tiles are grouped into spatial
+blocks of `block_size` x `block_size` tiles of the same orthophoto, using the `_i_j`
+indices in the tile names, and whole blocks are assigned to the splits. The blocks are
+stratified by their positive-pixel ratio (from `tile_index.csv` of the tiling), so all
+splits get dense and sparse areas. Optionally the train blocks next to a val/test block
+are dropped as a buffer. `kfold_splits` gives the folds for cross-validation.
+"""
+
 # %%
 import os
 from pathlib import Path
-import random
+import argparse
 import json
 
-# %%
-
-total_share = 0.5
+import numpy as np
+import pandas as pd
 
-val_share = 0.1
-test_share = 0.2
+# Increase the maximum number of pixels OpenCV can handle
+os.environ["OPENCV_IO_MAX_IMAGE_PIXELS"] = str(pow(2, 40))
+import cv2  # noqa
+from HOME.get_data_path import get_data_path  # noqa
 
 root_dir = Path(__file__).parents[3]
+data_path = get_data_path(root_dir)
 current_dir = Path(__file__).parents[0]
 
-# Read bbox from bbox.json
-with open(current_dir / "bbox.json", "r") as f:
-    bbox = json.load(f)
-cities = list(bbox.keys())
 
-data_path = root_dir / f"data/ML_training/train/image"
+# %%
+def tile_table(tiles: list[str], block_size: int = 4) -> pd.DataFrame:
+    """
+    Source orthophoto, tile indices and block of every tile ("{image}_{i}_{j}").
+
+    Arguments:
+    - tiles: tile names (without extension)
+    - block_size: edge length of the blocks in tiles
+
+    Returns:
+    - DataFrame with the columns tile, source, i, j, block_i, block_j and block
+    """
+    parts = pd.Series(tiles, dtype=str).str.rsplit("_", n=2, expand=True)
+    table = pd.DataFrame(
+        {
+            "tile": tiles,
+            "source": parts[0],
+            "i": parts[1].astype(int),
+            "j": parts[2].astype(int),
+        }
+    )
+    table["block_i"] = table["i"] // block_size
+    table["block_j"] = table["j"] // block_size
+    table["block"] = (
+        table["source"]
+        + "_"
+        + table["block_i"].astype(str)
+        + "_"
+        + table["block_j"].astype(str)
+    )
+    return table
+
+
+def load_tile_ratios(
+    tiles: list[str], index_path: Path = None, label_dir: Path = None
+) -> np.ndarray:
+    """
+    Positive-pixel ratio of the tiles, from the tile index of `step_03_tile_generation`.
+    Tiles missing in the index are read from label_dir (if given), otherwise 0.
+    """
+    ratios = pd.Series(np.nan, index=pd.Index(tiles, dtype=str))
+    if index_path is not None and Path(index_path).exists():
+        tile_index = pd.read_csv(index_path)
+        tile_index["tile"] = tile_index["tile"].str.replace(".tif", "", regex=False)
+        tile_index = tile_index.drop_duplicates("tile", keep="last").set_index("tile")
+        ratios.update(tile_index["ratio"])
+    missing = ratios.index[ratios.isna()]
+    if label_dir is not None:
+        for tile in missing:
+            label = cv2.imread(
+                str(Path(label_dir) / f"{tile}.tif"), cv2.IMREAD_GRAYSCALE
+            )
+            if label is not None:
+                positive = np.count_nonzero(label)
+                ratios[tile] = positive / max(label.size - positive, 1)
+    return ratios.fillna(0).to_numpy()
+
+
+def assign_blocks(
+    table: pd.DataFrame,
+    shares: dict,
+    n_strata: int = 5,
+    seed: int = 42,
+) -> pd.Series:
+    """
+    Assigns the blocks to splits, stratified by the mean positive ratio of the blocks.
+    Within a stratum the (shuffled) blocks go to the split that is furthest below its
+    share of tiles.
+
+    Arguments:
+    - table: tile table with a ratio column (see `tile_table`)
+    - shares: {split: share of the tiles}, the shares are normalized
+    - n_strata: number of ratio quantiles used as strata
+    - seed: seed for the shuffling
 
-train_file = open(root_dir / "data/ML_training/dataset/train.txt", "w")
-val_file = open(root_dir / "data/ML_training/dataset/val.txt", "w")
-test_file = open(root_dir / "data/ML_training/dataset/test.txt", "w")
+    Returns:
+    - split of every tile (same index as table)
+    """
+    rng = np.random.default_rng(seed)
+    names = list(shares)
+    targets = np.array([shares[name] for name in names], dtype=float)
+    targets /= targets.sum()
 
-random.seed(42)
-for city in cities[:-1]:  # exclude Fredrikstad
-    tiles = [
-        os.path.splitext(tile)[0] for tile in os.listdir(data_path) if city in tile
-    ]
+    blocks = table.groupby("block").agg(
+        n_tiles=("tile", "size"), ratio=("ratio", "mean")
+    )
+    n_strata = max(1, min(n_strata, len(blocks)))
+    blocks["stratum"] = pd.qcut(
+        blocks["ratio"].rank(method="first"), n_strata, labels=False
+    )
+    block_split = pd.Series("", index=blocks.index, dtype=object)
+    for _, stratum in blocks.groupby("stratum"):
+        order = rng.permutation(len(stratum))
+        counts = np.zeros(len(names))
+        total = stratum["n_tiles"].sum()
+        for block, n_tiles in zip(
+            stratum.index[order], stratum["n_tiles"].to_numpy()[order]
+        ):
+            deficit = targets * total - counts
+            split = int(np.argmax(deficit))
+            counts[split] += n_tiles
+            block_split[block] = names[split]
+    return table["block"].map(block_split)
 
-    # Shuffle the tiles
-    random.shuffle(tiles)
 
-    tiles = tiles[: int(len(tiles) * total_share)]
+def buffer_mask(table: pd.DataFrame, split: pd.Series, buffer: int = 1) -> np.ndarray:
+    """
+    Tiles of the train split in blocks within `buffer` blocks of a val/test block of the
+    same orthophoto (to drop them from the training set).
+    """
+    held_out = table.loc[split != "train", ["source", "block_i", "block_j"]]
+    held_out = held_out.drop_duplicates()
+    near = set()
+    for di in range(-buffer, buffer + 1):
+        for dj in range(-buffer, buffer + 1):
+            near.update(
+                zip(
+                    held_out["source"],
+                    held_out["block_i"] + di,
+                    held_out["block_j"] + dj,
+                )
+            )
+    keys = zip(table["source"], table["block_i"], table["block_j"])
+    in_buffer = np.fromiter((key in near for key in keys), dtype=bool, count=len(table))
+    return in_buffer & (split == "train").to_numpy()
 
-    # Calculate the indices for splitting
-    val_index = int(len(tiles) * val_share)
-    test_index = val_index + int(len(tiles) * test_share)
 
-    # Split the tiles into validation, testing and training sets
-    val_tiles = tiles[:val_index]
-    test_tiles = tiles[val_index:test_index]
-    train_tiles = tiles[test_index:]
+def split_tiles(
+    tiles: list[str],
+    ratios: np.ndarray,
+    shares: dict = None,
+    block_size: int = 4,
+    n_strata: int = 5,
+    buffer: int = 0,
+    seed: int = 42,
+) -> dict:
+    """
+    Spatially blocked, stratified split of the tiles.
+
+    Arguments:
+    - tiles: tile names (without extension)
+    - ratios: positive-pixel ratio of the tiles
+    - shares: {split: share}, defaults to 70 % train, 10 % val, 20 % test
+    - block_size: edge length of the blocks in tiles
+    - n_strata: number of ratio quantiles used as strata
+    - buffer: drop train tiles within this many blocks of a val/test block
+    - seed: seed for the shuffling
+
+    Returns:
+    - {split: list of tile names}
+    """
+    if shares is None:
+        shares = {"train": 0.7, "val": 0.1, "test": 0.2}
+    table = tile_table(tiles, block_size)
+    table["ratio"] = ratios
+    split = assign_blocks(table, shares, n_strata, seed)
+    if buffer > 0:
+        split[buffer_mask(table, split, buffer)] = ""
+    return {name: table.loc[split == name, "tile"].to_list() for name in shares}
+
+
+def kfold_splits(
+    tiles: list[str],
+    ratios: np.ndarray,
+    k: int = 5,
+    block_size: int = 4,
+    n_strata: int = 5,
+    buffer: int = 0,
+    seed: int = 42,
+) -> list[dict]:
+    """
+    Blocked, stratified k-fold cross-validation: every fold is the validation set once.
+
+    Returns:
+    - list of k {"train": [...], "val": [...]}
+    """
+    table = tile_table(tiles, block_size)
+    table["ratio"] = ratios
+    fold = assign_blocks(table, {f: 1 for f in range(k)}, n_strata, seed)
+    folds = []
+    for f in range(k):
+        split = pd.Series(np.where(fold == f, "val", "train"), index=table.index)
+        if buffer > 0:
+            split[buffer_mask(table, split, buffer)] = ""
+        folds.append(
+            {
+                "train": table.loc[split == "train", "tile"].to_list(),
+                "val": table.loc[split == "val", "tile"].to_list(),
+            }
+        )
+    return folds
+
+
+def write_split_files(splits: dict, dataset_dir: Path, suffix: str = "") -> None:
+    """
+    Writes the txt list ({split}{suffix}.txt) of every split.
+    """
+    os.makedirs(dataset_dir, exist_ok=True)
+    for name, split_tiles_ in splits.items():
+        with open(Path(dataset_dir) / f"{name}{suffix}.txt", "w") as f:
+            f.writelines(f"{tile}\n" for tile in split_tiles_)
+    return
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split the tiles into datasets")
+    parser.add_argument("--total_share", default=0.5, type=float)
+    parser.add_argument("--val_share", default=0.1, type=float)
+    parser.add_argument("--test_share", default=0.2, type=float)
+    parser.add_argument("--block_size", default=4, type=int)
+    parser.add_argument("--strata", default=5, type=int)
+    parser.add_argument("--buffer", default=0, type=int)
+    parser.add_argument("--folds", default=0, type=int, help="write k-fold lists")
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    # Read bbox from bbox.json
+    with open(current_dir / "bbox.json", "r") as f:
+        bbox = json.load(f)
+    cities = list(bbox.keys())
 
-    # write the validation tiles to val.txt
-    for tile in val_tiles:
-        val_file.write(f"{tile}\n")
+    image_dir = data_path / "ML_training/train/image"
+    label_dir = data_path / "ML_training/train/label"
+    dataset_dir = data_path / "ML_training/dataset"
 
-    # write the training tiles to train.txt
-    for tile in train_tiles:
-        train_file.write(f"{tile}\n")
+    tiles = sorted(
+        os.path.splitext(tile)[0]
+        for tile in os.listdir(image_dir)
+        if tile.endswith(".tif")
+        and any(city in tile for city in cities[:-1])  # exclude Fredrikstad
+    )
+    ratios = load_tile_ratios(
+        tiles, data_path / "ML_training/train/tile_index.csv", label_dir
+    )
 
-    # write the test tiles to test.txt
-    for tile in test_tiles:
-        test_file.write(f"{tile}\n")
+    # only use a share of the blocks
+    if args.total_share < 1:
+        table = tile_table(tiles, args.block_size)
+        blocks = table["block"].unique()
+        rng = np.random.default_rng(args.seed)
+        used = rng.choice(
+            blocks, int(np.ceil(len(blocks) * args.total_share)), replace=False
+        )
+        keep = table["block"].isin(used).to_numpy()
+        tiles, ratios = list(np.array(tiles)[keep]), ratios[keep]
 
-train_file.close()
-val_file.close()
-test_file.close()
+    if args.folds > 1:
+        folds = kfold_splits(
+            tiles,
+            ratios,
+            args.folds,
+            args.block_size,
+            args.strata,
+            args.buffer,
+            args.seed,
+        )
+        for f, fold in enumerate(folds):
+            write_split_files(fold, dataset_dir, suffix=f"_fold{f}")
+    else:
+        shares = {
+            "train": 1 - args.val_share - args.test_share,
+            "val": args.val_share,
+            "test": args.test_share,
+        }
+        splits = split_tiles(
+            tiles,
+            ratios,
+            shares,
+            args.block_size,
+            args.strata,
+            args.buffer,
+            args.seed,
+        )
+        write_split_files(splits, dataset_dir)
+        print({name: len(split) for name, split in splits.items()})
 
 # %%
@@ -1,93 +1,232 @@
-# import os
-# import sys
-# import cv2
-# import torch
-import argparse
-
-# import subprocess
-import numpy as np
-from glob import glob
-from PIL import Image
-import os.path as osp
-import scipy.io as io
-from tqdm import tqdm
-from scipy.ndimage import distance_transform_edt, distance_transform_cdt
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--datadir", dest="datadir", default="data/ML_training/")
-parser.add_argument("--outname", default="boundary")
-# parser.add_argument('--split', nargs='+', default=['train', 'test'])
-parser.add_argument("--metric", default="euc", choices=["euc", "taxicab"])
-args = parser.parse_args()
-
-label_list = [0, 255]
-
-
-def _encode_label(labelmap):
-    encoded_labelmap = np.ones_like(labelmap, dtype=np.uint16) * 255
-    for i, class_id in enumerate(label_list):
-        encoded_labelmap[labelmap == class_id] = i
-
-    return encoded_labelmap
-
-
-def process(inp):
-    """
-    segfix.lib.datasets.preprocess.cityscapes.dt_offset_generator.py
-    """
-    (indir, outdir, basename) = inp
-    # print(inp)
-    labelmap = (
-        np.array(Image.open(osp.join(indir, basename)).convert("P")).astype(np.int16)
-        / 255
-    )
-    a = np.sum(labelmap == 0)
-    labelmap = _encode_label(labelmap)
-    labelmap = labelmap + 1
-    depth_map = np.zeros(labelmap.shape, dtype=np.float32)  # (H,W,C)
-
-    # for id in range(1, len(label_list)):
-    for id in range(1, len(label_list) + 1):  # only consider outer boundary
-        labelmap_i = labelmap.copy()
-        labelmap_i[labelmap_i != id] = 0
-        labelmap_i[labelmap_i == id] = 1
-        # label: 1 background: 0
-        if args.metric == "euc":
-            depth_i = distance_transform_edt(labelmap_i)
-        elif args.metric == "taxicab":
-            depth_i = distance_transform_cdt(labelmap_i, metric="taxicab")
-        else:
-            raise RuntimeError
-        depth_map += depth_i
-
-    depth_map[depth_map > 250] = 250
-    if a == (labelmap.shape[0] * labelmap.shape[1]):
-        depth_map[depth_map > 0] = 250
-
-    depth_map = depth_map.astype(np.uint8)
-
-    # edge = depth_map.copy()
-    # e1 = (depth_map > 0) & (depth_map <= 3)
-    # edge[e1] = 255
-    # e2 = (edge > 0) & (edge < 255)
-    # edge[e2] = 0
-    # ed = Image.fromarray(edge)
-    # ed.save("edge.png")
-
-    io.savemat(
-        osp.join(outdir, basename.replace("tif", "mat")),
-        {"depth": depth_map},
-        do_compression=True,
-    )
-
-
-indir = osp.join(args.datadir, f"train", "label")
-outdir = osp.join(args.datadir, args.outname)
-args_to_apply = [
-    (indir, outdir, osp.basename(basename))
-    for basename in glob(osp.join(indir, "*.tif"))
-    if "fredrikstad" not in osp.basename(basename)
-]
-print("Processing {} files".format(len(args_to_apply)))
-for i in tqdm(range(0, len(args_to_apply))):
-    process(args_to_apply[i])
+"""
+Makes the boundary (distance) maps for the training labels, used as target for the
+boundary head of HDNet.
+
+The labels are processed in a process pool, and a manifest with the content hash of
+every label lets us skip all labels that did not change since the last run. The maps
+are either written as one compressed `.mat` per label (what the HDNet dataset reads)
+or into one memory-mapped `.npy` store (N, H, W) with an index of the label names.
+"""
+
+# %%
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from glob import glob
+from PIL import Image
+import os.path as osp
+import scipy.io as io
+from tqdm import tqdm
+from scipy.ndimage import distance_transform_edt, distance_transform_cdt
+
+
+def distance_map(label: np.ndarray, metric: str = "euc") -> np.ndarray:
+    """
+    segfix.lib.datasets.preprocess.cityscapes.dt_offset_generator.py
+
+    Distance of every background pixel to the closest building (only the outer
+    boundary is considered), capped at 250. Tiles without buildings are 250 everywhere.
+
+    The original implementation looped over both classes with a copy of the label map
+    each; the building class never matched its encoded id, so its distance was always
+    zero and a single transform of the background gives the identical result.
+
+    Arguments:
+    - label: label tile (0 background, anything else building)
+    - metric: "euc" or "taxicab"
+
+    Returns:
+    - uint8 distance map
+    """
+    background = label == 0
+    if metric == "euc":
+        depth_map = distance_transform_edt(background)
+    elif metric == "taxicab":
+        depth_map = distance_transform_cdt(background, metric="taxicab")
+    else:
+        raise RuntimeError(f"Unknown metric {metric}")
+
+    depth_map = np.minimum(depth_map, 250)
+    if background.all():
+        depth_map[depth_map > 0] = 250
+
+    return depth_map.astype(np.uint8)
+
+
+def process(inp):
+    """
+    Reads a label tile and returns its distance map (run in a worker process).
+    """
+    (indir, basename, metric) = inp
+    label = np.array(Image.open(osp.join(indir, basename)).convert("P"))
+    return basename, distance_map(label, metric)
+
+
+def hash_file(path: str) -> str:
+    """
+    Content hash of a file.
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def make_distance_maps(
+    indir: str,
+    outdir: str,
+    outname: str = "boundary",
+    metric: str = "euc",
+    output_format: str = "mat",
+    exclude: str = "fredrikstad",
+    n_workers: int = None,
+) -> None:
+    """
+    Makes the distance maps for all labels in indir that changed since the last run.
+
+    Arguments:
+    - indir: folder with the label tiles (.tif)
+    - outdir: parent folder of the output
+    - outname: name of the output folder (mat) or store (npy)
+    - metric: "euc" or "taxicab"
+    - output_format: "mat" for one .mat per label in outdir/outname, or "npy" for
+        one store outdir/outname.npy with the label names in outdir/outname_index.txt
+    - exclude: skip labels containing this string (None to keep all)
+    - n_workers: number of worker processes (default: all cores)
+    """
+    basenames = sorted(
+        osp.basename(path)
+        for path in glob(osp.join(indir, "*.tif"))
+        if exclude is None or exclude not in osp.basename(path)
+    )
+    if not basenames:
+        print(f"No labels found in {indir}")
+        return
+    os.makedirs(outdir, exist_ok=True)
+    manifest_path = osp.join(outdir, f"{outname}_manifest.json")
+    manifest = {}
+    if osp.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        hashes = dict(
+            zip(
+                basenames,
+                executor.map(
+                    hash_file,
+                    [osp.join(indir, basename) for basename in basenames],
+                    chunksize=64,
+                ),
+            )
+        )
+
+        if output_format == "mat":
+            mat_dir = osp.join(outdir, outname)
+            os.makedirs(mat_dir, exist_ok=True)
+            to_process = [
+                basename
+                for basename in basenames
+                if manifest.get(basename) != hashes[basename]
+                or not osp.exists(osp.join(mat_dir, basename.replace("tif", "mat")))
+            ]
+        elif output_format == "npy":
+            store, to_process = _open_distance_store(
+                outdir, outname, basenames, hashes, manifest, indir
+            )
+            rows = {basename: i for i, basename in enumerate(basenames)}
+        else:
+            raise ValueError(f"Unknown output format {output_format}")
+
+        print(
+            f"Processing {len(to_process)} files "
+            + f"({len(basenames) - len(to_process)} unchanged)"
+        )
+        results = executor.map(
+            process,
+            [(indir, basename, metric) for basename in to_process],
+            chunksize=16,
+        )
+        for basename, depth_map in tqdm(results, total=len(to_process)):
+            if output_format == "mat":
+                io.savemat(
+                    osp.join(mat_dir, basename.replace("tif", "mat")),
+                    {"depth": depth_map},
+                    do_compression=True,
+                )
+            else:
+                store[rows[basename]] = depth_map
+            manifest[basename] = hashes[basename]
+
+    if output_format == "npy":
+        store.flush()
+        del store
+    manifest = {basename: manifest[basename] for basename in basenames}
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return
+
+
+def _open_distance_store(outdir, outname, basenames, hashes, manifest, indir):
+    """
+    Opens (or rebuilds) the npy store for the given labels and returns it together
+    with the labels that have to be (re)computed. If the set of labels changed, the
+    maps of the unchanged labels are copied over from the old store.
+    """
+    store_path = osp.join(outdir, f"{outname}.npy")
+    index_path = osp.join(outdir, f"{outname}_index.txt")
+    old_index = []
+    if osp.exists(store_path) and osp.exists(index_path):
+        with open(index_path, "r") as f:
+            old_index = f.read().splitlines()
+    unchanged = {
+        basename
+        for basename in set(old_index)
+        if manifest.get(basename) == hashes.get(basename)
+    }
+    to_process = [basename for basename in basenames if basename not in unchanged]
+
+    if old_index == basenames:
+        return np.load(store_path, mmap_mode="r+"), to_process
+
+    height, width = Image.open(osp.join(indir, basenames[0])).size[::-1]
+    tmp_path = osp.join(outdir, f"{outname}_tmp.npy")
+    store = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=np.uint8, shape=(len(basenames), height, width)
+    )
+    if unchanged:
+        old_store = np.load(store_path, mmap_mode="r")
+        old_rows = {basename: i for i, basename in enumerate(old_index)}
+        for i, basename in enumerate(basenames):
+            if basename in unchanged:
+                store[i] = old_store[old_rows[basename]]
+        del old_store
+    store.flush()
+    del store
+    os.replace(tmp_path, store_path)
+    with open(index_path, "w") as f:
+        f.write("\n".join(basenames) + "\n")
+    return np.load(store_path, mmap_mode="r+"), to_process
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datadir", dest="datadir", default="data/ML_training/")
+    parser.add_argument("--outname", default="boundary")
+    # parser.add_argument('--split', nargs='+', default=['train', 'test'])
+    parser.add_argument("--metric", default="euc", choices=["euc", "taxicab"])
+    parser.add_argument("--format", default="mat", choices=["mat", "npy"])
+    parser.add_argument("--numworkers", default=None, type=int)
+    args = parser.parse_args()
+
+    make_distance_maps(
+        indir=osp.join(args.datadir, "train", "label"),
+        outdir=args.datadir,
+        outname=args.outname,
+        metric=args.metric,
+        output_format=args.format,
+        n_workers=args.numworkers,
+    )
@@ -1,9 +1,30 @@
+"""
+Mean and std of the training images, used to normalize the input of the network.
+
+`compute_histograms` reads every image once (in a process pool) and counts the uint8
+values of each channel and of the grayscale image, summed per source orthophoto (the
+tile name without the trailing `_i_j`). The histograms are the sufficient statistics
+for everything we need: the exact per-pixel mean and std of the dataset (the moments
+of the groups are merged with Chan's update), and the grayscale mean/std that
+`match_bad_quality.py` turns into contrast and brightness factors. They are saved in
+the histogram cache of `radiometric_matching.get_reference_histograms` (keyed by the
+folder and its files), where `match_bad_quality.py` and the radiometric matching find
+them without touching the images again.
+
+`calculate_mean_std` is the old DataLoader version, it averages the std of the single
+images, which is not the std of the dataset.
+"""
+
 # %%
 from torchvision import transforms
 from torch.utils.data import DataLoader, Dataset
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from tqdm import tqdm
 from PIL import Image
+import numpy as np
+from HOME.get_data_path import get_data_path
+import cv2
 import os
 import argparse
 
@@ -53,18 +74,231 @@ def calculate_mean_std(dataset_path, txt_path=None, batch_size=32):
     return mean, std
 
 
+def image_group(img_name: str) -> str:
+    """
+    Source orthophoto of a training tile ("{image}_{i}_{j}.tif" -> "{image}").
+    """
+    return img_name.rsplit(".", 1)[0].rsplit("_", 2)[0]
+
+
+def image_histograms(img_path) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Histograms of the RGB channels and of the grayscale version of an image.
+    The grayscale conversion is the same integer formula as PIL's convert("L").
+
+    Arguments:
+    - img_path: path to the image
+
+    Returns:
+    - (3, 256) histograms of R, G and B
+    - (256,) histogram of the grayscale image
+    """
+    image = cv2.imread(str(img_path), cv2.IMREAD_COLOR)
+    if image is None:
+        raise FileNotFoundError(f"Could not read {img_path}")
+    blue, green, red = (image[..., c].ravel() for c in range(3))
+    # one bincount for the three channels, with the channels shifted to own bins
+    rgb_hist = np.bincount(
+        np.concatenate(
+            [red, green.astype(np.uint16) + 256, blue.astype(np.uint16) + 512]
+        ),
+        minlength=768,
+    ).reshape(3, 256)
+    gray = (
+        red.astype(np.uint32) * 19595
+        + green.astype(np.uint32) * 38470
+        + blue.astype(np.uint32) * 7471
+        + 0x8000
+    ) >> 16
+    gray_hist = np.bincount(gray, minlength=256)
+    return rgb_hist, gray_hist
+
+
+def _group_histograms(img_dir, img_names: list[str]) -> dict:
+    """
+    Sums the histograms of a chunk of images per group (run in a worker process).
+    """
+    histograms = {}
+    for img_name in img_names:
+        rgb_hist, gray_hist = image_histograms(Path(img_dir) / img_name)
+        group = image_group(img_name)
+        if group in histograms:
+            histograms[group][0] += rgb_hist
+            histograms[group][1] += gray_hist
+        else:
+            histograms[group] = [rgb_hist, gray_hist]
+    return histograms
+
+
+def compute_histograms(
+    img_dir,
+    txt_path=None,
+    img_names: list[str] = None,
+    n_workers: int = None,
+    chunk_size: int = 64,
+) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """
+    Histograms of all images in a folder (or in a split), summed per source orthophoto.
+
+    Arguments:
+    - img_dir: folder with the images
+    - txt_path: optional split file with the image names (without .tif)
+    - img_names: optional list of image names (with extension), instead of txt_path
+    - n_workers: number of worker processes (default: all cores)
+    - chunk_size: number of images handed to a worker at once
+
+    Returns:
+    - names of the groups
+    - (G, 3, 256) RGB histograms of the groups
+    - (G, 256) grayscale histograms of the groups
+    """
+    if img_names is None:
+        if txt_path is not None:
+            with open(txt_path, "r") as file:
+                img_names = [name + ".tif" for name in file.read().splitlines()]
+        else:
+            img_names = sorted(os.listdir(img_dir))
+    chunks = [
+        img_names[i : i + chunk_size] for i in range(0, len(img_names), chunk_size)
+    ]
+
+    histograms = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        with tqdm(total=len(img_names), desc="Histograms") as pbar:
+            for chunk, chunk_histograms in zip(
+                chunks, executor.map(_group_histograms, [img_dir] * len(chunks), chunks)
+            ):
+                for group, (rgb_hist, gray_hist) in chunk_histograms.items():
+                    if group in histograms:
+                        histograms[group][0] += rgb_hist
+                        histograms[group][1] += gray_hist
+                    else:
+                        histograms[group] = [rgb_hist, gray_hist]
+                pbar.update(len(chunk))
+
+    groups = sorted(histograms)
+    rgb_hists = np.zeros((len(groups), 3, 256), dtype=np.int64)
+    gray_hists = np.zeros((len(groups), 256), dtype=np.int64)
+    for i, group in enumerate(groups):
+        rgb_hists[i], gray_hists[i] = histograms[group]
+    return groups, rgb_hists, gray_hists
+
+
+def save_histograms(path, groups, rgb_hists, gray_hists) -> None:
+    """
+    Saves the histograms from `compute_histograms` to a npz file.
+    """
+    np.savez_compressed(path, groups=np.array(groups), rgb=rgb_hists, gray=gray_hists)
+    return
+
+
+def load_histograms(path) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """
+    Loads the histograms saved with `save_histograms`.
+    """
+    with np.load(path) as data:
+        return data["groups"].tolist(), data["rgb"], data["gray"]
+
+
+def histogram_moments(hist: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Count, mean and sum of squared deviations (M2) of uint8 histograms.
+
+    Arguments:
+    - hist: histograms with the 256 bins in the last axis
+
+    Returns:
+    - n, mean, M2 (each with the shape of hist without the last axis)
+    """
+    values = np.arange(256, dtype=np.float64)
+    n = hist.sum(axis=-1).astype(np.float64)
+    mean = (hist * values).sum(axis=-1) / np.maximum(n, 1)
+    m2 = (hist * (values - mean[..., None]) ** 2).sum(axis=-1)
+    return n, mean, m2
+
+
+def merge_moments(moments_a: tuple, moments_b: tuple) -> tuple:
+    """
+    Merges (n, mean, M2) of two sets of samples (Chan et al.).
+    """
+    n_a, mean_a, m2_a = moments_a
+    n_b, mean_b, m2_b = moments_b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    safe_n = np.maximum(n, 1)
+    mean = mean_a + delta * n_b / safe_n
+    m2 = m2_a + m2_b + delta**2 * n_a * n_b / safe_n
+    return n, mean, m2
+
+
+def histogram_mean_std(hists: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Exact mean and std (over all pixels) of a set of group histograms, in [0, 1]
+    like `calculate_mean_std`.
+
+    Arguments:
+    - hists: (G, ..., 256) histograms, e.g. the RGB or grayscale histograms
+
+    Returns:
+    - mean and std with the shape of one group without the bins
+    """
+    n, mean, m2 = histogram_moments(hists[0])
+    for hist in hists[1:]:
+        n, mean, m2 = merge_moments((n, mean, m2), histogram_moments(hist))
+    std = np.sqrt(m2 / np.maximum(n, 1))
+    return mean / 255, std / 255
+
+
+def contrast_brightness_factors(
+    gray_hists_from: np.ndarray, gray_hists_to: np.ndarray
+) -> tuple[float, float]:
+    """
+    Contrast and brightness factors (for PIL's ImageEnhance) that move the grayscale
+    std and mean of one set of images to the ones of another set.
+
+    Arguments:
+    - gray_hists_from: (G, 256) grayscale histograms of the images to transform
+    - gray_hists_to: (G, 256) grayscale histograms of the target images
+
+    Returns:
+    - contrast factor (ratio of the std) and brightness factor (ratio of the mean)
+    """
+    mean_from, std_from = histogram_mean_std(gray_hists_from)
+    mean_to, std_to = histogram_mean_std(gray_hists_to)
+    return float(std_to / std_from), float(mean_to / mean_from)
+
+
 # Usage
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calculate mean and std of dataset")
     parser.add_argument("-bw", "--BW", required=False, type=bool, default=False)
+    parser.add_argument(
+        "--method", required=False, default="histogram", choices=["histogram", "loader"]
+    )
+    parser.add_argument("--numworkers", required=False, type=int, default=None)
     args = parser.parse_args()
     str_bw = "_BW" if args.BW else ""
 
     root_dir = Path(__file__).parents[3]
-    path_train_data = root_dir / f"data/ML_training/train{str_bw}/image/"
-    path_train_txt = root_dir / "data/ML_training/dataset/train.txt"
+    data_path = get_data_path(root_dir)
+    path_train_data = data_path / f"ML_training/train{str_bw}/image/"
+    path_train_txt = data_path / "ML_training/dataset/train.txt"
+
+    if args.method == "loader":
+        mean, std = calculate_mean_std(path_train_data, path_train_txt)
+    else:
+        # imported here, radiometric_matching imports this module
+        from HOME.ML_training.preprocessing.radiometric_matching import (
+            get_reference_histograms,
+        )
 
-    mean, std = calculate_mean_std(path_train_data, path_train_txt)
+        # computed once and cached, match_bad_quality.py reads the same histograms
+        _, rgb_hists, gray_hists = get_reference_histograms(
+            path_train_data, path_train_txt, n_workers=args.numworkers
+        )
+        mean, std = histogram_mean_std(rgb_hists)
+        gray_mean, gray_std = histogram_mean_std(gray_hists)
+        print("Gray mean:", gray_mean, "Gray std:", gray_std)
 
     print("Mean:", mean)
     print("Std:", std)
@@ -0,0 +1,348 @@
+"""
+Packs the tiles of a split (image, label and boundary map) into a few large shards.
+
+Reading three small files per sample (`train/image/*.tif`, `train/label/*.tif`,
+`boundary/*.mat`) makes an epoch on the network filesystem mostly metadata operations.
+Here the tiles of a split (from the txt lists of `step_04_dataset_splitting`) are
+written as fixed size uint8 arrays into `.npy` shards of `shard_size` tiles:
+
+    {split}_{shard:04d}_image.npy     (n, H, W, 3), BGR as read by cv2
+    {split}_{shard:04d}_label.npy     (n, H, W)
+    {split}_{shard:04d}_boundary.npy  (n, H, W)
+    {split}_index.csv                 name, shard, row
+
+The boundary maps are taken from the npy store of `step_05_distance_map` (--format
+npy) if there is one, else from the `.mat` files; tiles without a map (e.g. val/test,
+which step_05 does not process) get it computed from their label on the fly.
+
+`PackedTileDataset` memory-maps the shards and `BlockShuffleSampler` shuffles blocks
+of consecutive tiles, so the DataLoader reads the shards (nearly) sequentially.
+`train.py --packed` swaps both into the HDNet training script.
+"""
+
+# %%
+import os
+import inspect
+import argparse
+from pathlib import Path
+from typing import Callable
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import cv2
+import scipy.io as io
+import torch
+from torch.utils.data import Dataset, Sampler
+from tqdm import tqdm
+
+from HOME.ML_training.preprocessing.step_05_distance_map import distance_map
+from HOME.get_data_path import get_data_path
+
+root_dir = Path(__file__).parents[3]
+data_path = get_data_path(root_dir)
+
+
+# %%
+class BoundarySource:
+    """
+    Boundary maps of the tiles: from the npy store `{boundary}.npy` (with
+    `{boundary}_index.txt`) of step_05 if it exists, else from `{boundary}/{name}.mat`,
+    else computed from the label with the same `distance_map` as step_05.
+
+    Arguments:
+    - data_dir: the ML_training folder
+    - boundary: name of the store or folder of the maps in data_dir
+    """
+
+    def __init__(self, data_dir: Path, boundary: str):
+        self.mat_dir = Path(data_dir) / boundary
+        store_path = Path(data_dir) / f"{boundary}.npy"
+        index_path = Path(data_dir) / f"{boundary}_index.txt"
+        self.store, self.rows = None, {}
+        if store_path.exists() and index_path.exists():
+            self.store = np.load(store_path, mmap_mode="r")
+            with open(index_path, "r") as f:
+                self.rows = {
+                    Path(name).stem: i for i, name in enumerate(f.read().splitlines())
+                }
+
+    def get(self, name: str, label: np.ndarray) -> np.ndarray:
+        if name in self.rows:
+            return np.asarray(self.store[self.rows[name]])
+        mat_path = self.mat_dir / f"{name}.mat"
+        if mat_path.exists():
+            return io.loadmat(str(mat_path))["depth"].astype(np.uint8)
+        return distance_map(label)
+
+
+def read_tile(
+    data_dir: Path,
+    name: str,
+    image_folder: str,
+    label_folder: str,
+    boundaries: BoundarySource,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Reads image, label and boundary map of a tile (names without extension).
+    """
+    image = cv2.imread(str(data_dir / image_folder / f"{name}.tif"), cv2.IMREAD_COLOR)
+    label = cv2.imread(
+        str(data_dir / label_folder / f"{name}.tif"), cv2.IMREAD_GRAYSCALE
+    )
+    if image is None or label is None:
+        raise FileNotFoundError(f"Could not read tile {name}")
+    return image, label, boundaries.get(name, label)
+
+
+def write_shard(
+    data_dir: Path,
+    names: list[str],
+    shard_prefix: Path,
+    image_folder: str,
+    label_folder: str,
+    boundary: str,
+) -> int:
+    """
+    Writes the tiles of one shard (run in a worker process). The arrays are written to
+    temporary files and renamed, so an interrupted run leaves no broken shards.
+    """
+    boundaries = BoundarySource(data_dir, boundary)
+    first_image, _, _ = read_tile(
+        data_dir, names[0], image_folder, label_folder, boundaries
+    )
+    height, width = first_image.shape[:2]
+    shapes = {
+        "image": (len(names), height, width, 3),
+        "label": (len(names), height, width),
+        "boundary": (len(names), height, width),
+    }
+    arrays = {
+        key: np.lib.format.open_memmap(
+            f"{shard_prefix}_{key}.tmp.npy", mode="w+", dtype=np.uint8, shape=shape
+        )
+        for key, shape in shapes.items()
+    }
+    for row, name in enumerate(names):
+        image, label, depth = read_tile(
+            data_dir, name, image_folder, label_folder, boundaries
+        )
+        arrays["image"][row] = image
+        arrays["label"][row] = label
+        arrays["boundary"][row] = depth
+    for array in arrays.values():
+        array.flush()
+    for key in list(arrays):
+        del arrays[key]
+        os.replace(f"{shard_prefix}_{key}.tmp.npy", f"{shard_prefix}_{key}.npy")
+    return len(names)
+
+
+def pack_split(
+    data_dir: Path,
+    split: str = "train",
+    output_dir: Path = None,
+    shard_size: int = 2048,
+    image_folder: str = "train/image",
+    label_folder: str = "train/label",
+    boundary: str = "boundary",
+    n_workers: int = None,
+) -> pd.DataFrame:
+    """
+    Packs the tiles of a split into shards.
+
+    Arguments:
+    - data_dir: the ML_training folder
+    - split: name of the split, the names are read from dataset/{split}.txt
+    - output_dir: folder for the shards, defaults to data_dir/shards
+    - shard_size: number of tiles per shard
+    - image_folder, label_folder: folders of the tiles in data_dir
+    - boundary: name of the npy store or folder of the boundary maps in data_dir
+        (see `BoundarySource`)
+    - n_workers: number of worker processes (default: all cores)
+
+    Returns:
+    - the index of the split (name, shard, row)
+    """
+    data_dir = Path(data_dir)
+    if output_dir is None:
+        output_dir = data_dir / "shards"
+    output_dir = Path(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(data_dir / f"dataset/{split}.txt", "r") as f:
+        names = f.read().splitlines()
+
+    shards = [names[i : i + shard_size] for i in range(0, len(names), shard_size)]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(
+                write_shard,
+                data_dir,
+                shard_names,
+                output_dir / f"{split}_{shard:04d}",
+                image_folder,
+                label_folder,
+                boundary,
+            )
+            for shard, shard_names in enumerate(shards)
+        ]
+        with tqdm(total=len(names), desc=f"Packing {split}") as pbar:
+            for future in futures:
+                pbar.update(future.result())
+
+    index = pd.DataFrame(
+        {
+            "name": names,
+            "shard": np.arange(len(names)) // shard_size,
+            "row": np.arange(len(names)) % shard_size,
+        }
+    )
+    index.to_csv(output_dir / f"{split}_index.csv", index=False)
+    return index
+
+
+class PackedTileDataset(Dataset):
+    """
+    Tiles of a split packed with `pack_split`, returned as dicts like the HDNet
+    BuildingDataset: "image" (3, H, W) RGB normalized with mean/std, "label" (1, H, W)
+    in {0, 1}, "boundary" (1, H, W) and "name".
+
+    Arguments:
+    - shard_dir: folder of the shards
+    - split: name of the split
+    - mean, std: per channel (RGB) in [0, 1] for the normalization
+    """
+
+    def __init__(self, shard_dir: Path, split: str, mean: tuple, std: tuple):
+        self.shard_dir = Path(shard_dir)
+        self.split = split
+        self.index = pd.read_csv(self.shard_dir / f"{split}_index.csv")
+        self.names = self.index["name"].to_list()
+        self.shards = self.index["shard"].to_numpy()
+        self.rows = self.index["row"].to_numpy()
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(3, 1, 1) * 255
+        self.std = torch.tensor(std, dtype=torch.float32).view(3, 1, 1) * 255
+        # opened lazily, so every DataLoader worker has its own memory maps
+        self._arrays = {}
+
+    def _array(self, shard: int, key: str) -> np.ndarray:
+        if (shard, key) not in self._arrays:
+            self._arrays[(shard, key)] = np.load(
+                self.shard_dir / f"{self.split}_{shard:04d}_{key}.npy", mmap_mode="r"
+            )
+        return self._arrays[(shard, key)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        shard, row = int(self.shards[index]), int(self.rows[index])
+        image = torch.from_numpy(
+            np.ascontiguousarray(self._array(shard, "image")[row][..., ::-1])
+        )
+        image = (image.permute(2, 0, 1).float() - self.mean) / self.std
+        label = torch.from_numpy(self._array(shard, "label")[row] > 0).float()
+        boundary = torch.from_numpy(self._array(shard, "boundary")[row].copy()).float()
+        return {
+            "image": image,
+            "label": label[None],
+            "boundary": boundary[None],
+            "name": self.names[index],
+        }
+
+
+class BlockShuffleSampler(Sampler):
+    """
+    Shuffles blocks of consecutive tiles (and the tiles within a block), so every
+    batch reads a few contiguous ranges of a shard instead of random rows.
+
+    Arguments:
+    - data_source: the dataset
+    - block_size: number of consecutive tiles in a block
+    - seed: seed, the order changes every epoch: with `set_epoch`, or else by itself
+        after every pass (the HDNet training loop does not call set_epoch)
+    """
+
+    def __init__(self, data_source: Dataset, block_size: int = 64, seed: int = 0):
+        self.n = len(data_source)
+        self.block_size = block_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+        starts = np.arange(0, self.n, self.block_size)
+        rng.shuffle(starts)
+        for start in starts:
+            block = np.arange(start, min(start + self.block_size, self.n))
+            rng.shuffle(block)
+            yield from block.tolist()
+
+    def __len__(self):
+        return self.n
+
+
+def packed_dataset_class(shard_dir: Path, mean: tuple, std: tuple) -> Callable:
+    """
+    Factory with the signature of the HDNet BuildingDataset that returns the
+    `PackedTileDataset` of the split of txt_name (e.g. "train.txt" -> "train"), to
+    replace the dataset class of a training script without changing it.
+    """
+
+    def make_dataset(*args, **kwargs):
+        # BuildingDataset(dataset_dir, training, txt_name, ...)
+        training = args[1] if len(args) > 1 else kwargs.get("training", False)
+        default_txt = "train.txt" if training else "val.txt"
+        txt_name = args[2] if len(args) > 2 else kwargs.get("txt_name", default_txt)
+        return PackedTileDataset(shard_dir, Path(txt_name).stem, mean, std)
+
+    return make_dataset
+
+
+def block_shuffle_loader_class(
+    base_class: type, block_size: int = 64, seed: int = 0
+) -> Callable:
+    """
+    Factory with the signature of the DataLoader that replaces shuffle=True by a
+    `BlockShuffleSampler`, to replace the DataLoader of a training script.
+    """
+    signature = inspect.signature(base_class)
+
+    def make_loader(*args, **kwargs):
+        bound = signature.bind_partial(*args, **kwargs)
+        if bound.arguments.get("shuffle"):
+            bound.arguments["shuffle"] = False
+            bound.arguments["sampler"] = BlockShuffleSampler(
+                bound.arguments["dataset"], block_size, seed
+            )
+        return base_class(*bound.args, **bound.kwargs)
+
+    return make_loader
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack training tiles into shards")
+    parser.add_argument("--datadir", default=data_path / "ML_training/")
+    parser.add_argument("--splits", nargs="+", default=["train", "val", "test"])
+    parser.add_argument("--shard_size", default=2048, type=int)
+    parser.add_argument("--image_folder", default="train/image")
+    parser.add_argument("--label_folder", default="train/label")
+    parser.add_argument("--boundary", default="boundary")
+    parser.add_argument("--numworkers", default=None, type=int)
+    args = parser.parse_args()
+
+    for split in args.splits:
+        pack_split(
+            args.datadir,
+            split,
+            shard_size=args.shard_size,
+            image_folder=args.image_folder,
+            label_folder=args.label_folder,
+            boundary=args.boundary,
+            n_workers=args.numworkers,
+        )
@@ -0,0 +1,151 @@
+"""
+Grayscale and "old orthophoto" versions of the training tiles, made at load time.
+
+Instead of materializing `train_BW` (utils/convert_BW.py) and `train_poor`
+(match_bad_quality.py), `AugmentedDataset` wraps the HDNet BuildingDataset of the RGB
+tiles and transforms the normalized image tensor of every sample:
+- "bw": grayscale (same weights as PIL's convert("L")), three identical channels
+- "poor": grayscale, then contrast and brightness like ImageEnhance (contrast around
+    the mean of the tile), with factors jittered per tile
+
+The image is brought back to [0, 255] with the normalization of the base dataset,
+transformed and normalized again with the statistics of the output. Both have to be
+the exact constants of the BuildingDataset ("NOCI" in, "NOCI_BW" out, as used at
+inference): statistics recomputed from the tiles differ slightly and would shift
+every input. The random choices only depend on the tile name and the seed, so every
+tile looks the same in every epoch and every run.
+"""
+
+# %%
+import zlib
+from typing import Callable
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+gray_weights = (0.299, 0.587, 0.114)
+
+
+# %%
+def tile_rng(name: str, seed: int = 0) -> np.random.Generator:
+    """
+    Random generator that only depends on the tile name and the seed.
+    """
+    return np.random.default_rng([zlib.crc32(str(name).encode()), seed])
+
+
+def to_gray(image: torch.Tensor) -> torch.Tensor:
+    """
+    Grayscale version of an RGB image (3, H, W) in [0, 255], as (3, H, W).
+    """
+    weights = torch.tensor(gray_weights, dtype=image.dtype, device=image.device)
+    gray = torch.tensordot(weights, image, dims=1)
+    return gray.expand(3, *gray.shape)
+
+
+def degrade(
+    image: torch.Tensor, contrast_factor: float, brightness_factor: float
+) -> torch.Tensor:
+    """
+    Contrast (around the mean of the image) and brightness of an image in [0, 255].
+    """
+    mean = image.mean().round()
+    image = (mean + contrast_factor * (image - mean)).clamp(0, 255)
+    return (image * brightness_factor).clamp(0, 255)
+
+
+class AugmentedDataset(Dataset):
+    """
+    Wraps a dataset returning dicts with a normalized "image" tensor (3, H, W) and the
+    tile path in "name".
+
+    Arguments:
+    - dataset: the base dataset (RGB tiles)
+    - mode: "rgb" (unchanged), "bw" or "poor"
+    - input_stats: (mean, std) per channel in [0, 1], the constants the base dataset
+        normalizes with
+    - output_stats: (mean, std) per channel in [0, 1] for the output, defaults to
+        input_stats
+    - contrast_factor, brightness_factor: factors for "poor" (e.g. from
+        `contrast_brightness_factors` of the training and the old images)
+    - jitter: relative range the factors are varied per tile
+    - poor_fraction: fraction of the tiles that are degraded in "poor", the others are
+        only grayscale
+    - seed: seed for the per tile random choices
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        mode: str = "bw",
+        input_stats: tuple = None,
+        output_stats: tuple = None,
+        contrast_factor: float = 1.0,
+        brightness_factor: float = 1.0,
+        jitter: float = 0.0,
+        poor_fraction: float = 1.0,
+        seed: int = 0,
+    ):
+        if mode not in ("rgb", "bw", "poor"):
+            raise ValueError(f"Unknown mode {mode}")
+        if mode != "rgb" and input_stats is None:
+            raise ValueError("input_stats are needed to undo the normalization")
+        self.dataset = dataset
+        self.mode = mode
+        if output_stats is None:
+            output_stats = input_stats
+        if mode != "rgb":
+            self.input_mean, self.input_std = (
+                torch.tensor(s, dtype=torch.float32).view(3, 1, 1) * 255
+                for s in input_stats
+            )
+            self.output_mean, self.output_std = (
+                torch.tensor(s, dtype=torch.float32).view(3, 1, 1) * 255
+                for s in output_stats
+            )
+        self.contrast_factor = contrast_factor
+        self.brightness_factor = brightness_factor
+        self.jitter = jitter
+        self.poor_fraction = poor_fraction
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        sample = self.dataset[index]
+        if self.mode == "rgb":
+            return sample
+        image = torch.as_tensor(sample["image"], dtype=torch.float32)
+        image = to_gray(image * self.input_std + self.input_mean)
+        if self.mode == "poor":
+            rng = tile_rng(sample["name"], self.seed)
+            if rng.random() < self.poor_fraction:
+                contrast, brightness = 1 + self.jitter * rng.uniform(-1, 1, size=2)
+                image = degrade(
+                    image,
+                    self.contrast_factor * contrast,
+                    self.brightness_factor * brightness,
+                )
+        sample["image"] = (image - self.output_mean) / self.output_std
+        return sample
+
+
+def augmented_dataset_class(base_class: type, **augment_kwargs) -> Callable:
+    """
+    Factory with the signature of base_class that returns the wrapped dataset, to
+    replace the dataset class of a training script without changing it. Datasets made
+    with training=False get "poor" replaced by "bw", so validation is not degraded.
+    """
+
+    def make_dataset(*args, **kwargs):
+        dataset = base_class(*args, **kwargs)
+        kwargs_dataset = dict(augment_kwargs)
+        # BuildingDataset(dataset_dir, training, ...)
+        training = args[1] if len(args) > 1 else kwargs.get("training", False)
+        if not training and kwargs_dataset.get("mode") == "poor":
+            kwargs_dataset["mode"] = "bw"
+        return AugmentedDataset(dataset, **kwargs_dataset)
+
+    return make_dataset
@@ -16,16 +16,18 @@ from ISPRS_HD_NET.utils.sync_batchnorm.batchnorm import convert_model  # type: i
 from ISPRS_HD_NET.model.HDNet import HighResolutionDecoupledNet  # type: ignore # noqa
 from ISPRS_HD_NET.utils.dataset import BuildingDataset  # type: ignore # noqa
 from ISPRS_HD_NET.eval.eval_HDNet import eval_net  # type: ignore # noqa
+from HOME.get_data_path import get_data_path  # noqa
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 matplotlib.use("tkagg")
 
 # %%
 root_dir = Path(__file__).parents[3]
-# data_dir = str(root_dir) + "/data/model/topredict/"
-data_dir = str(root_dir) + "/data/ML_prediction/"
+data_path = get_data_path(root_dir)
+# data_dir = str(data_path) + "/model/topredict/"
+data_dir = str(data_path) + "/ML_prediction/"
 
-dir_checkpoint = str(root_dir) + "/data/ML_model/save_weights/run_3/"
+dir_checkpoint = str(data_path) + "/ML_model/save_weights/run_3/"
 # dir_checkpoint = "../ISPRS_HD_NET/save_weights/pretrain/"
 predict = True
 # prediction_folder = 'predictions/BW_RGB_training/'
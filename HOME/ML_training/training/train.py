@@ -11,6 +11,15 @@ preroot_dir = Path(__file__).parents[4]
 sys.path.append(str(preroot_dir))
 sys.path.insert(0, str(preroot_dir / "ISPRS_HD_NET"))
 from ISPRS_HD_NET.Train_HDNet import main  # type: ignore # noqa
+import ISPRS_HD_NET.Train_HDNet as Train_HDNet  # type: ignore # noqa
+from HOME.ML_training.training.augmented_dataset import (  # noqa
+    augmented_dataset_class,
+)
+from HOME.ML_training.preprocessing.step_07_shard_packing import (  # noqa
+    packed_dataset_class,
+    block_shuffle_loader_class,
+)
+from HOME.get_data_path import get_data_path  # noqa
 
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
@@ -20,21 +29,31 @@ matplotlib.use("tkagg")
 torch.set_num_threads(16)
 
 root_dir = Path(__file__).parents[3]
+data_path = get_data_path(root_dir)
 
 
 def parse_args(parser, args):
     bw_str = "BW" if args.BW else "C"
     bw_str_ = "_BW" if args.BW else ""
+    if args.augment != "none":
+        # the augmented runs read the RGB tiles and convert them at load time; they
+        # are saved with the resolution like the other runs and an "_aug" suffix,
+        # load them with predict --checkpoint (and --BW)
+        bw_str = "BW" if args.augment == "bw" else "BW_poor"
+        bw_str_ = ""
     res = args.res
 
     parser.add_argument("-b", "--batch-size", default=8, type=int)
-    parser.add_argument("--data-path", default=root_dir / "data/ML_training/")
+    parser.add_argument("--data-path", default=data_path / "ML_training/")
     parser.add_argument("--numworkers", default=8, type=int)
     parser.add_argument("--num-classes", default=1, type=int)
     parser.add_argument("--base-channel", default=48, type=int)
     parser.add_argument("--device", default="cuda", help="training device")
     parser.add_argument("--read-name", default=args.read_name)
-    parser.add_argument("--save-name", default=f"HDNet_NOCI_{res}_{bw_str}")
+    save_name = f"HDNet_NOCI_{res}_{bw_str}"
+    if args.augment != "none":
+        save_name += "_aug"
+    parser.add_argument("--save-name", default=save_name)
     parser.add_argument("--DataSet", default="NOCI" + bw_str_)
     parser.add_argument("--image-folder", default=f"train{bw_str_}/image")
     args = parser.parse_args()
@@ -58,16 +77,79 @@ if __name__ == "__main__":
         help="number of total epochs to train",
     )
     parser.add_argument("--lr", default=0.001, type=float, help="initial learning rate")
+    parser.add_argument(
+        "--augment",
+        default="none",
+        choices=["none", "bw", "poor"],
+        help="grayscale or degraded tiles made at load time from the RGB tiles",
+    )
+    # the normalization constants of the HDNet BuildingDataset: the augmented images
+    # are de-normalized with the ones of "NOCI" (the RGB tiles it reads) and
+    # normalized again with the ones of "NOCI_BW" (used at inference on BW images)
+    parser.add_argument(
+        "--input-stats",
+        nargs=6,
+        type=float,
+        metavar=("MEAN_R", "MEAN_G", "MEAN_B", "STD_R", "STD_G", "STD_B"),
+        help="NOCI mean and std in [0, 1] of the BuildingDataset (for --augment and"
+        " --packed)",
+    )
+    parser.add_argument(
+        "--output-stats",
+        nargs=6,
+        type=float,
+        metavar=("MEAN_R", "MEAN_G", "MEAN_B", "STD_R", "STD_G", "STD_B"),
+        help="NOCI_BW mean and std in [0, 1] of the BuildingDataset (for --augment)",
+    )
+    parser.add_argument("--contrast", default=1.0, type=float)
+    parser.add_argument("--brightness", default=1.0, type=float)
+    parser.add_argument("--jitter", default=0.0, type=float)
+    parser.add_argument("--poor-fraction", default=1.0, type=float)
+    parser.add_argument(
+        "--packed",
+        default=None,
+        type=str,
+        metavar="SHARD_DIR",
+        help="read the tiles from the shards of step_07_shard_packing",
+    )
+    parser.add_argument("--block-size", default=64, type=int)
     args = parser.parse_args()
+    if args.packed is not None and args.input_stats is None:
+        # the shards hold the raw tiles, normalized like the BuildingDataset does
+        parser.error("--packed needs the --input-stats constants")
+    if args.augment != "none" and None in (args.input_stats, args.output_stats):
+        # statistics recomputed from the tiles differ slightly from the constants
+        # the dataset normalizes with, which would shift every augmented input
+        parser.error("--augment needs the --input-stats and --output-stats constants")
 
     args = parse_args(parser, args)
 
-    dir_checkpoint = str(root_dir) + f"/data/ML_model/save_weights/run_{args.numrun}/"
+    if args.packed is not None:
+        Train_HDNet.BuildingDataset = packed_dataset_class(
+            args.packed, args.input_stats[:3], args.input_stats[3:]
+        )
+        Train_HDNet.DataLoader = block_shuffle_loader_class(
+            Train_HDNet.DataLoader, block_size=args.block_size
+        )
+    if args.augment != "none":
+        Train_HDNet.BuildingDataset = augmented_dataset_class(
+            Train_HDNet.BuildingDataset,
+            mode=args.augment,
+            input_stats=(args.input_stats[:3], args.input_stats[3:]),
+            output_stats=(args.output_stats[:3], args.output_stats[3:]),
+            contrast_factor=args.contrast,
+            brightness_factor=args.brightness,
+            jitter=args.jitter,
+            poor_fraction=args.poor_fraction,
+        )
+
+    dir_checkpoint = str(data_path / f"ML_model/save_weights/run_{args.numrun}") + "/"
     if not os.path.exists(dir_checkpoint):
         os.mkdir(dir_checkpoint)
 
     description = (
-        f"Tile resolution: {args.res} \nBlack and White: {args.BW} \nFrom Existing:"
+        f"Tile resolution: {args.res} \nBlack and White: {args.BW} \n"
+        f"Augmentation: {args.augment} \nPacked: {args.packed} \nFrom Existing:"
         f" {args.read_name} \nDate: {datetime.now()}\n\n"
         f"max_epochs: {args.epochs}\n, learning rate: {args.lr}"
     )
@@ -0,0 +1,3 @@
+from HOME.cli import main
+
+main()
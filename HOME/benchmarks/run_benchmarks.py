@@ -0,0 +1,420 @@
+"""
+End-to-end benchmark of the prediction pipeline on synthetic data.
+
+Synthetic mosaics, buildings and a road based prediction mask (see
+`synthetic_data.py`) are written to a scratch data folder with the same layout as the
+real one, and every stage is timed on them:
+
+- tiling: `step_01_tile_generation.tile_images_no_labels`
+- text file: `step_02_make_text_file.make_text_file`
+- prediction: `predict.predict_and_eval` with a tiny stand-in network (or an
+    untrained HDNet with --network hdnet, to size GPUs)
+- reassembly: `step001_new_reassembling_tiles.reassemble_tiles`
+- polygonization: `step_03_polygonization.polygonize_project`
+
+For each stage the wall time, the throughput (Mpx/s of input, tiles/s), the peak RSS
+and the bytes read and written (including the worker processes) are reported as json
+in data/benchmarks/. With --calibrate the measured throughput is also written to
+`ML_prediction/project_log/benchmark_calibration.json`, which is used by
+`estimate_project_cost.py`.
+"""
+
+# %% Imports
+import os
+import json
+import time
+import shutil
+import resource
+import argparse
+import platform
+import tempfile
+from pathlib import Path
+from contextlib import contextmanager
+
+from HOME.benchmarks.synthetic_data import (
+    make_fkb_polygons,
+    make_mosaic,
+    make_road_mask,
+    mosaic_bounds,
+)
+from HOME.get_data_path import get_data_path
+from HOME.config import get_config
+
+# Get the root directory of the project
+root_dir = Path(__file__).resolve().parents[2]
+# print(root_dir)
+# get the data path (might change)
+data_path = get_data_path(root_dir)
+
+calibration_path = data_path / "ML_prediction/project_log/benchmark_calibration.json"
+
+
+# %% measuring
+def _descendants(pid: int) -> list[int]:
+    """
+    Process ids of the live children of a process and of their children (Linux).
+    """
+    parents = {}
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            # "pid (comm) state ppid ...", comm may contain spaces and brackets
+            fields = stat_path.read_text().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        parents.setdefault(int(fields[1]), []).append(int(stat_path.parent.name))
+    descendants, stack = [], [pid]
+    while stack:
+        children = parents.get(stack.pop(), [])
+        descendants.extend(children)
+        stack.extend(children)
+    return descendants
+
+
+def _read_io(pid) -> dict:
+    try:
+        with open(f"/proc/{pid}/io", "r") as f:
+            entries = dict(line.split(":") for line in f.read().splitlines())
+    except OSError:
+        return {}
+    return {
+        "read_bytes": int(entries["read_bytes"]),
+        "write_bytes": int(entries["write_bytes"]),
+    }
+
+
+def _proc_io() -> dict:
+    """
+    Bytes read from and written to storage by this process and its live child
+    processes (Linux only, else {}). Children that exited and were waited for (e.g. a
+    closed process pool) are already included in the counters of this process.
+    """
+    total = _read_io("self")
+    if not total:
+        return {}
+    for pid in _descendants(os.getpid()):
+        for key, value in _read_io(pid).items():
+            total[key] += value
+    return total
+
+
+def _reset_peak_rss() -> bool:
+    """
+    Resets the peak RSS of this process (Linux >= 4.0), so it can be read per stage.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb() -> float:
+    """
+    Peak RSS of this process in MB, since the last reset if that was possible.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024**2 if platform.system() == "Darwin" else 1024)
+
+
+def _folder_size(folder: Path) -> int:
+    return sum(f.stat().st_size for f in Path(folder).rglob("*") if f.is_file())
+
+
+@contextmanager
+def measure(results: dict, stage: str):
+    """
+    Times the block and records time, peak RSS (of this process and of the largest
+    child process, e.g. pool or DataLoader workers) and I/O in results[stage]. The I/O
+    includes the child processes, except for children that exit without being waited
+    for during the block.
+    """
+    _reset_peak_rss()
+    io_before = _proc_io()
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    io_after = _proc_io()
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    results[stage] = {
+        "seconds": seconds,
+        "peak_rss_mb": _peak_rss_mb(),
+        "peak_rss_children_mb": children_rss,
+        **{key: io_after[key] - io_before[key] for key in io_after},
+    }
+
+
+# %% stages
+def make_tiny_net(width: int = 8):
+    """
+    A tiny stand-in for HDNet with the same output format (a tuple with the logits
+    first), so prediction can be benchmarked without weights or a big GPU.
+    """
+    import torch
+
+    class TinyNet(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.layers = torch.nn.Sequential(
+                torch.nn.LazyConv2d(width, 3, padding=1),
+                torch.nn.ReLU(),
+                torch.nn.Conv2d(width, 1, 1),
+            )
+
+        def forward(self, x):
+            return (self.layers(x),)
+
+    return TinyNet()
+
+
+def make_data(bench_root: Path, project_name: str, compression: str, args) -> dict:
+    """
+    Writes the synthetic mosaics, buildings and prediction mask of the benchmark.
+    """
+    raw_dir = bench_root / f"raw/orthophoto/res_{args.res}/{project_name}/{compression}"
+    size_px = (args.size, args.size)
+    # off the tile grid like a real project (origin near Trondheim)
+    origins = [
+        (270_013.7 + k * args.size * args.res, 7_040_021.1) for k in range(args.mosaics)
+    ]
+    all_bounds = [mosaic_bounds(origin, size_px, args.res) for origin in origins]
+    bounds = (
+        min(b[0] for b in all_bounds),
+        min(b[1] for b in all_bounds),
+        max(b[2] for b in all_bounds),
+        max(b[3] for b in all_bounds),
+    )
+    area_km2 = (bounds[2] - bounds[0]) * (bounds[3] - bounds[1]) / 1e6
+    buildings = make_fkb_polygons(
+        bounds, n_buildings=int(args.buildings_per_km2 * area_km2), seed=args.seed
+    )
+    buildings.to_parquet(bench_root / "buildings.parquet")
+    for k, origin in enumerate(origins):
+        make_mosaic(
+            raw_dir / f"mosaic_{k}.tif",
+            origin,
+            size_px,
+            args.res,
+            buildings=buildings,
+            bands=1 if args.bw else 3,
+            nodata_fraction=args.nodata_fraction,
+            seed=args.seed + k,
+        )
+    _, prediction_mask = make_road_mask(
+        bounds, args.res, road_spacing=args.road_spacing, seed=args.seed
+    )
+    return {
+        "raw_dir": raw_dir,
+        "prediction_mask": prediction_mask,
+        "raw_mpx": args.mosaics * args.size**2 / 1e6,
+        "raw_bytes": _folder_size(raw_dir),
+        "n_buildings": len(buildings),
+        "masked_cells": int(prediction_mask.to_numpy().sum()),
+    }
+
+
+def run_benchmark(args) -> dict:
+    """
+    Generates the synthetic data and times all stages.
+
+    Returns:
+    - dictionary with the configuration, the data and the results per stage
+    """
+    from HOME.ML_prediction.preprocessing.step_01_tile_generation import (
+        tile_images_no_labels,
+    )
+    from HOME.ML_prediction.preprocessing.step_02_make_text_file import (
+        make_text_file,
+    )
+    from HOME.ML_prediction.postprocessing.step001_new_reassembling_tiles import (
+        reassemble_tiles,
+    )
+    from HOME.ML_prediction.postprocessing.step_03_polygonization import (
+        polygonize_project,
+    )
+
+    scratch = args.scratch or get_config().scratch_root
+    os.makedirs(scratch, exist_ok=True)
+    bench_root = Path(tempfile.mkdtemp(prefix="benchmark_", dir=scratch))
+    project_name = "benchmark_2024"
+    compression = "i_lzw_25"
+    subfolder = f"res_{args.res}/{project_name}/{compression}"
+    tile_dir = bench_root / f"ML_prediction/topredict/image/{subfolder}"
+    prediction_dir = bench_root / f"ML_prediction/predictions/{subfolder}"
+    os.makedirs(bench_root / "ML_prediction/dataset", exist_ok=True)
+
+    data = make_data(bench_root, project_name, compression, args)
+    results = {}
+    try:
+        with measure(results, "tiling"):
+            tile_images_no_labels(
+                data["raw_dir"],
+                tile_dir,
+                tile_size=512,
+                res=args.res,
+                project_name=project_name,
+                prediction_mask=data["prediction_mask"],
+            )
+        n_tiles = len(os.listdir(tile_dir))
+        results["tiling"]["mpx_per_s"] = data["raw_mpx"] / results["tiling"]["seconds"]
+        results["tiling"]["tiles_per_s"] = n_tiles / results["tiling"]["seconds"]
+        results["tiling"]["output_bytes"] = _folder_size(tile_dir)
+
+        with measure(results, "make_text_file"):
+            make_text_file(project_name, args.res, compression, data_root=bench_root)
+
+        if not args.skip_prediction:
+            import torch
+            from HOME.ML_prediction.prediction.predict import predict_and_eval
+
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            if args.network == "hdnet":
+                from ISPRS_HD_NET.model.HDNet import (  # type: ignore # noqa
+                    HighResolutionDecoupledNet,
+                )
+
+                net = HighResolutionDecoupledNet(base_channel=48, num_classes=1)
+            else:
+                net = make_tiny_net()
+            net = net.to(device).eval()
+            with measure(results, "prediction"):
+                predict_and_eval(
+                    net=net,
+                    device=device,
+                    data_dir=bench_root / "ML_prediction/",
+                    txt_name=f"pred_{project_name}_{args.res}_{compression}.txt",
+                    predict=True,
+                    prediction_folder=bench_root / "ML_prediction/predictions",
+                    image_folder="topredict/image/",
+                    Dataset="NOCI_BW" if args.bw else "NOCI",
+                    num_workers=args.num_workers,
+                    batchsize=args.batchsize,
+                    res=args.res,
+                )
+            results["prediction"]["tiles_per_s"] = (
+                n_tiles / results["prediction"]["seconds"]
+            )
+            results["prediction"]["device"] = str(device)
+            results["prediction"]["network"] = args.network
+        else:
+            # no torch: the input tiles stand in for the predictions
+            shutil.copytree(tile_dir, prediction_dir)
+
+        with measure(results, "reassembly"):
+            large_tile_dir = bench_root / "ML_prediction/reassembled_tiles"
+            os.makedirs(large_tile_dir, exist_ok=True)
+            reassemble_tiles(
+                [str(tile) for tile in prediction_dir.glob("*.tif")],
+                n_tiles_edge=args.n_tiles_edge,
+                n_overlap=1,
+                tile_size=512,
+                res=args.res,
+                large_tile_loc=large_tile_dir,
+                project_name=project_name,
+                project_details={"channels": "RGB", "resolution": args.res},
+                save_path=large_tile_dir,
+            )
+        results["reassembly"]["tiles_per_s"] = (
+            n_tiles / results["reassembly"]["seconds"]
+        )
+        results["reassembly"]["output_bytes"] = _folder_size(large_tile_dir)
+
+        with measure(results, "polygonization"):
+            polygons = polygonize_project(
+                project_name,
+                args.res,
+                compression,
+                n_workers=args.num_workers,
+                data_root=bench_root,
+            )
+        results["polygonization"]["tiles_per_s"] = (
+            n_tiles / results["polygonization"]["seconds"]
+        )
+        results["polygonization"]["n_polygons"] = len(polygons)
+    finally:
+        if not args.keep:
+            shutil.rmtree(bench_root, ignore_errors=True)
+
+    data = {k: v for k, v in data.items() if k not in ("raw_dir", "prediction_mask")}
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "cpu_count": os.cpu_count(),
+        "config": vars(args),
+        "data": {**data, "n_tiles": n_tiles},
+        "stages": results,
+        "notes": {
+            "io": "read_bytes/write_bytes of /proc/<pid>/io, summed over this process "
+            "and its child processes; only bytes that reach the storage layer are "
+            "counted, reads served from the page cache are not",
+        },
+    }
+
+
+def calibration_from_benchmark(benchmark: dict) -> dict:
+    """
+    Throughput values for `estimate_project_cost.load_calibration`. The inference
+    speed of the tiny network says nothing about HDNet, so it is only included for
+    --network hdnet.
+    """
+    stages = benchmark["stages"]
+    calibration = {
+        "tiling_mpx_per_s": stages["tiling"]["mpx_per_s"],
+        "polygonization_tiles_per_s": stages["polygonization"]["tiles_per_s"],
+    }
+    if "prediction" in stages and stages["prediction"]["network"] == "hdnet":
+        calibration["inference_tiles_per_s"] = stages["prediction"]["tiles_per_s"]
+    return calibration
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the prediction pipeline on synthetic mosaics"
+    )
+    parser.add_argument("--res", required=False, type=float, default=0.3)
+    parser.add_argument("--size", required=False, type=int, default=4096)
+    parser.add_argument("--mosaics", required=False, type=int, default=2)
+    parser.add_argument("--bw", action="store_true")
+    parser.add_argument("--nodata_fraction", required=False, type=float, default=0.1)
+    parser.add_argument("--buildings_per_km2", required=False, type=int, default=800)
+    parser.add_argument("--road_spacing", required=False, type=float, default=300)
+    parser.add_argument(
+        "--skip_prediction",
+        action="store_true",
+        help="time the other stages without torch/ISPRS_HD_NET",
+    )
+    parser.add_argument(
+        "--network", required=False, choices=["tiny", "hdnet"], default="tiny"
+    )
+    parser.add_argument("--batchsize", required=False, type=int, default=16)
+    parser.add_argument("--num_workers", required=False, type=int, default=4)
+    parser.add_argument("--n_tiles_edge", required=False, type=int, default=4)
+    parser.add_argument("--seed", required=False, type=int, default=0)
+    parser.add_argument("--scratch", required=False, type=str, default=None)
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic data")
+    parser.add_argument("--calibrate", action="store_true")
+    args = parser.parse_args()
+
+    benchmark = run_benchmark(args)
+    output_dir = data_path / "benchmarks"
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = output_dir / f"benchmark_{time.strftime('%Y%m%d%H%M%S')}.json"
+    with open(output_path, "w") as f:
+        json.dump(benchmark, f, indent=4, default=str)
+    print(json.dumps(benchmark["stages"], indent=4))
+    print(f"Saved to {output_path}")
+
+    if args.calibrate:
+        os.makedirs(calibration_path.parent, exist_ok=True)
+        with open(calibration_path, "w") as f:
+            json.dump(calibration_from_benchmark(benchmark), f, indent=4)
+        print(f"Saved calibration to {calibration_path}")
@@ -0,0 +1,226 @@
+"""
+Synthetic data for the benchmarks, so the pipeline can be timed without real
+Norge i bilder orthophotos.
+
+- `make_fkb_polygons`: random rotated rectangles with FKB-like attributes
+- `make_mosaic`: an EPSG:25833 GeoTIFF mosaic (RGB or BW) with textured ground, the
+    buildings burnt in and a share of nodata (black) columns, placed off the tile
+    grid like a real project
+- `make_road_mask`: a road network and the prediction mask (grid cells touching a
+    road) in the format of `ML_prediction/prediction_mask/prediction_mask_<res>.csv`
+"""
+
+# %% Imports
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+from rasterio.features import geometry_mask, rasterize
+from rasterio.transform import from_origin, from_bounds
+from shapely import affinity
+from shapely.geometry import LineString, box
+
+crs = "EPSG:25833"
+
+
+# %% function definitions
+def mosaic_bounds(
+    origin: tuple[float, float], size_px: tuple[int, int], res: float
+) -> tuple[float, float, float, float]:
+    """
+    Bounds (left, bottom, right, top) of a mosaic with top left corner origin.
+    """
+    left, top = origin
+    width, height = size_px
+    return left, top - height * res, left + width * res, top
+
+
+def make_fkb_polygons(
+    bounds: tuple[float, float, float, float],
+    n_buildings: int = 500,
+    min_size: float = 6,
+    max_size: float = 40,
+    seed: int = 0,
+) -> gpd.GeoDataFrame:
+    """
+    Random rotated rectangles as stand-ins for FKB building polygons.
+
+    Arguments:
+    - bounds: (left, bottom, right, top) to place the buildings in
+    - n_buildings: number of buildings
+    - min_size, max_size: range of the side lengths in m
+    - seed: seed of the random generator
+
+    Returns:
+    - GeoDataFrame with bygningsnummer, bygningstype and the polygons
+    """
+    rng = np.random.default_rng(seed)
+    left, bottom, right, top = bounds
+    centers_x = rng.uniform(left + max_size, right - max_size, n_buildings)
+    centers_y = rng.uniform(bottom + max_size, top - max_size, n_buildings)
+    sizes = rng.uniform(min_size, max_size, (n_buildings, 2))
+    angles = rng.uniform(0, 90, n_buildings)
+    geometries = [
+        affinity.rotate(box(x - w / 2, y - h / 2, x + w / 2, y + h / 2), angle)
+        for x, y, (w, h), angle in zip(centers_x, centers_y, sizes, angles)
+    ]
+    return gpd.GeoDataFrame(
+        {
+            "bygningsnummer": np.arange(n_buildings, dtype=np.int64) + 1,
+            "bygningstype": rng.choice([111, 121, 131, 211, 311], n_buildings),
+        },
+        geometry=geometries,
+        crs=crs,
+    )
+
+
+def make_mosaic(
+    path: Path,
+    origin: tuple[float, float],
+    size_px: tuple[int, int],
+    res: float,
+    buildings: gpd.GeoDataFrame = None,
+    bands: int = 3,
+    nodata_fraction: float = 0.1,
+    compress: str = "lzw",
+    seed: int = 0,
+) -> Path:
+    """
+    Writes a synthetic orthophoto mosaic as GeoTIFF.
+
+    Arguments:
+    - path: output path
+    - origin: (x, y) of the top left corner in EPSG:25833
+    - size_px: (width, height) in pixels
+    - res: resolution in m
+    - buildings: polygons burnt in as bright roofs (optional)
+    - bands: 3 (RGB) or 1 (BW)
+    - nodata_fraction: share of columns on the right side that are black
+    - compress: compression of the GeoTIFF
+    - seed: seed of the random generator
+
+    Returns:
+    - path of the mosaic
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size_px
+    transform = from_origin(origin[0], origin[1], res, res)
+
+    # smooth ground texture: upsampled noise plus some fine grain
+    coarse = rng.integers(40, 140, (height // 64 + 1, width // 64 + 1, 3), np.uint8)
+    image = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+    image = cv2.add(image, rng.integers(0, 20, image.shape, np.uint8))
+
+    if buildings is not None and len(buildings):
+        roofs = rasterize(
+            ((geometry, 1) for geometry in buildings.geometry),
+            out_shape=(height, width),
+            transform=transform,
+            dtype=np.uint8,
+        ).astype(bool)
+        image[roofs] = rng.integers(170, 230, 3, np.uint8)
+
+    n_nodata = int(width * nodata_fraction)
+    if n_nodata:
+        image[:, width - n_nodata :] = 0
+
+    if bands == 1:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)[..., None]
+
+    os.makedirs(Path(path).parent, exist_ok=True)
+    profile = {
+        "driver": "GTiff",
+        "dtype": "uint8",
+        "count": bands,
+        "width": width,
+        "height": height,
+        "crs": crs,
+        "transform": transform,
+        "compress": compress,
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(np.moveaxis(image, -1, 0))
+    return Path(path)
+
+
+def make_road_mask(
+    bounds: tuple[float, float, float, float],
+    res: float,
+    tile_size: int = 512,
+    road_spacing: float = 300,
+    road_width: float = 8,
+    seed: int = 0,
+) -> tuple[gpd.GeoDataFrame, pd.DataFrame]:
+    """
+    A grid of slightly bent roads and the prediction mask of the tile grid cells
+    touching a road (like `step_00_road_grid.road_grid` without the dilation).
+
+    Arguments:
+    - bounds: (left, bottom, right, top) of the area
+    - res: resolution of the tile grid
+    - tile_size: tile size in pixels
+    - road_spacing: distance between roads in m
+    - road_width: width of the roads in m
+    - seed: seed of the random generator
+
+    Returns:
+    - GeoDataFrame with the road polygons
+    - prediction mask (index grid_y, columns grid_x, True where tiles are predicted)
+    """
+    rng = np.random.default_rng(seed)
+    left, bottom, right, top = bounds
+    roads = []
+    for x in np.arange(left + road_spacing / 2, right, road_spacing):
+        bend = rng.uniform(-road_spacing / 4, road_spacing / 4)
+        roads.append(
+            LineString([(x, bottom), (x + bend, (bottom + top) / 2), (x, top)])
+        )
+    for y in np.arange(bottom + road_spacing / 2, top, road_spacing):
+        bend = rng.uniform(-road_spacing / 4, road_spacing / 4)
+        roads.append(
+            LineString([(left, y), ((left + right) / 2, y + bend), (right, y)])
+        )
+    roads = gpd.GeoDataFrame(
+        geometry=[road.buffer(road_width / 2) for road in roads], crs=crs
+    )
+
+    grid_size_m = res * tile_size
+    min_grid_x = int(np.floor(left / grid_size_m))
+    max_grid_x = int(np.ceil(right / grid_size_m))
+    min_grid_y = int(np.floor(bottom / grid_size_m))
+    max_grid_y = int(np.ceil(top / grid_size_m))
+    n_x, n_y = max_grid_x - min_grid_x, max_grid_y - min_grid_y
+    mask = geometry_mask(
+        roads.geometry.to_list(),
+        transform=from_bounds(
+            min_grid_x * grid_size_m,
+            min_grid_y * grid_size_m,
+            max_grid_x * grid_size_m,
+            max_grid_y * grid_size_m,
+            n_x,
+            n_y,
+        ),
+        out_shape=(n_y, n_x),
+        invert=True,
+        all_touched=True,
+    )
+    # row k of the mask is the cell with top edge max_grid_y - k (the tile name)
+    prediction_mask = pd.DataFrame(
+        mask,
+        index=np.arange(max_grid_y, min_grid_y, -1),
+        columns=np.arange(min_grid_x, max_grid_x),
+    )
+    # pad by one cell, tiling reaches one cell beyond the bounds of the mosaic
+    prediction_mask = prediction_mask.reindex(
+        index=np.arange(max_grid_y + 1, min_grid_y - 1, -1),
+        columns=np.arange(min_grid_x - 1, max_grid_x + 1),
+        fill_value=False,
+    )
+    return roads, prediction_mask
@@ -0,0 +1,160 @@
+"""
+Command line entry point for the stages of the project:
+
+    python -m HOME <command> [arguments of the command]
+    demolition <command> ...            (after `pip install -e .`)
+
+Every command runs the `__main__` block of its module, so the arguments are the same
+as when running the script directly (`python -m HOME predict --help`). The module is
+only imported when its command runs, so `--help` and `status` start without torch,
+GDAL or geopandas. Options before the command configure the paths and worker
+counts for all stages (see `HOME.config`), e.g.
+
+    python -m HOME --fast_root /nvme/demolition pipeline --projects trondheim_2019
+"""
+
+import os
+import sys
+import json
+import runpy
+import argparse
+
+from HOME.config import add_config_arguments, configure_from_args
+
+# command: (module, description)
+commands = {
+    # prediction
+    "pipeline": (
+        "HOME.ML_prediction.pipeline",
+        "tile, predict and polygonize projects with overlapping stages",
+    ),
+    "tile": (
+        "HOME.ML_prediction.preprocessing.step_01_tile_generation",
+        "tile the orthophotos of a project for prediction",
+    ),
+    "text-file": (
+        "HOME.ML_prediction.preprocessing.step_02_make_text_file",
+        "write the list of tiles to predict",
+    ),
+    "predict": ("HOME.ML_prediction.prediction.predict", "predict a tiled project"),
+    "polygonize": (
+        "HOME.ML_prediction.postprocessing.step_03_polygonization",
+        "polygonize the predictions of a project",
+    ),
+    "rethreshold": (
+        "HOME.ML_prediction.postprocessing.step_04_rethreshold",
+        "re-threshold or ensemble stored probabilities without the network",
+    ),
+    "label-tiles": (
+        "HOME.ML_prediction.preprocessing.label_tiling",
+        "rasterize FKB labels on the prediction grid",
+    ),
+    # data acquisition
+    "estimate-cost": (
+        "HOME.data_acquisition.norgeibilder.estimate_project_cost",
+        "estimate download volume and processing time of queued projects",
+    ),
+    "download": (
+        "HOME.data_acquisition.norgeibilder.download_orthophotos",
+        "download all finished orthophoto exports",
+    ),
+    "fetch-buildings": (
+        "HOME.data_acquisition.matrikkel.fetch_buildings",
+        "fetch the buildings of municipalities from the matrikkel",
+    ),
+    "building-table": (
+        "HOME.data_acquisition.matrikkel.building_table",
+        "build the matrikkel building table",
+    ),
+    # visualization
+    "coverage-cogs": (
+        "HOME.visualization.orthophoto_metadata.project_density_maps",
+        "plot the orthophoto coverage, or export it as COGs (--export_cogs)",
+    ),
+    # training
+    "train-tiles": (
+        "HOME.ML_training.preprocessing.step_03_tile_generation",
+        "cut the training images and labels into tiles",
+    ),
+    "split": (
+        "HOME.ML_training.preprocessing.step_04_dataset_splitting",
+        "split the training tiles into train/val/test",
+    ),
+    "distance-map": (
+        "HOME.ML_training.preprocessing.step_05_distance_map",
+        "compute the boundary distance maps of the labels",
+    ),
+    "mean-std": (
+        "HOME.ML_training.preprocessing.step_06_mean_std_calculation",
+        "compute the channel statistics of the training set",
+    ),
+    "radiometric-matching": (
+        "HOME.ML_training.preprocessing.radiometric_matching",
+        "match the radiometry of a folder of images to a reference",
+    ),
+    "pack-shards": (
+        "HOME.ML_training.preprocessing.step_07_shard_packing",
+        "pack a split into memory mapped shards",
+    ),
+    "train": ("HOME.ML_training.training.train", "train HDNet"),
+    # benchmarks
+    "benchmark": (
+        "HOME.benchmarks.run_benchmarks",
+        "benchmark the pipeline on synthetic mosaics",
+    ),
+}
+
+
+def status() -> None:
+    """
+    Prints the status and pipeline stage of all projects (only reads the json logs).
+    """
+    from HOME.config import get_config
+
+    project_log = get_config().data_root / "ML_prediction/project_log"
+    with open(project_log / "project_details.json", "r") as file:
+        project_details = json.load(file)
+    pipeline_state = {}
+    if os.path.exists(project_log / "pipeline_state.json"):
+        with open(project_log / "pipeline_state.json", "r") as file:
+            pipeline_state = json.load(file)
+
+    width = max([len(name) for name in project_details] + [7])
+    print(f"{'project':<{width}}  {'status':<12}  {'pipeline':<12}  error")
+    for project_name, details in sorted(project_details.items()):
+        state = pipeline_state.get(project_name, {})
+        print(
+            f"{project_name:<{width}}  {details.get('status', ''):<12}  "
+            + f"{state.get('completed') or '':<12}  {state.get('error') or ''}"
+        )
+
+
+def main(argv: list = None) -> None:
+    epilog = "commands:\n" + "\n".join(
+        f"  {name:<22}{description}" for name, (_, description) in commands.items()
+    )
+    epilog += f"\n  {'status':<22}show the status of all projects"
+    parser = argparse.ArgumentParser(
+        prog="demolition",
+        description="Run a stage of the demolition footprints project",
+        epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    add_config_arguments(parser)
+    parser.add_argument("command", choices=[*commands, "status"], metavar="command")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    # before any stage module is imported, they read the paths on import
+    configure_from_args(args)
+
+    if args.command == "status":
+        status()
+        return
+    module, _ = commands[args.command]
+    sys.argv = [f"demolition {args.command}", *args.args]
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Central configuration of paths and worker counts, resolved once per process.
+
+Sources, later ones win:
+1. defaults: the data folder named in HOME/data_path.txt (like before), all other
+    roots derived from it
+2. a json config file: $DEMOLITION_CONFIG, or HOME/config.json if it exists
+3. environment variables: DEMOLITION_DATA_ROOT, DEMOLITION_FAST_ROOT,
+    DEMOLITION_SCRATCH_ROOT, DEMOLITION_CPU_WORKERS, DEMOLITION_IO_WORKERS,
+    DEMOLITION_LOADER_WORKERS
+4. `configure(...)`, e.g. from command line arguments (see `add_config_arguments`)
+
+Roots:
+- data_root: the data folder (`data_path` in all modules), on the shared bulk
+    storage that holds the raw data and the outputs
+- fast_root: local disk (e.g. NVMe) for hot intermediates like the tiles to
+    predict; it mirrors the layout of the data folder (defaults to data_root)
+- scratch_root: temporary files, e.g. benchmark data (defaults to data_root/temp)
+
+Most modules compute `data_path` when they are imported, so `configure` has to be
+called before they are imported; environment variables and the file always work.
+"""
+
+import os
+import json
+import argparse
+from pathlib import Path
+from dataclasses import dataclass, fields
+
+root_dir = Path(__file__).resolve().parents[1]
+
+_config = None
+_overrides = {}
+
+
+@dataclass(frozen=True)
+class Config:
+    root_dir: Path
+    data_root: Path
+    fast_root: Path
+    scratch_root: Path
+    cpu_workers: int
+    io_workers: int
+    loader_workers: int
+
+    def bulk(self, relative: str) -> Path:
+        """
+        Path on the bulk storage (raw data, predictions, outputs).
+        """
+        return self.data_root / relative
+
+    def fast(self, relative: str) -> Path:
+        """
+        Path on the fast local storage (tiles and other hot intermediates).
+        """
+        return self.fast_root / relative
+
+
+def _data_root_from_txt() -> Path:
+    """
+    The data folder named in HOME/data_path.txt (relative to the repository).
+    """
+    try:
+        with open(root_dir / "HOME/data_path.txt", "r") as file:
+            mode = file.read().strip()
+    except IOError:
+        print("cannot accss the dat_path.txt file - falling back to default (data)")
+        mode = "data"
+    return root_dir / mode
+
+
+def _load_file() -> dict:
+    config_file = os.environ.get("DEMOLITION_CONFIG", root_dir / "HOME/config.json")
+    if not Path(config_file).exists():
+        return {}
+    with open(config_file, "r") as file:
+        return json.load(file)
+
+
+def _load_env() -> dict:
+    entries = {}
+    for field in fields(Config):
+        value = os.environ.get(f"DEMOLITION_{field.name.upper()}")
+        if value is not None and field.name != "root_dir":
+            entries[field.name] = value
+    return entries
+
+
+def _build(entries: dict) -> Config:
+    data_root = Path(entries.get("data_root") or _data_root_from_txt())
+    if not data_root.is_absolute():
+        data_root = root_dir / data_root
+
+    def root(name, default):
+        return Path(entries[name]) if entries.get(name) else default
+
+    return Config(
+        root_dir=root_dir,
+        data_root=data_root,
+        fast_root=root("fast_root", data_root),
+        scratch_root=root("scratch_root", data_root / "temp"),
+        cpu_workers=int(entries.get("cpu_workers") or os.cpu_count() or 1),
+        io_workers=int(entries.get("io_workers") or 8),
+        loader_workers=int(entries.get("loader_workers") or 8),
+    )
+
+
+def get_config() -> Config:
+    """
+    The configuration of this process (resolved on the first call).
+    """
+    global _config
+    if _config is None:
+        _config = _build({**_load_file(), **_load_env(), **_overrides})
+    return _config
+
+
+def configure(**overrides) -> Config:
+    """
+    Overrides entries of the configuration (None values are ignored), e.g.
+    configure(data_root="/data", fast_root="/nvme/demolition").
+    """
+    global _config
+    unknown = set(overrides) - {field.name for field in fields(Config)}
+    if unknown:
+        raise ValueError(f"Unknown config entries: {unknown}")
+    _overrides.update({k: v for k, v in overrides.items() if v is not None})
+    # resolved again, so the derived roots follow an overridden data_root
+    _config = None
+    return get_config()
+
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Adds --data_root, --fast_root, --scratch_root and the worker counts to a parser;
+    pass the parsed arguments to `configure_from_args`.
+    """
+    group = parser.add_argument_group("configuration")
+    for name in ("data_root", "fast_root", "scratch_root"):
+        group.add_argument(f"--{name}", required=False, type=str, default=None)
+    for name in ("cpu_workers", "io_workers", "loader_workers"):
+        group.add_argument(f"--{name}", required=False, type=int, default=None)
+
+
+def configure_from_args(args: argparse.Namespace) -> Config:
+    return configure(
+        **{
+            field.name: getattr(args, field.name, None)
+            for field in fields(Config)
+            if field.name != "root_dir"
+        }
+    )
+
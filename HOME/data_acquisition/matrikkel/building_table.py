@@ -0,0 +1,162 @@
+"""
+Builds one table of all buildings in the matrikkel from the municipality pickles.
+
+The pickles (one per municipality, or the parts written by `fetch_buildings.py`) are
+unpickled in parallel and flattened into a columnar table with one row per building:
+- bygningsnummer (index)
+- kommune: municipality number from the file name
+- first_status_year: earliest year in the status history (like
+    `building_cohort.extract_cohorts_from_building`, missing if there is none)
+- status_years, status_codes: all events of the status history, sorted by date
+
+The table is saved as Parquet and can be joined to the FKB polygons on
+`bygningsnummer` (e.g. `fkb.join(table, on="bygningsnummer")`).
+"""
+
+# %% Imports
+import os
+import pickle
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from HOME.get_data_path import get_data_path
+
+# Get the root directory of the project
+root_dir = Path(__file__).resolve().parents[3]
+# print(root_dir)
+# get the data path (might change)
+data_path = get_data_path(root_dir)
+
+building_table_path = data_path / "raw/matrikkel/building_table.parquet"
+
+
+# %% function definitions
+def _get(obj, *keys):
+    """
+    Nested access on suds objects or the dicts of `fetch_buildings.py`, None if any
+    level is missing.
+    """
+    for key in keys:
+        obj = obj.get(key) if isinstance(obj, dict) else getattr(obj, key, None)
+        if obj is None:
+            return None
+    return obj
+
+
+def building_events(building) -> tuple[list, list]:
+    """
+    Years and status codes of the status history of a building, sorted by date.
+    Events without a date are skipped.
+    """
+    events = []
+    for b_history in _get(building, "bygningsstatusHistorikker", "item") or []:
+        b_datetime = _get(b_history, "dato", "date")
+        if b_datetime is None:
+            continue
+        status = _get(b_history, "bygningsstatusKodeId", "value")
+        events.append((b_datetime, -1 if status is None else int(status)))
+    events.sort(key=lambda event: event[0])
+    return [event[0].year for event in events], [event[1] for event in events]
+
+
+def municipality_pickle_to_table(pickle_path: Path) -> pd.DataFrame:
+    """
+    Flattens the buildings of a municipality pickle into a table (run in a worker).
+    """
+    with open(pickle_path, "rb") as f:
+        description, buildings = pickle.load(f)
+    items = _get(buildings, "item") or []
+    building_numbers = np.empty(len(items), dtype=np.int64)
+    status_years, status_codes = [], []
+    for i, building in enumerate(items):
+        building_numbers[i] = int(building["bygningsnummer"])
+        years, codes = building_events(building)
+        status_years.append(years)
+        status_codes.append(codes)
+    first_years = pd.array(
+        [min(years) if years else None for years in status_years], dtype="Int16"
+    )
+    return pd.DataFrame(
+        {
+            "bygningsnummer": building_numbers,
+            "kommune": Path(pickle_path).name.split("_")[0],
+            "first_status_year": first_years,
+            "status_years": status_years,
+            "status_codes": status_codes,
+            "source": Path(pickle_path).name,
+        }
+    )
+
+
+def build_building_table(
+    pickle_dir: Path = None,
+    output_path: Path = None,
+    n_workers: int = None,
+) -> pd.DataFrame:
+    """
+    Builds the building table from all municipality pickles and saves it as Parquet.
+    If a building is in several pickles, the row from the most recently written pickle
+    (the latest fetch) is kept.
+
+    Arguments:
+    - pickle_dir: folder with the pickles (default raw/matrikkel/municipality_pickles)
+    - output_path: path of the Parquet file, defaults to `building_table_path`
+    - n_workers: number of worker processes (default: all cores)
+
+    Returns:
+    - the table, indexed by bygningsnummer
+    """
+    if pickle_dir is None:
+        pickle_dir = data_path / "raw/matrikkel/municipality_pickles"
+    if output_path is None:
+        output_path = building_table_path
+    # whole municipality pickles and the parts of fetch_buildings.py in subfolders
+    pickle_paths = sorted(Path(pickle_dir).glob("**/*.pkl"), key=os.path.getmtime)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        tables = list(
+            tqdm(
+                executor.map(municipality_pickle_to_table, pickle_paths),
+                total=len(pickle_paths),
+                desc="Reading municipality pickles",
+            )
+        )
+    table = pd.concat(tables, ignore_index=True)
+    table = table.drop_duplicates("bygningsnummer", keep="last")
+    table = table.set_index("bygningsnummer").sort_index()
+    table["kommune"] = table["kommune"].astype("category")
+
+    os.makedirs(Path(output_path).parent, exist_ok=True)
+    table.to_parquet(output_path)
+    return table
+
+
+def load_building_table(path: Path = None, columns: list = None) -> pd.DataFrame:
+    """
+    Loads the building table (indexed by bygningsnummer).
+
+    Arguments:
+    - path: path of the Parquet file, defaults to `building_table_path`
+    - columns: columns to read (e.g. ["first_status_year"])
+    """
+    if path is None:
+        path = building_table_path
+    return pd.read_parquet(path, columns=columns)
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the matrikkel building table from the municipality pickles"
+    )
+    parser.add_argument("--pickle_dir", required=False, type=str, default=None)
+    parser.add_argument("--output", required=False, type=str, default=None)
+    parser.add_argument("--n_workers", required=False, type=int, default=None)
+    args = parser.parse_args()
+    table = build_building_table(args.pickle_dir, args.output, args.n_workers)
+    print(f"{len(table)} buildings, {table['first_status_year'].notna().sum()} dated")
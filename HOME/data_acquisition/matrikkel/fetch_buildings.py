@@ -0,0 +1,320 @@
+"""
+Fetches the building objects of municipalities from the matrikkel API.
+
+A pool of authenticated (BygningService, StoreService) client pairs is shared by a
+thread pool: for every municipality the building ids are fetched once
+(`findByggForKommune`), and the objects are fetched in concurrent batches
+(`getObjects`). Every call is rate limited, and calls that failed on the way (transport
+errors, timeouts, HTTP 429/5xx) are retried with exponential backoff; SOAP faults and
+authentication errors are raised at once. The
+batches are streamed to disk as part pickles
+`municipality_pickles/{kommune}/{kommune}_part_{k:05d}.pkl`, each a
+(description, objects) tuple with the objects as nested dicts, so an interrupted pull
+continues where it stopped and `building_table.py` reads the parts directly.
+
+The parsed WSDLs are cached (see `prepare_clients.make_client`), and `base_url` can
+point to a local SOAP stub for testing (`soap_stub.py`).
+"""
+
+# %% Imports
+import os
+import time
+import queue
+import pickle
+import argparse
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from suds import WebFault
+from suds.sudsobject import Object, asdict
+from suds.transport import TransportError
+from tqdm import tqdm
+
+from HOME.ML_training.preprocessing.get_label_data.prepare_clients import (
+    make_client,
+    matrikkel_url,
+    default_wsdl_cache_dir,
+)
+from HOME.ML_training.preprocessing.get_label_data.prepare_matrikkel_objects import (
+    prepare_matrikkel_context,
+    prepare_Kommune,
+)
+from HOME.get_data_path import get_data_path
+from HOME.utils.metrics import metrics
+
+# Get the root directory of the project
+root_dir = Path(__file__).resolve().parents[3]
+# print(root_dir)
+# get the data path (might change)
+data_path = get_data_path(root_dir)
+
+# HTTP status codes of failures that may go away when the call is repeated
+transient_status = (408, 429, 500, 502, 503, 504)
+
+
+# %% helpers
+class RateLimiter:
+    """
+    Allows at most `rate` calls per second over all threads.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ClientPool:
+    """
+    Pool of (BygningService, StoreService) client pairs with their matrikkel context.
+    A client is only used by one thread at a time.
+
+    Arguments:
+    - username, password: matrikkel credentials
+    - n_clients: number of client pairs
+    - matrikkel_version: timestamp of the matrikkel snapshot
+    - client_purpose: identification of the client towards the matrikkel
+    - base_url: matrikkel.no or the url of a local stub
+    - wsdl_cache_dir: folder for the parsed WSDLs
+    """
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        n_clients: int = 4,
+        matrikkel_version: str = "9999-01-01T00:00:00+01:00",
+        client_purpose: str = "demolition_footprints",
+        base_url: str = matrikkel_url,
+        wsdl_cache_dir: Path = default_wsdl_cache_dir,
+    ):
+        self.clients = queue.Queue()
+        for _ in range(n_clients):
+            client_buildings = make_client(
+                "BygningService", username, password, base_url, wsdl_cache_dir
+            )
+            client_objects = make_client(
+                "StoreService", username, password, base_url, wsdl_cache_dir
+            )
+            _, context_buildings = prepare_matrikkel_context(
+                matrikkel_version, client_purpose, client_buildings
+            )
+            _, context_objects = prepare_matrikkel_context(
+                matrikkel_version, client_purpose, client_objects
+            )
+            self.clients.put(
+                (client_buildings, context_buildings, client_objects, context_objects)
+            )
+
+    @contextmanager
+    def acquire(self):
+        clients = self.clients.get()
+        try:
+            yield clients
+        finally:
+            self.clients.put(clients)
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Whether a failed call may succeed when repeated: transport errors, timeouts and
+    HTTP 408/429/5xx. SOAP faults (e.g. bad arguments), authentication errors and
+    WSDL errors are not.
+    """
+    if isinstance(error, WebFault):
+        return False
+    if isinstance(error, TransportError):
+        return error.httpcode in transient_status
+    if isinstance(error, OSError):
+        # connection refused or reset, timeouts (urllib.error.URLError is an OSError)
+        return True
+    # suds raises Exception((status, reason)) for HTTP errors without a SOAP fault
+    status = error.args[0] if len(error.args) == 1 else None
+    return (
+        type(error) is Exception
+        and isinstance(status, tuple)
+        and status[0] in transient_status
+    )
+
+
+def call_with_retry(
+    func, *args, rate_limiter: RateLimiter = None, retries: int = 5, backoff: float = 2
+):
+    """
+    Calls func(*args), retrying transient failures (see `is_transient`) with
+    exponential backoff. Other errors are raised at once.
+    """
+    for attempt in range(retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            return func(*args)
+        except Exception as e:  # noqa
+            if attempt == retries or not is_transient(e):
+                raise
+            wait = backoff**attempt
+            metrics.inc("retries", stage="matrikkel")
+            print(f"Call failed ({e}), retrying in {wait:.0f} s")
+            time.sleep(wait)
+
+
+def to_builtin(obj):
+    """
+    Suds object as nested dicts and lists. The suds classes are created at runtime
+    and cannot be pickled.
+    """
+    if isinstance(obj, Object):
+        return {key: to_builtin(value) for key, value in asdict(obj).items()}
+    if isinstance(obj, list):
+        return [to_builtin(value) for value in obj]
+    return obj
+
+
+def write_part(path: Path, description: str, objects) -> None:
+    """
+    Pickles a part (written to a temporary file and renamed, so no broken parts).
+    """
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        pickle.dump((description, to_builtin(objects)), f)
+    os.replace(tmp_path, path)
+
+
+# %% fetching
+def fetch_building_ids(pool: ClientPool, kommune: str, **retry_kwargs) -> list:
+    """
+    Ids of all buildings in a municipality.
+    """
+    with pool.acquire() as (client_buildings, context_buildings, _, _):
+        kommune_id = prepare_Kommune(kommune, client_buildings)
+        ids = call_with_retry(
+            client_buildings.service.findByggForKommune,
+            kommune_id,
+            context_buildings,
+            **retry_kwargs,
+        )
+    return list(getattr(ids, "item", None) or [])
+
+
+def fetch_objects(pool: ClientPool, ids: list, **retry_kwargs):
+    """
+    Objects of a batch of ids from the StoreService.
+    """
+    with pool.acquire() as (_, _, client_objects, context_objects):
+        return call_with_retry(
+            client_objects.service.getObjects,
+            {"item": ids},
+            context_objects,
+            **retry_kwargs,
+        )
+
+
+def fetch_municipality(
+    pool: ClientPool,
+    executor: ThreadPoolExecutor,
+    kommune: str,
+    output_dir: Path,
+    batch_size: int = 1000,
+    **retry_kwargs,
+) -> int:
+    """
+    Fetches all buildings of a municipality in concurrent batches and writes them as
+    part pickles. Parts that exist already are skipped.
+
+    Returns:
+    - number of parts written
+    """
+    kommune_dir = Path(output_dir) / kommune
+    os.makedirs(kommune_dir, exist_ok=True)
+    ids = fetch_building_ids(pool, kommune, **retry_kwargs)
+    batches = [ids[i : i + batch_size] for i in range(0, len(ids), batch_size)]
+
+    def fetch_part(k, batch):
+        path = kommune_dir / f"{kommune}_part_{k:05d}.pkl"
+        if path.exists():
+            return 0
+        with metrics.timer("request_seconds", stage="matrikkel"):
+            objects = fetch_objects(pool, batch, **retry_kwargs)
+        description = (
+            f"{kommune}: buildings {k * batch_size} to {k * batch_size + len(batch)} "
+            + f"of {len(ids)}, fetched {time.strftime('%Y-%m-%d %H:%M')}"
+        )
+        write_part(path, description, objects)
+        metrics.inc("parts_written", stage="matrikkel")
+        metrics.inc("buildings_fetched", len(batch), stage="matrikkel")
+        return 1
+
+    written = 0
+    futures = [executor.submit(fetch_part, k, batch) for k, batch in enumerate(batches)]
+    for future in tqdm(futures, desc=f"Kommune {kommune}", leave=False):
+        written += future.result()
+    return written
+
+
+def fetch_buildings(
+    kommuner: list,
+    username: str,
+    password: str,
+    output_dir: Path = None,
+    n_clients: int = 4,
+    batch_size: int = 1000,
+    rate: float = 10,
+    retries: int = 5,
+    base_url: str = matrikkel_url,
+) -> None:
+    """
+    Fetches the buildings of several municipalities.
+
+    Arguments:
+    - kommuner: municipality numbers (e.g. ["5001"])
+    - username, password: matrikkel credentials
+    - output_dir: folder for the parts, defaults to raw/matrikkel/municipality_pickles
+    - n_clients: number of clients (and concurrent requests)
+    - batch_size: number of buildings per getObjects call (and part)
+    - rate: maximum number of calls per second
+    - retries: retries per call
+    - base_url: matrikkel.no, or the url of a local stub
+    """
+    if output_dir is None:
+        output_dir = data_path / "raw/matrikkel/municipality_pickles"
+    pool = ClientPool(username, password, n_clients, base_url=base_url)
+    retry_kwargs = {"rate_limiter": RateLimiter(rate), "retries": retries}
+    with ThreadPoolExecutor(max_workers=n_clients) as executor:
+        for kommune in tqdm(kommuner, desc="Municipalities"):
+            fetch_municipality(
+                pool, executor, kommune, output_dir, batch_size, **retry_kwargs
+            )
+    return
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch buildings from the matrikkel")
+    parser.add_argument("--kommuner", nargs="+", required=True, type=str)
+    parser.add_argument("--output_dir", required=False, type=str, default=None)
+    parser.add_argument("--n_clients", required=False, type=int, default=4)
+    parser.add_argument("--batch_size", required=False, type=int, default=1000)
+    parser.add_argument("--rate", required=False, type=float, default=10)
+    parser.add_argument("--base_url", required=False, type=str, default=matrikkel_url)
+    args = parser.parse_args()
+
+    fetch_buildings(
+        args.kommuner,
+        os.environ["MATRIKKEL_USERNAME"],
+        os.environ["MATRIKKEL_PASSWORD"],
+        output_dir=args.output_dir,
+        n_clients=args.n_clients,
+        batch_size=args.batch_size,
+        rate=args.rate,
+        base_url=args.base_url,
+    )
@@ -0,0 +1,264 @@
+"""
+Local stand-in for the BygningService and StoreService of the matrikkel API, to run
+`fetch_buildings.py` without credentials or network
+(`--base_url http://127.0.0.1:8089`).
+
+The WSDLs only have the two calls and the types `fetch_buildings` uses, under the
+prefixes of the real ones (ns0 context, ns14 codes, ns21 ids). Every municipality
+has `n_buildings` buildings, and failures can be injected to exercise the retries:
+- `fail_next`: HTTP status codes to answer the next calls with (e.g. [503])
+- municipality "0000" answers with a SOAP fault (a bad argument)
+- calls with other credentials than username/password get HTTP 401
+
+All calls are recorded in `calls` as (time, operation).
+"""
+
+# %% Imports
+import re
+import time
+import base64
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+namespace = "http://matrikkel.no/stub"
+
+# operation: (input elements, output type)
+services = {
+    "BygningService": {
+        "findByggForKommune": (
+            '<xsd:element name="kommuneId" type="tns:KommuneId"/>',
+            "tns:ByggIdList",
+        ),
+    },
+    "StoreService": {
+        "getObjects": (
+            '<xsd:element name="ids" type="tns:ByggIdList"/>',
+            "tns:BubbleObjectList",
+        ),
+    },
+}
+
+types = """
+<xsd:complexType name="Timestamp">
+  <xsd:sequence><xsd:element name="timestamp" type="xsd:string"/></xsd:sequence>
+</xsd:complexType>
+<xsd:complexType name="KoordinatsystemKodeId">
+  <xsd:sequence><xsd:element name="value" type="xsd:long"/></xsd:sequence>
+</xsd:complexType>
+<xsd:complexType name="KommuneId">
+  <xsd:sequence><xsd:element name="value" type="xsd:string"/></xsd:sequence>
+</xsd:complexType>
+<xsd:complexType name="MatrikkelContext">
+  <xsd:sequence>
+    <xsd:element name="locale" type="xsd:string"/>
+    <xsd:element name="brukOriginaleKoordinater" type="xsd:boolean"/>
+    <xsd:element name="koordinatsystemKodeId" type="tns:KoordinatsystemKodeId"/>
+    <xsd:element name="systemVersion" type="xsd:string"/>
+    <xsd:element name="klientIdentifikasjon" type="xsd:string"/>
+    <xsd:element name="snapshotVersion" type="tns:Timestamp"/>
+  </xsd:sequence>
+</xsd:complexType>
+<xsd:complexType name="ByggIdList">
+  <xsd:sequence>
+    <xsd:element name="item" type="xsd:long" minOccurs="0" maxOccurs="unbounded"/>
+  </xsd:sequence>
+</xsd:complexType>
+<xsd:complexType name="Bygg">
+  <xsd:sequence>
+    <xsd:element name="id" type="xsd:long"/>
+    <xsd:element name="bygningsnummer" type="xsd:long"/>
+  </xsd:sequence>
+</xsd:complexType>
+<xsd:complexType name="BubbleObjectList">
+  <xsd:sequence>
+    <xsd:element name="item" type="tns:Bygg" minOccurs="0" maxOccurs="unbounded"/>
+  </xsd:sequence>
+</xsd:complexType>
+"""
+
+
+def make_wsdl(service: str, url: str) -> str:
+    """
+    WSDL (document/literal) of a stub service.
+    """
+    elements, messages, operations, bindings = [], [], [], []
+    for operation, (inputs, output) in services[service].items():
+        elements.append(
+            f"""
+<xsd:element name="{operation}"><xsd:complexType><xsd:sequence>
+  {inputs}
+  <xsd:element name="matrikkelContext" type="tns:MatrikkelContext"/>
+</xsd:sequence></xsd:complexType></xsd:element>
+<xsd:element name="{operation}Response"><xsd:complexType><xsd:sequence>
+  <xsd:element name="return" type="{output}"/>
+</xsd:sequence></xsd:complexType></xsd:element>"""
+        )
+        messages.append(
+            f"""
+<wsdl:message name="{operation}"><wsdl:part name="parameters"
+  element="tns:{operation}"/></wsdl:message>
+<wsdl:message name="{operation}Response"><wsdl:part name="parameters"
+  element="tns:{operation}Response"/></wsdl:message>"""
+        )
+        operations.append(
+            f"""
+<wsdl:operation name="{operation}">
+  <wsdl:input message="tns:{operation}"/>
+  <wsdl:output message="tns:{operation}Response"/>
+</wsdl:operation>"""
+        )
+        bindings.append(
+            f"""
+<wsdl:operation name="{operation}">
+  <soap:operation soapAction="{operation}"/>
+  <wsdl:input><soap:body use="literal"/></wsdl:input>
+  <wsdl:output><soap:body use="literal"/></wsdl:output>
+</wsdl:operation>"""
+        )
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/"
+  xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+  xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+  xmlns:tns="{namespace}" xmlns:ns0="{namespace}" xmlns:ns14="{namespace}"
+  xmlns:ns21="{namespace}" targetNamespace="{namespace}">
+<wsdl:types>
+<xsd:schema targetNamespace="{namespace}" elementFormDefault="qualified">
+{types}{"".join(elements)}
+</xsd:schema>
+</wsdl:types>
+{"".join(messages)}
+<wsdl:portType name="{service}">{"".join(operations)}
+</wsdl:portType>
+<wsdl:binding name="{service}Binding" type="tns:{service}">
+<soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>
+{"".join(bindings)}
+</wsdl:binding>
+<wsdl:service name="{service}WS">
+<wsdl:port name="{service}Port" binding="tns:{service}Binding">
+  <soap:address location="{url}"/>
+</wsdl:port>
+</wsdl:service>
+</wsdl:definitions>"""
+
+
+def envelope(body: str) -> bytes:
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        + '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"'
+        + f' xmlns:tns="{namespace}"><soapenv:Body>{body}</soapenv:Body>'
+        + "</soapenv:Envelope>"
+    ).encode()
+
+
+class MatrikkelStub(ThreadingHTTPServer):
+    """
+    The stub server, serving on 127.0.0.1 (port 0 picks a free port).
+
+    Arguments:
+    - port: port to listen on
+    - username, password: the accepted credentials
+    - n_buildings: number of buildings of every municipality
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port: int = 0,
+        username: str = "user",
+        password: str = "password",
+        n_buildings: int = 25,
+    ):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        credentials = base64.b64encode(f"{username}:{password}".encode()).decode()
+        self.authorization = f"Basic {credentials}"
+        self.n_buildings = n_buildings
+        self.fail_next = []
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def start(self) -> "MatrikkelStub":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def answer(
+        self, operation: str, request: str, authorization: str
+    ) -> tuple[int, bytes]:
+        """
+        Status and body of the answer to a call.
+        """
+        with self.lock:
+            self.calls.append((time.monotonic(), operation))
+            if authorization != self.authorization:
+                return 401, b"unauthorized"
+            if self.fail_next:
+                return self.fail_next.pop(0), b"unavailable"
+        if operation == "findByggForKommune":
+            kommune = re.search(r"kommuneId>\s*<(?:\w+:)?value>(\w+)<", request)[1]
+            if kommune == "0000":
+                fault = (
+                    "<soapenv:Fault><faultcode>soapenv:Client</faultcode>"
+                    + f"<faultstring>Ugyldig kommune {kommune}</faultstring>"
+                    + "</soapenv:Fault>"
+                )
+                return 500, envelope(fault)
+            first = int(kommune) * 100_000
+            items = "".join(
+                f"<tns:item>{first + i}</tns:item>" for i in range(self.n_buildings)
+            )
+        elif operation == "getObjects":
+            ids = re.findall(r"item>(\d+)<", request)
+            items = "".join(
+                f"<tns:item><tns:id>{i}</tns:id>"
+                + f"<tns:bygningsnummer>{int(i) + 1}</tns:bygningsnummer></tns:item>"
+                for i in ids
+            )
+        else:
+            return 400, b"unknown operation"
+        body = f"<tns:{operation}Response><tns:return>{items}</tns:return>"
+        return 200, envelope(body + f"</tns:{operation}Response>")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # /matrikkelapi/wsapi/v1/{service}WS?WSDL
+        service = self.path.split("?")[0].rstrip("/").split("/")[-1][: -len("WS")]
+        if service not in services:
+            self._send(404, b"unknown service")
+            return
+        url = f"{self.server.url}{self.path.split('?')[0]}"
+        self._send(200, make_wsdl(service, url).encode())
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        operation = self.headers.get("SOAPAction", "").strip('"')
+        authorization = self.headers.get("Authorization")
+        self._send(*self.server.answer(operation, request, authorization))
+
+    def _send(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stub of the matrikkel API")
+    parser.add_argument("--port", required=False, type=int, default=8089)
+    parser.add_argument("--n_buildings", required=False, type=int, default=25)
+    args = parser.parse_args()
+
+    stub = MatrikkelStub(args.port, n_buildings=args.n_buildings)
+    print(f"Matrikkel stub on {stub.url} (user / password)")
+    stub.serve_forever()
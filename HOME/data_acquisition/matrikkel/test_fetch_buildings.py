@@ -0,0 +1,148 @@
+"""
+Runs the matrikkel pull against the local SOAP stub (`soap_stub.py`): client pool,
+rate limiter and retries, without credentials or network.
+
+    python -m pytest HOME/data_acquisition/matrikkel/test_fetch_buildings.py
+"""
+
+# %% Imports
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("suds")
+
+from suds import WebFault  # noqa: E402
+
+from HOME.data_acquisition.matrikkel.fetch_buildings import (  # noqa: E402
+    ClientPool,
+    RateLimiter,
+    call_with_retry,
+    fetch_municipality,
+)
+from HOME.data_acquisition.matrikkel.soap_stub import MatrikkelStub  # noqa: E402
+
+
+# %%
+@pytest.fixture
+def stub():
+    stub = MatrikkelStub(n_buildings=25).start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def pool(stub, tmp_path):
+    return ClientPool(
+        "user",
+        "password",
+        n_clients=2,
+        base_url=stub.url,
+        wsdl_cache_dir=tmp_path / "wsdl",
+    )
+
+
+def test_fetch_municipality_writes_parts(stub, pool, tmp_path):
+    with ThreadPoolExecutor(2) as executor:
+        written = fetch_municipality(
+            pool, executor, "0301", tmp_path / "parts", batch_size=10, retries=2
+        )
+    assert written == 3
+    parts = sorted((tmp_path / "parts/0301").glob("0301_part_*.pkl"))
+    assert [p.name for p in parts] == [f"0301_part_{k:05d}.pkl" for k in range(3)]
+    with open(parts[-1], "rb") as f:
+        description, objects = pickle.load(f)
+    assert description.startswith("0301: buildings 20 to 25 of 25")
+    assert [o["id"] for o in objects["item"]] == list(range(30_100_020, 30_100_025))
+
+    # parts on disk are skipped when the pull is repeated
+    n_calls = len(stub.calls)
+    with ThreadPoolExecutor(2) as executor:
+        written = fetch_municipality(
+            pool, executor, "0301", tmp_path / "parts", batch_size=10, retries=2
+        )
+    assert written == 0
+    assert len(stub.calls) == n_calls + 1
+
+
+def test_transient_failures_are_retried(stub, pool):
+    stub.fail_next = [503, 429]
+    with pool.acquire() as (client_buildings, context_buildings, _, _):
+        kommune_id = client_buildings.factory.create("ns21:KommuneId")
+        kommune_id.value = "0301"
+        ids = call_with_retry(
+            client_buildings.service.findByggForKommune,
+            kommune_id,
+            context_buildings,
+            retries=3,
+            backoff=0.01,
+        )
+    assert len(ids.item) == 25
+    assert len(stub.calls) == 3
+
+
+def test_transient_failures_give_up_after_retries(stub, pool):
+    stub.fail_next = [503] * 3
+    with pool.acquire() as (client_buildings, context_buildings, _, _):
+        kommune_id = client_buildings.factory.create("ns21:KommuneId")
+        kommune_id.value = "0301"
+        with pytest.raises(Exception):
+            call_with_retry(
+                client_buildings.service.findByggForKommune,
+                kommune_id,
+                context_buildings,
+                retries=2,
+                backoff=0.01,
+            )
+    assert len(stub.calls) == 3
+
+
+def test_soap_faults_are_not_retried(stub, pool):
+    with pool.acquire() as (client_buildings, context_buildings, _, _):
+        kommune_id = client_buildings.factory.create("ns21:KommuneId")
+        kommune_id.value = "0000"
+        with pytest.raises(WebFault):
+            call_with_retry(
+                client_buildings.service.findByggForKommune,
+                kommune_id,
+                context_buildings,
+                retries=3,
+                backoff=0.01,
+            )
+    assert len(stub.calls) == 1
+
+
+def test_authentication_errors_are_not_retried(stub, tmp_path):
+    pool = ClientPool(
+        "user", "wrong", n_clients=1, base_url=stub.url, wsdl_cache_dir=tmp_path
+    )
+    with pool.acquire() as (client_buildings, context_buildings, _, _):
+        kommune_id = client_buildings.factory.create("ns21:KommuneId")
+        kommune_id.value = "0301"
+        with pytest.raises(Exception):
+            call_with_retry(
+                client_buildings.service.findByggForKommune,
+                kommune_id,
+                context_buildings,
+                retries=3,
+                backoff=0.01,
+            )
+    assert len(stub.calls) == 1
+
+
+def test_rate_limiter_spaces_calls(stub, pool, tmp_path):
+    rate = 20
+    with ThreadPoolExecutor(4) as executor:
+        fetch_municipality(
+            pool,
+            executor,
+            "0301",
+            tmp_path / "parts",
+            batch_size=5,
+            rate_limiter=RateLimiter(rate),
+        )
+    times = sorted(t for t, _ in stub.calls)
+    assert len(times) == 6
+    # 6 calls at 20 per second take at least 5 intervals
+    assert times[-1] - times[0] >= 5 / rate * 0.9
@@ -7,15 +7,17 @@ import requests
 import os
 import zipfile
 from pathlib import Path
+from HOME.get_data_path import get_data_path
 from osgeo import gdal, osr
 from tqdm import tqdm
 import json
 from datetime import datetime
 
 root_dir = Path(__file__).parents[3]
+data_path = get_data_path(root_dir)
 print(f"root_dir: {root_dir}")
 # load in metadata:
-path_to_data = root_dir / "data" / "raw" / "orthophoto"
+path_to_data = data_path / "raw" / "orthophoto"
 # list all files (not directories) in the path
 metadata_files = [
     f for f in os.listdir(path_to_data) if os.path.isfile(os.path.join(path_to_data, f))
@@ -48,7 +50,7 @@ with open(path_to_data / newest_file, "r") as f:
 
 # %% open the file and change it
 with open(
-    root_dir / "data/ML_prediction/project_log/project_details.json", "r"
+    data_path / "ML_prediction/project_log/project_details.json", "r"
 ) as file:
     project_details = json.load(file)
 
@@ -73,7 +75,7 @@ for project_name in project_details.keys():
 print(project_details)
 # %% save the file
 with open(
-    root_dir / "data/ML_prediction/project_log/project_details.json", "w"
+    data_path / "ML_prediction/project_log/project_details.json", "w"
 ) as file:
     json.dump(project_details, file, indent=4)
 # %%
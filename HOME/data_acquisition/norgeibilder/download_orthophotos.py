@@ -58,10 +58,6 @@ def check_all_jobs() -> bool:
     return all_jobs_complete
 
 
-# check once manually
-all_jobs_complete = check_all_jobs()
-
-
 # immediatly download the finished jobs
 def download_all_possible():
     urls_dir = data_path / "temp/norgeibilder/urls/"
@@ -87,17 +83,21 @@ def download_all_possible():
     return
 
 
-# download once manually
-download_all_possible()
-
-
-while not all_jobs_complete:
-    print(
-        "Not all jobs are complete. Waiting for 60 minutes before" + " checking again."
-    )
-    time.sleep(3600)  # Wait for 60 minutes
+# %%
+if __name__ == "__main__":
+    # check once manually
     all_jobs_complete = check_all_jobs()
+    # download once manually
     download_all_possible()
 
+    while not all_jobs_complete:
+        print(
+            "Not all jobs are complete. Waiting for 60 minutes before"
+            + " checking again."
+        )
+        time.sleep(3600)  # Wait for 60 minutes
+        all_jobs_complete = check_all_jobs()
+        download_all_possible()
+
 
 # %%
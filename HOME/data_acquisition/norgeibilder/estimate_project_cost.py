@@ -0,0 +1,314 @@
+"""
+Estimates the cost of the projects waiting in the download que before we start the
+exports.
+
+For every json in `data/temp/norgeibilder/download_que/` we look up the project in the
+newest metadata file (`st_area(shape)`, `pixelstorrelse`, `bildekategori` and the
+project geometry) and combine it with the prediction mask of the requested resolution.
+From that we predict:
+- the raw (uncompressed) and expected download size in bytes
+- the number of 512 px tiles that survive the prediction mask
+- the expected time for tiling, inference and polygonization
+
+All projects are handled together: the masked grid cells of a resolution are joined
+against all project geometries in a single spatial join. The time estimates come from
+the throughput measured by `HOME.benchmarks.run_benchmarks --calibrate` (see
+`load_calibration`). Throughputs missing from that file (e.g. the inference speed,
+which is only measured with --network hdnet) fall back to rough placeholders, and the
+estimates are then marked as uncalibrated.
+"""
+
+# %% imports
+import json
+import os
+import warnings
+from datetime import datetime
+from pathlib import Path
+import argparse
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import shape
+from HOME.get_data_path import get_data_path
+
+# Get the root directory of the project
+root_dir = Path(__file__).resolve().parents[3]
+# print(root_dir)
+# get the data path (might change)
+data_path = get_data_path(root_dir)
+# print(data_path)
+
+# bytes per pixel for the picture types in the metadata ("bildekategori")
+picture_types = {
+    "1": ("IR", 3),
+    "2": ("BW", 1),
+    "3": ("RGB", 3),
+    "4": ("RGBI", 4),
+}
+
+# rough placeholders (not measured), only used if no calibration file is available;
+# run `python -m HOME benchmark --calibrate` to measure the actual throughput
+default_calibration = {
+    "tiling_mpx_per_s": 40.0,  # megapixels of the raw orthophoto per second
+    "inference_tiles_per_s": 12.0,  # 512 px tiles per second (one GPU)
+    "polygonization_tiles_per_s": 60.0,  # 512 px prediction tiles per second
+    "compression_ratio": 0.55,  # download size / raw size for LZW exports
+}
+# the throughputs the time estimates depend on
+time_keys = ("tiling_mpx_per_s", "inference_tiles_per_s", "polygonization_tiles_per_s")
+
+
+# %% functions
+def load_newest_metadata(path_to_metadata: Path) -> dict:
+    """
+    Loads the newest metadata file (metadata_all_projects_<datetime>.json) in a
+    folder.
+
+    Arguments:
+    - path_to_metadata: folder containing the metadata files from `download_metadata.py`
+
+    Returns:
+    - The metadata of all projects as saved by `download_metadata.py`
+    """
+    metadata_files = [
+        f
+        for f in os.listdir(path_to_metadata)
+        if f.startswith("metadata_all_projects") and f.endswith(".json")
+    ]
+    if not metadata_files:
+        raise FileNotFoundError(f"No metadata files found in {path_to_metadata}")
+    newest_file = max(
+        metadata_files,
+        key=lambda f: datetime.strptime(f.split("_")[-1].split(".")[0], "%Y%m%d%H%M%S"),
+    )
+    with open(Path(path_to_metadata) / newest_file, "r") as f:
+        return json.load(f)
+
+
+def load_calibration(calibration_file: Path = None, required: bool = False) -> dict:
+    """
+    Loads the throughput calibration for the time estimates. The file is a flat json
+    with the same keys as `default_calibration` (written by the benchmark suite with
+    --calibrate); missing keys fall back to the placeholders.
+
+    Arguments:
+    - calibration_file: path to the calibration json, defaults to
+        `ML_prediction/project_log/benchmark_calibration.json` in the data folder
+    - required: raise if a throughput of the time estimates is not in the
+        calibration file instead of using the placeholder
+
+    Returns:
+    - dictionary with the calibration values, "measured" (the keys read from the
+        file) and "calibrated" (False if any throughput of the time estimates is a
+        placeholder)
+    """
+    if calibration_file is None:
+        calibration_file = (
+            data_path / "ML_prediction/project_log/benchmark_calibration.json"
+        )
+    calibration = default_calibration.copy()
+    measured = {}
+    if Path(calibration_file).exists():
+        with open(calibration_file, "r") as f:
+            measured = {k: v for k, v in json.load(f).items() if k in calibration}
+    calibration.update(measured)
+    placeholders = [key for key in time_keys if key not in measured]
+    if placeholders:
+        message = (
+            f"No measured {', '.join(placeholders)} in {calibration_file}: the time "
+            + "estimates use rough placeholders (run the benchmarks with --calibrate, "
+            + "and --network hdnet for the inference)"
+        )
+        if required and not measured:
+            raise FileNotFoundError(message)
+        if required:
+            raise ValueError(message)
+        warnings.warn(message)
+    calibration["measured"] = sorted(measured)
+    calibration["calibrated"] = not placeholders
+    return calibration
+
+
+def load_download_que(download_que_dir: Path) -> pd.DataFrame:
+    """
+    Reads all plain jsons in the download que into one DataFrame.
+    """
+    que_files = sorted(f for f in os.listdir(download_que_dir) if f.endswith(".json"))
+    rows = []
+    for que_file in que_files:
+        with open(Path(download_que_dir) / que_file, "r") as f:
+            rows.append(json.load(f))
+    return pd.DataFrame(rows, columns=["project", "resolution"])
+
+
+def load_prediction_mask(res: float) -> pd.DataFrame:
+    """
+    Loads the premade prediction mask for a resolution (see `step_00_road_grid.py`).
+    """
+    prediction_mask = pd.read_csv(
+        data_path / f"ML_prediction/prediction_mask/prediction_mask_{res}.csv",
+        index_col=0,
+    )
+    prediction_mask.columns = prediction_mask.columns.astype(int)
+    prediction_mask.index = prediction_mask.index.astype(int)
+    return prediction_mask
+
+
+def count_masked_tiles(
+    project_geometries: gpd.GeoSeries,
+    prediction_mask: pd.DataFrame,
+    res: float,
+    tile_size: int = 512,
+) -> np.ndarray:
+    """
+    Counts the grid cells in the prediction mask that fall into each project geometry.
+    The cells are named after their top left corner, like the tiles in
+    `step_01_tile_generation`, so cell (x, y) covers [x, x+1] * [y-1, y] in grid units.
+
+    Arguments:
+    - project_geometries: geometries of the projects in EPSG:25833
+    - prediction_mask: boolean DataFrame with grid_y as index and grid_x as columns
+    - res: resolution in m per pixel
+    - tile_size: tile size in pixels
+
+    Returns:
+    - number of masked tiles for each project (same order as project_geometries)
+    """
+    grid_size_m = res * tile_size
+    rows, cols = np.nonzero(prediction_mask.to_numpy(dtype=bool))
+    grid_x = prediction_mask.columns.to_numpy()[cols]
+    grid_y = prediction_mask.index.to_numpy()[rows]
+    cell_centers = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy(
+            (grid_x + 0.5) * grid_size_m, (grid_y - 0.5) * grid_size_m
+        ),
+        crs="EPSG:25833",
+    )
+    projects = gpd.GeoDataFrame(
+        {"project_index": np.arange(len(project_geometries))},
+        geometry=project_geometries.values,
+        crs="EPSG:25833",
+    )
+    joined = gpd.sjoin(cell_centers, projects, how="inner", predicate="within")
+    counts = np.bincount(
+        joined["project_index"].to_numpy(), minlength=len(project_geometries)
+    )
+    return counts
+
+
+def estimate_project_cost(
+    download_que: pd.DataFrame,
+    metadata_all_projects: dict,
+    calibration: dict = None,
+    tile_size: int = 512,
+    prediction_masks: dict = None,
+) -> pd.DataFrame:
+    """
+    Estimates size and processing time for all queued projects in one pass.
+
+    Arguments:
+    - download_que: DataFrame with (at least) the columns project and resolution
+    - metadata_all_projects: metadata as saved by `download_metadata.py`
+    - calibration: throughput calibration, see `load_calibration`
+    - tile_size: tile size in pixels used for the prediction
+    - prediction_masks: optional dictionary {res: prediction_mask} to avoid reading
+        the masks from disk
+
+    Returns:
+    - DataFrame with one row per queued project and the estimates as columns
+    """
+    if calibration is None:
+        calibration = load_calibration()
+    if prediction_masks is None:
+        prediction_masks = {}
+
+    project_list = metadata_all_projects["ProjectList"]
+    metadata_index = pd.Series(np.arange(len(project_list)), index=project_list)
+    missing = ~download_que["project"].isin(metadata_index.index)
+    if missing.any():
+        print(
+            "No metadata for the queued projects: "
+            + f"{download_que.loc[missing, 'project'].to_list()}"
+        )
+    estimate = download_que.loc[~missing, ["project", "resolution"]].copy()
+    estimate = estimate.reset_index(drop=True)
+    properties = [
+        metadata_all_projects["ProjectMetadata"][i]["properties"]
+        for i in metadata_index[estimate["project"]]
+    ]
+    geometries = gpd.GeoSeries(
+        [
+            shape(metadata_all_projects["ProjectMetadata"][i]["geometry"])
+            for i in metadata_index[estimate["project"]]
+        ],
+        crs="EPSG:25833",
+    )
+
+    estimate["area_m2"] = np.array([float(p["st_area(shape)"]) for p in properties])
+    estimate["resolution"] = estimate["resolution"].astype(float)
+    estimate["channels"] = [picture_types[p["bildekategori"]][0] for p in properties]
+    bands = np.array([picture_types[p["bildekategori"]][1] for p in properties])
+
+    # sizes
+    pixels = estimate["area_m2"].to_numpy() / estimate["resolution"].to_numpy() ** 2
+    estimate["raw_bytes"] = (pixels * bands).astype(np.int64)
+    estimate["download_bytes"] = (
+        estimate["raw_bytes"] * calibration["compression_ratio"]
+    ).astype(np.int64)
+
+    # tiles in the prediction mask, one spatial join per resolution
+    estimate["n_tiles"] = 0
+    for res, group in estimate.groupby("resolution"):
+        if res not in prediction_masks:
+            prediction_masks[res] = load_prediction_mask(res)
+        estimate.loc[group.index, "n_tiles"] = count_masked_tiles(
+            geometries[group.index], prediction_masks[res], res, tile_size
+        )
+    estimate["tile_bytes"] = estimate["n_tiles"] * tile_size**2 * bands
+
+    # time
+    estimate["tiling_s"] = pixels / (calibration["tiling_mpx_per_s"] * 1e6)
+    estimate["inference_s"] = (
+        estimate["n_tiles"] / calibration["inference_tiles_per_s"]
+    )
+    estimate["polygonization_s"] = (
+        estimate["n_tiles"] / calibration["polygonization_tiles_per_s"]
+    )
+    estimate["total_s"] = (
+        estimate["tiling_s"] + estimate["inference_s"] + estimate["polygonization_s"]
+    )
+    # False if any of the times comes from a placeholder, not from a benchmark
+    estimate["calibrated"] = calibration.get("calibrated", False)
+    return estimate
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Estimate download volume and processing time of queued projects"
+    )
+    parser.add_argument("--calibration", required=False, type=str, default=None)
+    parser.add_argument(
+        "--require_calibration",
+        action="store_true",
+        help="fail instead of using a placeholder throughput",
+    )
+    parser.add_argument("--tile_size", required=False, type=int, default=512)
+    parser.add_argument("--save", required=False, type=str, default=None)
+    args = parser.parse_args()
+
+    download_que = load_download_que(data_path / "temp/norgeibilder/download_que/")
+    metadata_all_projects = load_newest_metadata(data_path / "raw/orthophoto")
+    calibration = load_calibration(args.calibration, args.require_calibration)
+    estimate = estimate_project_cost(
+        download_que, metadata_all_projects, calibration, tile_size=args.tile_size
+    )
+    print(estimate.to_string())
+    print(
+        f"Total: {estimate['download_bytes'].sum() / 2**30:.1f} GiB to download, "
+        f"{estimate['tile_bytes'].sum() / 2**30:.1f} GiB of tiles, "
+        f"{estimate['n_tiles'].sum()} tiles, {estimate['total_s'].sum() / 3600:.1f} h"
+    )
+    if args.save:
+        estimate.to_csv(args.save, index=False)
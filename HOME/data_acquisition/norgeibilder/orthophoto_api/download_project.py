@@ -11,6 +11,7 @@ from osgeo import gdal, osr
 from tqdm import tqdm
 import json
 from HOME.get_data_path import get_data_path
+from HOME.utils.metrics import metrics
 
 root_dir = Path(__file__).parents[4]
 # print(root_dir)
@@ -54,20 +55,22 @@ def download_project(
     file_path = os.path.join(extract_path, file_name)
 
     # write zip file to the specified path
-    with open(file_path, "wb") as file:
+    with metrics.stage("download", project=project), open(file_path, "wb") as file:
         with tqdm(total=total_size, unit="B", unit_scale=True, desc=file_name) as pbar:
             for chunk in response.iter_content(chunk_size=1024):
                 if chunk:  # filter out keep-alive new chunks
                     file.write(chunk)
                     pbar.update(len(chunk))
+                    metrics.inc("bytes_downloaded", len(chunk), stage="download")
 
     # Unzip the file
     unzip_folder = os.path.join(extract_path, file_name.split(".")[0])
     os.makedirs(unzip_folder, exist_ok=True)
-    with zipfile.ZipFile(file_path, "r") as zip_ref:
-        zip_ref.extractall(unzip_folder)
-        # Remove the zip file after extraction
-        os.remove(file_path)
+    with metrics.timer("unzip_seconds", stage="download"):
+        with zipfile.ZipFile(file_path, "r") as zip_ref:
+            zip_ref.extractall(unzip_folder)
+            # Remove the zip file after extraction
+            os.remove(file_path)
 
     # find all tif files in the folder:
     tif_files = [f for f in os.listdir(unzip_folder) if ".tif" in f]
@@ -4,16 +4,18 @@ Prepares the jsons that say what we want to download
 
 # %% imports
 from pathlib import Path
+from HOME.get_data_path import get_data_path
 import json
 import os
 from datetime import datetime
 
 root_dir = Path(__file__).resolve().parents[3]
+data_path = get_data_path(root_dir)
 # print(root_dir)
 
 # %% import metadata for the projects to check availabilitly
 
-path_to_data = root_dir / "data" / "raw" / "orthophoto"
+path_to_data = data_path / "raw" / "orthophoto"
 # list all files (not directories) in the path
 metadata_files = [
     f for f in os.listdir(path_to_data) if os.path.isfile(os.path.join(path_to_data, f))
@@ -82,11 +84,11 @@ project_names = [
 
 
 project_names = []
-que_path = root_dir / "data/temp/norgeibilder/download_que/"
+que_path = data_path / "temp/norgeibilder/download_que/"
 
 # read in the json for project management:
 with open(
-    root_dir / "data/ML_prediction/project_log/project_details.json", "r"
+    data_path / "ML_prediction/project_log/project_details.json", "r"
 ) as file:
     project_details = json.load(file)
 # %% create the jsons
@@ -128,7 +130,7 @@ for project in project_names:
 
 # %% save the updated project details
 with open(
-    root_dir / "data/ML_prediction/project_log/project_details.json", "w"
+    data_path / "ML_prediction/project_log/project_details.json", "w"
 ) as file:
     json.dump(project_details, file, indent=4)
 
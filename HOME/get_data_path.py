@@ -1,23 +1,31 @@
 """
 To easily toggle between data paths for different machines, we will always use the
-function from this file to refer to the current data folder
+function from this file to refer to the current data folder.
+
+The data folder is resolved once per process by `HOME.config` (HOME/data_path.txt,
+a config file or environment variables), so importing many modules does not read
+the file again every time.
 """
 
-import os
+from functools import lru_cache
 from pathlib import Path
 
+from HOME.config import get_config, root_dir as config_root_dir
+
 
-def get_data_path(root_dir: str):
-    # Path to the text file
-    config_file = os.path.join(root_dir, "HOME/data_path.txt")
-    # print(f"config_file: {config_file}")
-    # Read the current data folder from the file
+@lru_cache(maxsize=None)
+def _data_path_of_checkout(root_dir: Path) -> Path:
+    # another checkout than the one HOME.config belongs to: read its data_path.txt
     try:
-        with open(config_file, "r") as file:
+        with open(root_dir / "HOME/data_path.txt", "r") as file:
             mode = file.read().strip()
     except IOError:
         print("cannot accss the dat_path.txt file - falling back to default (data)")
-        # Default to 'data' if the file cannot be read
         mode = "data"
+    return root_dir / mode
+
 
-    return Path(os.path.join(root_dir, mode))
+def get_data_path(root_dir: str = None) -> Path:
+    if root_dir is None or Path(root_dir).resolve() == config_root_dir:
+        return get_config().data_root
+    return _data_path_of_checkout(Path(root_dir).resolve())
@@ -1,10 +1,16 @@
-from pyproj import Transformer
+from HOME.utils.crs import transform_bboxes, transform_coords
 
 
 def convert_bbox_to_meters(bbox, source_crs='EPSG:4326',
                            target_crs='EPSG:25833'):
-    transformer = Transformer.from_crs(source_crs, target_crs,
-                                       always_xy=True)
-    left, bottom = transformer.transform(bbox[0], bbox[1])
-    right, top = transformer.transform(bbox[2], bbox[3])
+    left, bottom = transform_coords(bbox[0], bbox[1], source_crs, target_crs)
+    right, top = transform_coords(bbox[2], bbox[3], source_crs, target_crs)
     return [left, bottom, right, top]
+
+
+def convert_bboxes_to_meters(bboxes, source_crs='EPSG:4326',
+                             target_crs='EPSG:25833'):
+    """
+    Same as convert_bbox_to_meters for many bboxes (N, 4) in one call.
+    """
+    return transform_bboxes(bboxes, source_crs, target_crs)
@@ -2,6 +2,7 @@ from PIL import Image
 import os
 from pathlib import Path
 from tqdm import tqdm
+from HOME.get_data_path import get_data_path
 
 
 def convert_to_bw(image_path, output_dir):
@@ -19,8 +20,10 @@ def convert_folder_to_bw(input_dir, output_dir):
             convert_to_bw(image_path, output_dir)
 
 
-# Specify the folder path here
-root_dir = Path(__file__).parents[2]
-input_dir = root_dir / "data/ML_training/train/image"
-output_dir = root_dir / "data/ML_training/train_BW/image"
-convert_folder_to_bw(input_dir, output_dir)
+if __name__ == "__main__":
+    # Specify the folder path here
+    root_dir = Path(__file__).parents[2]
+    data_path = get_data_path(root_dir)
+    input_dir = data_path / "ML_training/train/image"
+    output_dir = data_path / "ML_training/train_BW/image"
+    convert_folder_to_bw(input_dir, output_dir)
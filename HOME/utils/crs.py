@@ -0,0 +1,78 @@
+"""
+Shared helpers for coordinate reference system conversions.
+
+Creating a pyproj Transformer is far more expensive than using it, so there is one
+cached Transformer per (source, target) pair. All transforms work on whole arrays:
+coordinates as NumPy arrays and geometries as shapely 2 geometry arrays (or
+GeoSeries), which are reprojected with a single vectorized call instead of point by
+point in Python.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+
+
+@lru_cache(maxsize=64)
+def get_transformer(source_crs, target_crs) -> Transformer:
+    """
+    Cached Transformer (always_xy, so x/lon first) between two crs, which can be
+    anything pyproj understands ("EPSG:25833", proj4 strings, pyproj.CRS, ...).
+    """
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+def transform_coords(x, y, source_crs, target_crs) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Transforms coordinates (scalars or arrays).
+
+    Arguments:
+    - x, y: coordinates in source_crs
+    - source_crs, target_crs: crs of the input and the output
+
+    Returns:
+    - x, y in target_crs
+    """
+    return get_transformer(source_crs, target_crs).transform(x, y)
+
+
+def transform_bboxes(bboxes, source_crs, target_crs) -> np.ndarray:
+    """
+    Transforms the corners (left, bottom) and (right, top) of many bboxes.
+
+    Arguments:
+    - bboxes: (N, 4) [left, bottom, right, top] in source_crs
+    - source_crs, target_crs: crs of the input and the output
+
+    Returns:
+    - (N, 4) bboxes in target_crs
+    """
+    bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+    transformer = get_transformer(source_crs, target_crs)
+    left, bottom = transformer.transform(bboxes[:, 0], bboxes[:, 1])
+    right, top = transformer.transform(bboxes[:, 2], bboxes[:, 3])
+    return np.stack([left, bottom, right, top], axis=1)
+
+
+def transform_geometries(geometries, source_crs, target_crs) -> np.ndarray:
+    """
+    Transforms all coordinates of an array of shapely geometries in one call.
+
+    Arguments:
+    - geometries: shapely geometry, array of geometries or GeoSeries in source_crs
+    - source_crs, target_crs: crs of the input and the output
+
+    Returns:
+    - geometries in target_crs (same shape as the input, z is dropped)
+    """
+    transformer = get_transformer(source_crs, target_crs)
+    if hasattr(geometries, "to_numpy"):
+        geometries = geometries.to_numpy()
+
+    def transformation(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+
+    return shapely.transform(geometries, transformation)
@@ -0,0 +1,342 @@
+"""
+Lightweight instrumentation for the long running stages (tiling, prediction,
+reassembly, downloads), to see whether a slow run is bound by decoding, disk or
+compute.
+
+There is one registry per process (`metrics`) with
+- counters: tiles written or skipped, bytes, retries, ...
+- timers: count, total and max seconds of e.g. decode, forward, encode, I/O wait
+- gauges: current values like queue depths and the RSS of the process
+
+Everything is kept in memory and costs about a dict update per call, so it can stay
+in the inner loops. Where it goes is configured once per process with
+`metrics.configure(...)` or the environment variables
+- METRICS_JSONL: path of a JSONL log with stage events and periodic snapshots
+- METRICS_PORT: port of a local Prometheus text endpoint (http://127.0.0.1:port/)
+- METRICS_PROFILE: "cprofile" or "py-spy" to profile every outermost `stage` block
+    (nested stages are part of the profile of the enclosing one). cProfile only
+    sees the thread that entered the stage; py-spy samples all threads of the process
+    (not its child processes), so only one py-spy recording runs at a time
+- METRICS_PROFILE_DIR: folder for the profiles (default: next to the JSONL log)
+
+Usage:
+    from HOME.utils.metrics import metrics
+
+    with metrics.stage("tiling", project=project_name):
+        with metrics.timer("decode_seconds", stage="tiling"):
+            image = cv2.imread(path)
+        metrics.inc("tiles_written", stage="tiling")
+"""
+
+import os
+import json
+import time
+import shutil
+import signal
+import cProfile
+import resource
+import threading
+import subprocess
+from pathlib import Path
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())))
+
+
+def _rss_bytes() -> int:
+    """
+    Current RSS of the process (peak RSS where /proc is not available).
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Metrics:
+    """
+    Registry of counters, timers and gauges with optional JSONL, Prometheus and
+    profiling outputs. All methods are thread safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}  # key -> [count, total seconds, max seconds]
+        self.gauges = {}
+        self.jsonl_path = None
+        self.profile = None
+        self.profile_dir = None
+        self.configured = False
+        self._server = None
+        self._flush_thread = None
+        self._stop = threading.Event()
+        self._local = threading.local()  # depth of the nested stages per thread
+        self._recorder = None  # the running py-spy process
+
+    # recording
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = _key(name, labels)
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # outputs
+    def configure(
+        self,
+        jsonl_path: Path = None,
+        prometheus_port: int = None,
+        profile: str = None,
+        profile_dir: Path = None,
+        flush_interval: float = 30,
+    ) -> "Metrics":
+        """
+        Sets up the outputs; arguments that are None are taken from the environment.
+
+        Arguments:
+        - jsonl_path: JSONL log of stage events and snapshots
+        - prometheus_port: serve the metrics in Prometheus text format on this port
+        - profile: "cprofile" or "py-spy" to profile each `stage` block
+        - profile_dir: folder for the profiles
+        - flush_interval: seconds between snapshots in the JSONL log
+        """
+        jsonl_path = jsonl_path or os.environ.get("METRICS_JSONL")
+        prometheus_port = prometheus_port or os.environ.get("METRICS_PORT")
+        self.profile = profile or os.environ.get("METRICS_PROFILE")
+        profile_dir = profile_dir or os.environ.get("METRICS_PROFILE_DIR")
+
+        if jsonl_path:
+            self.jsonl_path = Path(jsonl_path)
+            os.makedirs(self.jsonl_path.parent, exist_ok=True)
+            if self._flush_thread is None and flush_interval:
+                self._flush_thread = threading.Thread(
+                    target=self._flush_loop, args=(flush_interval,), daemon=True
+                )
+                self._flush_thread.start()
+        if profile_dir:
+            self.profile_dir = Path(profile_dir)
+        elif self.jsonl_path is not None:
+            self.profile_dir = self.jsonl_path.parent / "profiles"
+        else:
+            self.profile_dir = Path("profiles")
+        if prometheus_port and self._server is None:
+            self._serve(int(prometheus_port))
+        self.configured = True
+        return self
+
+    def event(self, event: str, **fields) -> None:
+        """
+        Writes a structured event (e.g. the end of a stage) to the JSONL log.
+        """
+        if self.jsonl_path is None:
+            return
+        record = {"time": time.time(), "pid": os.getpid(), "event": event, **fields}
+        line = json.dumps(record, default=str)
+        with self.lock:
+            with open(self.jsonl_path, "a") as f:
+                f.write(line + "\n")
+
+    def snapshot(self) -> dict:
+        """
+        Current values of all metrics (the RSS gauge is updated first).
+        """
+        self.set_gauge("rss_bytes", _rss_bytes())
+
+        def flat(key):
+            name, labels = key
+            return {"name": name, **dict(labels)}
+
+        with self.lock:
+            return {
+                "counters": [
+                    {**flat(k), "value": v} for k, v in self.counters.items()
+                ],
+                "timers": [
+                    {**flat(k), "count": c, "total": t, "max": m}
+                    for k, (c, t, m) in self.timers.items()
+                ],
+                "gauges": [{**flat(k), "value": v} for k, v in self.gauges.items()],
+            }
+
+    def flush(self) -> None:
+        self.event("snapshot", **self.snapshot())
+
+    def _flush_loop(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def prometheus_text(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+
+        def sample(name, entry, value, skip=("value",)):
+            labels = ",".join(
+                f'{k}="{v}"' for k, v in entry.items() if k != "name" and k not in skip
+            )
+            return f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+
+        lines = []
+        for entry in snapshot["counters"]:
+            lines.append(sample(f"{entry['name']}_total", entry, entry["value"]))
+        for entry in snapshot["gauges"]:
+            lines.append(sample(entry["name"], entry, entry["value"]))
+        for entry in snapshot["timers"]:
+            for suffix, field in (("count", "count"), ("sum", "total"), ("max", "max")):
+                lines.append(
+                    sample(
+                        f"{entry['name']}_{suffix}",
+                        entry,
+                        entry[field],
+                        skip=("count", "total", "max"),
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+    def _serve(self, port: int) -> None:
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    # stages
+    @contextmanager
+    def _profiled(self, stage: str):
+        """
+        Profiles the outermost stage of the thread: a profiler can not be enabled
+        twice, and the profile of the outer stage already contains the inner ones.
+        """
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        try:
+            if self.profile not in ("cprofile", "py-spy") or depth > 0:
+                yield
+            elif self.profile == "cprofile":
+                with self._cprofile(stage):
+                    yield
+            else:
+                with self._py_spy(stage):
+                    yield
+        finally:
+            self._local.depth = depth
+
+    def _profile_stem(self, stage: str) -> Path:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        return self.profile_dir / f"{stage}_{os.getpid()}_{time.strftime('%H%M%S')}"
+
+    @contextmanager
+    def _cprofile(self, stage: str):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python >= 3.12 allows one profiler per process, e.g. a stage of
+            # another thread
+            print(f"Another profiler is active, stage {stage} is not profiled")
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f"{self._profile_stem(stage)}.prof")
+
+    @contextmanager
+    def _py_spy(self, stage: str):
+        if shutil.which("py-spy") is None:
+            print("py-spy not found, stage is not profiled")
+            yield
+            return
+        with self.lock:
+            running = self._recorder is not None
+            if not running:
+                # py-spy samples this process from outside, and writes on SIGINT
+                self._recorder = subprocess.Popen(
+                    [
+                        "py-spy",
+                        "record",
+                        "--pid",
+                        str(os.getpid()),
+                        "-o",
+                        f"{self._profile_stem(stage)}.svg",
+                    ]
+                )
+        if running:
+            # the recording of the stage of another thread covers this one
+            yield
+            return
+        try:
+            yield
+        finally:
+            recorder, self._recorder = self._recorder, None
+            recorder.send_signal(signal.SIGINT)
+            recorder.wait()
+
+    @contextmanager
+    def stage(self, stage: str, **fields):
+        """
+        Marks a stage: logs its start and end (with duration and a snapshot), times
+        it as stage_seconds, and profiles it if profiling is enabled.
+        """
+        if not self.configured:
+            self.configure()
+        self.event("stage_start", stage=stage, **fields)
+        start = time.perf_counter()
+        status = "failed"
+        try:
+            with self._profiled(stage):
+                yield
+            status = "done"
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe("stage_seconds", seconds, stage=stage)
+            self.event(
+                "stage_end",
+                stage=stage,
+                status=status,
+                seconds=seconds,
+                **fields,
+                **self.snapshot(),
+            )
+
+
+metrics = Metrics()
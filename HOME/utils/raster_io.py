@@ -0,0 +1,187 @@
+"""
+Writing and reading of tiles, predictions and reassembled rasters as Cloud-Optimized
+GeoTIFFs (COGs).
+
+`cv2.imwrite` writes striped TIFFs without georeferencing or compression control.
+Here the rasters are written with GDAL's COG driver:
+- internal tiles (256 or 512 px), so windowed reads only touch the blocks they need
+- LZW, DEFLATE or ZSTD compression, with the horizontal predictor for images
+- the geotransform in EPSG:25833 (for grid tiles derived from the tile name, see
+    `HOME.utils.tile_grid`)
+- optional overviews, so low-zoom reads (e.g. for plots) read a fraction of the data
+
+Images are passed in the channel order of cv2 (BGR, height x width x channels) and
+come back in it from `read_raster`, so the functions can replace cv2.imwrite and
+cv2.imread. The files are regular GeoTIFFs that cv2, PIL and QGIS read as before
+(cv2 and PIL do not read ZSTD, so the default is DEFLATE).
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as rio_copy
+from rasterio.windows import Window
+
+from HOME.utils.tile_grid import tile_name_to_grid, get_tile_transform
+
+crs = "EPSG:25833"
+
+_predictors = {
+    None: "NO",
+    "none": "NO",
+    "horizontal": "STANDARD",
+    "float": "FLOATING_POINT",
+}
+
+
+def cog_options(
+    blocksize: int = 512,
+    compress: str = "deflate",
+    predictor: str = None,
+    level: int = None,
+    overviews: bool = False,
+    resampling: str = "average",
+) -> dict:
+    """
+    Creation options of the GDAL COG driver.
+
+    Arguments:
+    - blocksize: size of the internal tiles (256 or 512)
+    - compress: "lzw", "deflate", "zstd" or "none"
+    - predictor: None, "horizontal" (images) or "float" (floating point data)
+    - level: compression level of DEFLATE/ZSTD (GDAL default if None)
+    - overviews: build overviews down to the block size
+    - resampling: resampling of the overviews ("nearest" for masks)
+
+    Returns:
+    - dictionary of creation options
+    """
+    options = {
+        "BLOCKSIZE": blocksize,
+        "COMPRESS": compress.upper(),
+        "PREDICTOR": _predictors[predictor],
+        "OVERVIEWS": "AUTO" if overviews else "NONE",
+        "OVERVIEW_RESAMPLING": resampling.upper(),
+        "BIGTIFF": "IF_SAFER",
+    }
+    if level is not None:
+        options["LEVEL"] = level
+    return options
+
+
+def write_raster(
+    path: Path,
+    array: np.ndarray,
+    transform=None,
+    crs: str = crs,
+    bgr: bool = True,
+    nodata: float = None,
+    **options,
+) -> Path:
+    """
+    Writes an array as COG (via an in-memory GeoTIFF, the COG driver can only copy).
+
+    Arguments:
+    - path: output path
+    - array: height x width or height x width x channels (BGR if bgr)
+    - transform: affine geotransform, None for a raster without georeferencing
+    - crs: crs of the transform
+    - bgr: reverse the channel order of 3 and 4 channel arrays to RGB(A)
+    - nodata: nodata value
+    - options: passed to `cog_options` (blocksize, compress, predictor, level,
+        overviews, resampling)
+
+    Returns:
+    - path of the written file
+    """
+    if array.ndim == 2:
+        bands = array[None]
+    else:
+        bands = np.moveaxis(array, -1, 0)
+        if bgr and bands.shape[0] in (3, 4):
+            bands = bands[[2, 1, 0, 3][: bands.shape[0]]]
+    profile = {
+        "driver": "GTiff",
+        "dtype": bands.dtype,
+        "count": bands.shape[0],
+        "height": bands.shape[1],
+        "width": bands.shape[2],
+        "nodata": nodata,
+    }
+    if transform is not None:
+        profile.update(transform=transform, crs=crs)
+    if bands.shape[0] == 3 and bands.dtype == np.uint8:
+        profile["photometric"] = "RGB"
+
+    os.makedirs(Path(path).parent, exist_ok=True)
+    # write next to the target and rename, so readers never see half a file
+    tmp_path = Path(path).with_name(f".{Path(path).name}.tmp")
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as mem:
+            mem.write(bands)
+        with memfile.open() as mem:
+            rio_copy(mem, tmp_path, driver="COG", **cog_options(**options))
+    os.replace(tmp_path, path)
+    return Path(path)
+
+
+def write_tile(
+    path: Path, array: np.ndarray, res: float, tile_size: int = 512, **kwargs
+) -> Path:
+    """
+    Writes a tile of the prediction grid as COG, georeferenced from its name
+    (`..._<grid_x>_<grid_y>.tif`).
+
+    Arguments:
+    - path: output path, named after the grid cell
+    - array: the tile (BGR image or mask)
+    - res: resolution in m
+    - tile_size: size of a grid cell in pixels
+    - kwargs: passed to `write_raster`
+
+    Returns:
+    - path of the written file
+    """
+    grid_x, grid_y = tile_name_to_grid(Path(path).name)
+    transform = get_tile_transform(grid_x, grid_y, res, tile_size)
+    return write_raster(path, array, transform, **kwargs)
+
+
+def read_raster(
+    path: Path,
+    window: Window = None,
+    scale: float = 1,
+    bgr: bool = True,
+    resampling: Resampling = Resampling.average,
+) -> np.ndarray:
+    """
+    Reads (part of) a raster, using the overviews for downscaled reads.
+
+    Arguments:
+    - path: raster path
+    - window: pixel window to read, all if None
+    - scale: output size relative to the window (e.g. 1/8 for a low-zoom read)
+    - bgr: return 3 and 4 channel rasters in the channel order of cv2
+    - resampling: resampling where no fitting overview exists
+
+    Returns:
+    - height x width array for one band, height x width x channels otherwise
+    """
+    with rasterio.open(path) as src:
+        if window is None:
+            window = Window(0, 0, src.width, src.height)
+        out_shape = (
+            src.count,
+            max(1, int(round(window.height * scale))),
+            max(1, int(round(window.width * scale))),
+        )
+        bands = src.read(window=window, out_shape=out_shape, resampling=resampling)
+    if bands.shape[0] == 1:
+        return bands[0]
+    if bgr and bands.shape[0] in (3, 4):
+        bands = bands[[2, 1, 0, 3][: bands.shape[0]]]
+    return np.ascontiguousarray(np.moveaxis(bands, 0, -1))
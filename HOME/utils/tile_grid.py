@@ -0,0 +1,39 @@
+"""
+Helpers for the logical tile grid used for prediction. The grid starts at 0,0 in
+EPSG:25833 and extends towards north and east; a tile is named after the grid
+coordinates of its top left corner (`..._<grid_x>_<grid_y>.tif`), so tile (x, y) covers
+[x, x+1] * [y-1, y] in grid units of res * tile_size meters.
+"""
+
+from rasterio.transform import from_origin
+
+
+def tile_name_to_grid(tile_name: str) -> tuple[int, int]:
+    """
+    Extracts grid_x and grid_y from a tile name of pattern '..._x_y(.tif)'.
+    """
+    parts = tile_name.split(".")[0].split("_")
+    return int(parts[-2]), int(parts[-1])
+
+
+def get_tile_bounds(
+    grid_x: int, grid_y: int, res: float, tile_size: int = 512
+) -> tuple[float, float, float, float]:
+    """
+    Bounds (left, bottom, right, top) of a grid cell in EPSG:25833.
+    """
+    grid_size_m = res * tile_size
+    return (
+        grid_x * grid_size_m,
+        (grid_y - 1) * grid_size_m,
+        (grid_x + 1) * grid_size_m,
+        grid_y * grid_size_m,
+    )
+
+
+def get_tile_transform(grid_x: int, grid_y: int, res: float, tile_size: int = 512):
+    """
+    Affine transform of a grid cell (top left corner at grid_x, grid_y).
+    """
+    grid_size_m = res * tile_size
+    return from_origin(grid_x * grid_size_m, grid_y * grid_size_m, res, res)
@@ -0,0 +1,275 @@
+"""
+Chunked storage of prediction tiles on the prediction grid (see `HOME.utils.tile_grid`).
+
+The predictions of HDNet are binary, but as 0/255 tiles every pixel takes a byte (and
+a file per tile). A `TileStore` keeps the tiles of a project in chunks of
+chunk_cells x chunk_cells grid cells, one memory-mapped `.npy` per chunk:
+
+    store.json                      res, tile_size, bits, chunk_cells, crs
+    chunk_{cx}_{cy}.npy             (chunk_cells, chunk_cells, tile_size, row_bytes)
+    chunk_{cx}_{cy}_valid.npy       (chunk_cells, chunk_cells) bool, tiles written
+
+With bits=1 the rows are bit-packed (`np.packbits`, 1 bit per pixel, 32 KB for a
+512 x 512 tile instead of 256 KB); with bits=8 they are stored as uint8 (e.g. the
+quantized probabilities). Chunk (cx, cy) holds the cells with grid_x // chunk_cells
+== cx and grid_y // chunk_cells == cy, with the northernmost row of cells first, so a
+whole chunk unpacks with one vectorized call into a mosaic in image orientation
+(`read_chunk`), ready for polygonization or for comparing two stores.
+
+Probabilities are quantized to uint8 as q = min(floor(256 * p), 255), so every q
+covers an equal interval [q / 256, (q + 1) / 256) and q >= 128 is exactly p >= 0.5
+(logit >= 0), the threshold of the binary predictions.
+"""
+
+import os
+import json
+from pathlib import Path
+
+import numpy as np
+
+from HOME.utils.tile_grid import get_tile_transform
+
+crs = "EPSG:25833"
+
+
+def store_path(
+    kind: str, project_name: str, res: float, compression: str, data_root: Path
+) -> Path:
+    """
+    Folder of a store of a project, e.g. kind="prediction_store".
+    """
+    return (
+        Path(data_root) / f"ML_prediction/{kind}/res_{res}/{project_name}/{compression}"
+    )
+
+
+class TileStore:
+    """
+    Tiles of one project on the prediction grid, in chunked memory-mapped containers.
+    Opens an existing store, or creates one if res is given.
+
+    Arguments:
+    - path: folder of the store
+    - res: resolution in m (only needed to create the store)
+    - tile_size: size of a grid cell in pixels
+    - bits: 1 for binary masks (bit-packed), 8 for uint8 values
+    - chunk_cells: grid cells per chunk side
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        res: float = None,
+        tile_size: int = 512,
+        bits: int = 1,
+        chunk_cells: int = 16,
+    ):
+        self.path = Path(path)
+        meta_path = self.path / "store.json"
+        if meta_path.exists():
+            with open(meta_path, "r") as file:
+                meta = json.load(file)
+        elif res is None:
+            raise FileNotFoundError(f"No tile store in {self.path}")
+        else:
+            if bits not in (1, 8) or (bits == 1 and tile_size % 8):
+                raise ValueError(f"Unsupported bits {bits} for tile size {tile_size}")
+            meta = {
+                "res": res,
+                "tile_size": tile_size,
+                "bits": bits,
+                "chunk_cells": chunk_cells,
+                "crs": crs,
+            }
+            os.makedirs(self.path, exist_ok=True)
+            tmp_path = meta_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as file:
+                json.dump(meta, file, indent=4)
+            os.replace(tmp_path, meta_path)
+        self.res = meta["res"]
+        self.tile_size = meta["tile_size"]
+        self.bits = meta["bits"]
+        self.chunk_cells = meta["chunk_cells"]
+        self.row_bytes = self.tile_size // 8 if self.bits == 1 else self.tile_size
+        self._chunks = {}
+
+    # layout
+    def locate(self, grid_x: int, grid_y: int) -> tuple[tuple[int, int], int, int]:
+        """
+        Chunk (cx, cy) of a grid cell and its row and column within the chunk.
+        """
+        c = self.chunk_cells
+        cx, cy = grid_x // c, grid_y // c
+        return (cx, cy), (cy * c + c - 1) - grid_y, grid_x - cx * c
+
+    def chunk_transform(self, chunk: tuple[int, int]):
+        """
+        Affine transform of the mosaic of a chunk (see `read_chunk`).
+        """
+        c = self.chunk_cells
+        return get_tile_transform(
+            chunk[0] * c, chunk[1] * c + c - 1, self.res, self.tile_size
+        )
+
+    def chunks(self) -> list[tuple[int, int]]:
+        """
+        All chunks (cx, cy) of the store.
+        """
+        chunks = []
+        for file in self.path.glob("chunk_*_valid.npy"):
+            _, cx, cy, _ = file.stem.split("_")
+            chunks.append((int(cx), int(cy)))
+        return sorted(chunks)
+
+    def cells(self) -> list[tuple[int, int]]:
+        """
+        All grid cells (grid_x, grid_y) that were written.
+        """
+        c = self.chunk_cells
+        cells = []
+        for cx, cy in self.chunks():
+            rows, cols = np.nonzero(self._open(cx, cy)[1])
+            cells.extend(zip(cx * c + cols, cy * c + c - 1 - rows))
+        return [(int(x), int(y)) for x, y in cells]
+
+    def _open(self, cx: int, cy: int, create: bool = False):
+        """
+        Memory maps (data, valid) of a chunk, None if it does not exist.
+        """
+        if (cx, cy) in self._chunks:
+            return self._chunks[(cx, cy)]
+        data_path = self.path / f"chunk_{cx}_{cy}.npy"
+        valid_path = self.path / f"chunk_{cx}_{cy}_valid.npy"
+        if not valid_path.exists():
+            if not create:
+                return None
+            c = self.chunk_cells
+            shapes = {
+                data_path: ((c, c, self.tile_size, self.row_bytes), np.uint8),
+                valid_path: ((c, c), bool),
+            }
+            # created under temporary names, the valid array last, so a chunk with a
+            # valid array is always complete
+            for path, (shape, dtype) in shapes.items():
+                tmp_path = path.with_suffix(".tmp.npy")
+                np.lib.format.open_memmap(tmp_path, "w+", dtype, shape).flush()
+                os.replace(tmp_path, path)
+        arrays = (
+            np.load(data_path, mmap_mode="r+"),
+            np.load(valid_path, mmap_mode="r+"),
+        )
+        self._chunks[(cx, cy)] = arrays
+        return arrays
+
+    # writing
+    def write_tiles(self, cells: list[tuple[int, int]], tiles: np.ndarray) -> None:
+        """
+        Writes a batch of tiles (n, tile_size, tile_size); with bits=1 every value > 0
+        is a building pixel.
+        """
+        tiles = np.asarray(tiles)
+        if self.bits == 1:
+            tiles = np.packbits(tiles > 0, axis=-1)
+        for (grid_x, grid_y), tile in zip(cells, tiles):
+            chunk, row, col = self.locate(grid_x, grid_y)
+            data, valid = self._open(*chunk, create=True)
+            data[row, col] = tile
+            valid[row, col] = True
+
+    def write_tile(self, grid_x: int, grid_y: int, tile: np.ndarray) -> None:
+        self.write_tiles([(grid_x, grid_y)], np.asarray(tile)[None])
+
+    def write_chunk(
+        self, chunk: tuple[int, int], mosaic: np.ndarray, valid: np.ndarray
+    ) -> None:
+        """
+        Writes the tiles of a chunk from a mosaic like the one of `read_chunk`.
+
+        Arguments:
+        - chunk: (cx, cy)
+        - mosaic: chunk_cells * tile_size pixels per side
+        - valid: (chunk_cells, chunk_cells) bool, the cells to write
+        """
+        c, t = self.chunk_cells, self.tile_size
+        tiles = np.asarray(mosaic).reshape(c, t, c, t).transpose(0, 2, 1, 3)
+        if self.bits == 1:
+            tiles = np.packbits(tiles > 0, axis=-1)
+        data, valid_cells = self._open(*chunk, create=True)
+        data[valid] = tiles[valid]
+        valid_cells[valid] = True
+
+    def flush(self) -> None:
+        for data, valid in self._chunks.values():
+            data.flush()
+            valid.flush()
+
+    # reading
+    def _unpack(self, packed: np.ndarray) -> np.ndarray:
+        if self.bits == 1:
+            return np.unpackbits(packed, axis=-1, count=self.tile_size).view(bool)
+        return np.asarray(packed)
+
+    def read_tile(self, grid_x: int, grid_y: int) -> np.ndarray:
+        """
+        One tile (bool for bits=1, uint8 for bits=8), None if it was not written.
+        """
+        chunk, row, col = self.locate(grid_x, grid_y)
+        arrays = self._open(*chunk)
+        if arrays is None or not arrays[1][row, col]:
+            return None
+        return self._unpack(arrays[0][row, col])
+
+    def read_chunk(self, chunk: tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        All tiles of a chunk as one mosaic, unpacked in a single vectorized call.
+
+        Arguments:
+        - chunk: (cx, cy)
+
+        Returns:
+        - mosaic of chunk_cells * tile_size pixels per side (bool for bits=1, uint8
+            for bits=8), north up, georeferenced by `chunk_transform`
+        - the valid mask of the mosaic (False where no tile was written)
+        """
+        c, t = self.chunk_cells, self.tile_size
+        arrays = self._open(*chunk)
+        if arrays is None:
+            dtype = bool if self.bits == 1 else np.uint8
+            return np.zeros((c * t, c * t), dtype), np.zeros((c * t, c * t), bool)
+        data, valid = arrays
+        mosaic = self._unpack(data).transpose(0, 2, 1, 3).reshape(c * t, c * t)
+        valid_mosaic = np.repeat(np.repeat(valid, t, axis=0), t, axis=1)
+        return mosaic, valid_mosaic
+
+
+def quantize_probability(probability: np.ndarray) -> np.ndarray:
+    """
+    Probabilities in [0, 1] as uint8 (see the module docstring).
+    """
+    return np.minimum(np.floor(np.asarray(probability) * 256), 255).astype(np.uint8)
+
+
+def dequantize_probability(quantized: np.ndarray) -> np.ndarray:
+    """
+    Center of the probability interval of uint8 values, as float32.
+    """
+    return (np.asarray(quantized, dtype=np.float32) + 0.5) / 256
+
+
+def quantized_threshold(threshold: float) -> int:
+    """
+    Smallest uint8 value with probability >= threshold (128 for 0.5).
+    """
+    return int(np.ceil(threshold * 256))
+
+
+def demolished(
+    before: TileStore, after: TileStore, chunk: tuple[int, int]
+) -> np.ndarray:
+    """
+    Pixels of a chunk that are buildings in `before` but not in `after`, where both
+    binary stores have a prediction (the stores must share res and layout).
+    """
+    mask_before, valid_before = before.read_chunk(chunk)
+    mask_after, valid_after = after.read_chunk(chunk)
+    return mask_before & ~mask_after & valid_before & valid_after
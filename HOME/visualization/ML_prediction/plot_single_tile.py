@@ -4,6 +4,7 @@ from PIL import Image
 import geopandas as gpd
 import contextily as ctx
 from pathlib import Path
+from HOME.get_data_path import get_data_path
 from random import choice
 import os
 from shapely.geometry import box
@@ -11,18 +12,18 @@ from osgeo import gdal
 import numpy as np
 
 root_dir = Path(__file__).parents[3]
+data_path = get_data_path(root_dir)
 
 # %% Load the image
-img_dir = "data/ML_prediction/topredict/image/res_0.2/trondheim_mof_2023/i_lzw_25"
+img_dir = (
+    data_path / "ML_prediction/topredict/image/res_0.2/trondheim_mof_2023/i_lzw_25"
+)
 
-image_paths = [
-    os.path.join(root_dir, img_dir, img)
-    for img in os.listdir(os.path.join(root_dir, img_dir))
-]
+image_paths = [os.path.join(img_dir, img) for img in os.listdir(img_dir)]
 
 trondheim = gpd.read_file(
-    root_dir
-    / "/scratch/mueller_andco/orthophoto/HOME/data/raw/FKB_bygning/Basisdata_5001_Trondheim_5972_FKB-Bygning_FGDB.gdb",
+    data_path
+    / "raw/FKB_bygning/Basisdata_5001_Trondheim_5972_FKB-Bygning_FGDB.gdb",
     layer="fkb_bygning_omrade",
 ).to_crs(epsg=25833)
 
@@ -153,8 +154,8 @@ xmax = xmin + grid_size
 ymin = ymax - grid_size
 
 img_path = (
-    root_dir
-    / f"data/ML_prediction/topredict/image/res_0.2/trondheim_mof_2023/i_lzw_25/trondheim_mof_2023_b_{grid_x}_{grid_y}.tif"
+    data_path
+    / f"ML_prediction/topredict/image/res_0.2/trondheim_mof_2023/i_lzw_25/trondheim_mof_2023_b_{grid_x}_{grid_y}.tif"
 )
 
 img = Image.open(img_path)
@@ -8,6 +8,7 @@ currently I get the polygons bu running the code on the given image, but eventia
 import matplotlib.pyplot as plt
 import pandas as pd
 from pathlib import Path
+from HOME.get_data_path import get_data_path
 import random
 import rasterio
 import numpy as np
@@ -18,6 +19,7 @@ import re
 import sys
 from HOME.ML_prediction.postprocessing.step_02_regularization import process_project_tiles
 root_dir = Path(__file__).parents[4]
+data_path = get_data_path(root_dir)
 print(root_dir)
 
 
@@ -43,7 +45,7 @@ def plot_prediction_input(
     """
     # check status of project:
     project_details = pd.read_json(
-        root_dir / "data/ML_prediction/project_log/project_details.json"
+        data_path / "ML_prediction/project_log/project_details.json"
     )
     project_details = project_details[project_name]
     print(project_details)
@@ -51,14 +53,14 @@ def plot_prediction_input(
         print("Project is not predicted yet.")
         return
     # get overview of all files in the prediction folder:
-    prediction_folder = root_dir / "data/ML_prediction/predictions"
+    prediction_folder = data_path / "ML_prediction/predictions"
     res = f'res_{project_details["resolution"]:.1f}'
     compression = f'i_{project_details["compression_name"]}_{project_details["compression_value"]}'
     prediction_files_folder = prediction_folder / res / project_name / compression
 
     preds = [f for f in os.listdir(prediction_files_folder) if f.endswith(".tif")]
 
-    input_folder = root_dir / "data/ML_prediction/topredict/image"
+    input_folder = data_path / "ML_prediction/topredict/image"
     input_files_folder = input_folder / res / project_name / compression
     inputs = [f for f in os.listdir(input_files_folder) if f.endswith(".tif")]
         
@@ -99,7 +101,7 @@ def plot_prediction_input(
             "Functionality to plot specific tile not implemented yet."
         )
     if save:
-        save_path = root_dir / "data/figures//ML_prediction/prediction_inspection"
+        save_path = data_path / "figures//ML_prediction/prediction_inspection"
         save_path = save_path / res / project_name / compression
         save_path.mkdir(parents=True, exist_ok=True)
     for p, i in zip(preds, inputs):
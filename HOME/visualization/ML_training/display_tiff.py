@@ -4,7 +4,7 @@ import matplotlib.pyplot as plt
 from osgeo import gdal, osr
 from pathlib import Path
 import math
-from pyproj import Transformer
+from HOME.utils.crs import transform_coords
 import rasterio
 import os
 import random
@@ -31,10 +31,9 @@ def pixel_to_geographic_coordinates(dataset, x, y):
 
     # If the projection is in meters, convert to degrees
     if unit == "metre":
-        transformer = Transformer.from_crs(
-            srs.ExportToProj4(), "EPSG:4326", always_xy=True
+        x_geo, y_geo = transform_coords(
+            x_geo, y_geo, srs.ExportToProj4(), "EPSG:4326"
         )
-        x_geo, y_geo = transformer.transform(x_geo, y_geo)
 
     return x_geo, y_geo
 
@@ -8,10 +8,14 @@ import numpy as np
 import pandas as pd
 from datetime import datetime
 
+from HOME.get_data_path import get_data_path
+
 # Get the root directory of the project
 root_dir = Path(__file__).resolve().parents[3]
+# get the data path (might change)
+data_path = get_data_path(root_dir)
 
-path_to_data = root_dir / "data" / "raw" / "orthophoto"
+path_to_data = data_path / "raw" / "orthophoto"
 # list all files (not directories) in the path
 metadata_files = [
     f for f in os.listdir(path_to_data) if os.path.isfile(os.path.join(path_to_data, f))
@@ -289,16 +293,29 @@ plt.title("Total area by year")
 plt.show()
 
 # %% the uniquely covered area for each year with a sufficient resolution
+from shapely.geometry import shape
+from shapely.ops import unary_union
+
 projects_by_year = {y: [] for y in range(1935, 2024)}
 for project, year, res in zip(
-    metadata_all_projects["ProjectList"], time_list, resolution_list
+    metadata_all_projects["ProjectMetadata"], time_list, resolution_list
 ):
     if res <= 0.5:
         projects_by_year[year.year].append(project)
-print(projects_by_year)
+print({year: len(projects) for year, projects in projects_by_year.items()})
+# overlapping projects of the same year are only counted once
+unique_area_by_year = {}
 for year, projects in projects_by_year.items():
     shapes = []
     for project in projects:
+        shapes.append(shape(project["geometry"]))
+    unique_area_by_year[year] = unary_union(shapes).area if shapes else 0
+plt.figure()
+plt.bar(unique_area_by_year.keys(), unique_area_by_year.values())
+plt.xlabel("Year")
+plt.ylabel("Uniquely covered area")
+plt.title("Uniquely covered area by year")
+plt.show()
 # print(f'we have a total area of {area0}  for the 0th projects')
 # %% scatter plot of resolution and time
 # we make a scatter plot, but we'll slightly move the individual points randomly
@@ -369,7 +386,7 @@ plt.yticks([0.1, 0.2, 0.5, 1, 2, 5, 10], [0.1, 0.2, 0.5, 1, 2, 5, 10])
 plt.title("Resolution vs time - all orthophoto projects Norway")
 plt.legend(handles=legend_elements, title="Types")
 plt.savefig(
-    root_dir / "data/figures/orthophoto_metadata/resolution_vs_time.png",
+    data_path / "figures/orthophoto_metadata/resolution_vs_time.png",
     dpi=300,
     bbox_inches="tight",
 )
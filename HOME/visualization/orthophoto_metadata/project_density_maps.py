@@ -5,11 +5,15 @@ import matplotlib.pyplot as plt
 import json
 
 
-from rasterio.transform import from_origin
+import rasterio
+from rasterio.transform import from_origin, array_bounds
 from rasterio.features import rasterize
+from rasterio.enums import MergeAlg
+from rasterio.windows import Window, transform as window_transform
+from rasterio.shutil import copy as rio_copy
 from rasterio.plot import show
 
-from shapely.geometry import shape
+from shapely.geometry import shape, box
 
 import matplotlib.cm as cm
 from matplotlib import colors
@@ -21,7 +25,17 @@ from datetime import datetime
 
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
+import os
+import argparse
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from HOME.get_data_path import get_data_path
+
+# Get the root directory of the project
+root_dir = Path(__file__).resolve().parents[3]
+# get the data path (might change)
+data_path = get_data_path(root_dir)
 
 class ProjectDensityGrid():
     ''' 
@@ -34,11 +48,14 @@ class ProjectDensityGrid():
                         metadata_all_projects: list,
                         region_shape_file:str,
                         resolution: float = 500, # resolution in meters per pixel
-                        region:str = 'Norway') -> None:
+                        region:str = 'Norway',
+                        compute_grids:bool = True) -> None:
         '''
         Args:
         metadata_all_projects (list): metadata for all projects, needs to work with ___
         region_shape (str): path to a geopanda readable shape of the region
+        compute_grids (bool): compute the in-memory grids at the given resolution - set to False
+                              if only export_coverage_cogs is used at high resolution
         '''
         self.metadata_all_projects = metadata_all_projects
         gdf = gpd.read_file(region_shape_file)
@@ -54,14 +71,18 @@ class ProjectDensityGrid():
         self.resolution = resolution
         self.region = region
         self.region_grid, self.bounds, \
-        self.transform, self.raster_width, self.raster_height =  self.create_region_grid()
+        self.transform, self.raster_width, self.raster_height =  self.create_region_grid(allocate=compute_grids)
 
-        self.density_grid = self.get_density_grid()
-        self.oldest_grid = self.get_oldest_project_grid()
+        self.project_geometries, self.project_years = self._get_project_geometries()
+
+        if compute_grids:
+            self.density_grid = self.get_density_grid()
+            self.oldest_grid = self.get_oldest_project_grid()
+            self.newest_grid = self.get_newest_project_grid()
         #self._display_raster(density_grid, self.transform, cmap='gist_heat_r', 
         #                                plot_boundaries=True, plot_colorbar=True, 
         #                                color_bar_label='Project coverage - # of projects')
-    def create_region_grid(self):
+    def create_region_grid(self, allocate:bool = True):
         '''
         Creates a grid of the region that we can use to fill it up.
         '''
@@ -70,7 +91,7 @@ class ProjectDensityGrid():
         height = int(np.ceil((bounds[3] - bounds[1]) / self.resolution))
 
         # creaty empty grid
-        raster = np.zeros((height, width), dtype=np.uint8)
+        raster = np.zeros((height, width), dtype=np.uint8) if allocate else None
         return raster, bounds, transform, width, height
     
     def _get_region_transform(self):
@@ -110,7 +131,7 @@ class ProjectDensityGrid():
                                                 fill = empty_fill, default_value=area_fill, 
                                                 transform=transform, dtype=np.uint8)
         return project_raster
-    
+
     def _get_project_geometry(self, project_metadata:dict):
         '''
         Get the geometry of the project - may need to be adjusted for different metadata formats
@@ -123,6 +144,24 @@ class ProjectDensityGrid():
             return project_geometry
         else:
             raise NotImplementedError('fetching the geometry of metadata for the Region not implemented') 
+
+    def _get_project_geometries(self):
+        '''
+        Get the geometries and years of all projects at once, so we reproject only a single time.
+        Returns:
+        project_geometries (gpd.GeoSeries): geometries of all projects in crs ('EPSG:32633')
+        project_years (np.ndarray): year of each project
+        '''
+        # for Norway:
+        if self.region.lower() == 'norway':
+            project_geometries = gpd.GeoSeries([shape(project_metadata['geometry']) 
+                                                for project_metadata in self.metadata_all_projects], 
+                                                crs='EPSG:25833').to_crs('EPSG:32633')
+            project_years = np.array([self._get_project_year(project_metadata) 
+                                      for project_metadata in self.metadata_all_projects], dtype=np.uint16)
+            return project_geometries, project_years
+        else:
+            raise NotImplementedError('fetching the geometry of metadata for the Region not implemented') 
     
     def _get_project_year(self, project_metadata:dict):
         '''
@@ -137,34 +176,122 @@ class ProjectDensityGrid():
 
     def get_density_grid(self):
         '''
-        Get the density grid for the region
+        Get the density grid for the region - all projects are burned in a single pass, 
+        adding up where they overlap.
         '''
-        density_grid = np.zeros((self.raster_height, self.raster_width), dtype=np.uint8)
-        for project_metadata in self.metadata_all_projects:
-            project_geometry = self._get_project_geometry(project_metadata)
-            project_raster = self._get_project_grid(project_geometry, self.transform, self.raster_width, self.raster_height)
-            density_grid += project_raster
+        density_grid = rasterize(((geometry, 1) for geometry in self.project_geometries), 
+                                 out_shape=(self.raster_height, self.raster_width), 
+                                 fill=0, transform=self.transform, 
+                                 merge_alg=MergeAlg.add, dtype=np.uint16)
         return density_grid
 
+    def _get_year_grid(self, oldest:bool = True):
+        '''
+        Burn the year of all projects in a single pass, sorted by year so that the last burn 
+        (which replaces the earlier ones) is the oldest or newest project.
+        Uncovered pixels are 0.
+        '''
+        order = np.argsort(self.project_years, kind='stable')
+        if oldest:
+            order = order[::-1]
+        year_grid = rasterize(((self.project_geometries.iloc[i], int(self.project_years[i])) for i in order), 
+                              out_shape=(self.raster_height, self.raster_width), 
+                              fill=0, transform=self.transform, 
+                              merge_alg=MergeAlg.replace, dtype=np.uint16)
+        return year_grid
+
     def get_oldest_project_grid(self):
         ''' 
-        get the grid of the oldest project for each year
+        get the grid of the oldest project for each pixel
         '''
-        coverage_grid = self.density_grid.copy()
-        coverage_grid[coverage_grid > 0] = 1
-        coverage_grid = coverage_grid*5000
-        for project_metadata in self.metadata_all_projects:
-            project_geometry = self._get_project_geometry(project_metadata)
-            project_raster = self._get_project_grid(project_geometry, self.transform, 
-                                                                            self.raster_width, self.raster_height)
-            project_year = self._get_project_year(project_metadata)
-            
-            # we want to make sure only the pixels with the actual project coverage get the year
-            # the remaining pixels should get a year that is much higher.
-            project_raster = project_raster * -project_year
-            project_raster = project_raster + np.ones(np.shape(project_raster)) * project_year*2
-            coverage_grid = np.minimum(coverage_grid, project_raster)
-        return coverage_grid
+        return self._get_year_grid(oldest=True)
+
+    def get_newest_project_grid(self):
+        ''' 
+        get the grid of the newest project for each pixel
+        '''
+        return self._get_year_grid(oldest=False)
+
+    def export_coverage_cogs(self, 
+                             output_dir:str,
+                             resolution:float = 20,
+                             block_size:int = 4096,
+                             n_workers:int = None,
+                             name:str = None) -> dict:
+        '''
+        Computes density, oldest-year and newest-year coverage block by block at a (high) resolution 
+        and writes each as a Cloud-Optimized GeoTIFF with internal overviews, so the national
+        coverage can be explored by zooming without recomputing. Blocks are computed in parallel,
+        each worker only gets the projects intersecting its block.
+        Args:
+        output_dir (str): folder to write the COGs to
+        resolution (float): resolution in meters per pixel (10-50 m is reasonable)
+        block_size (int): edge length of the blocks in pixels
+        n_workers (int): number of worker processes (default: all cores)
+        name (str): prefix for the file names, defaults to the region
+        Returns:
+        dict: paths of the written COGs by layer ('density', 'oldest', 'newest')
+        '''
+        output_dir = Path(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+        if name is None:
+            name = self.region.lower()
+        width = int(np.ceil((self.bounds[2] - self.bounds[0]) / resolution))
+        height = int(np.ceil((self.bounds[3] - self.bounds[1]) / resolution))
+        transform = from_origin(self.bounds[0], self.bounds[3], resolution, resolution)
+        profile = {'driver': 'GTiff', 'width': width, 'height': height, 'count': 1,
+                   'dtype': 'uint16', 'crs': 'EPSG:32633', 'transform': transform, 'nodata': 0,
+                   'tiled': True, 'blockxsize': 512, 'blockysize': 512, 
+                   'compress': 'deflate', 'predictor': 2, 'BIGTIFF': 'IF_SAFER'}
+        layers = ['density', 'oldest', 'newest']
+        tmp_paths = {layer: output_dir / f'{name}_{layer}_res{resolution}_tmp.tif' for layer in layers}
+        cog_paths = {layer: output_dir / f'{name}_{layer}_res{resolution}.tif' for layer in layers}
+
+        # only the projects intersecting a block are sent to its worker
+        spatial_index = self.project_geometries.sindex
+        blocks = []
+        for row_off in range(0, height, block_size):
+            for col_off in range(0, width, block_size):
+                window = Window(col_off, row_off, min(block_size, width - col_off), 
+                                min(block_size, height - row_off))
+                block_transform = window_transform(window, transform)
+                block_bounds = array_bounds(int(window.height), int(window.width), block_transform)
+                project_indices = spatial_index.query(box(*block_bounds))
+                if len(project_indices) > 0:
+                    blocks.append((window, block_transform, np.sort(project_indices)))
+        print(f'Computing {len(blocks)} blocks with projects at {resolution} m')
+
+        datasets = {layer: rasterio.open(tmp_paths[layer], 'w', **profile) for layer in layers}
+        def write_blocks(done):
+            for future in done:
+                block_window, block_layers = future.result()
+                for layer in layers:
+                    datasets[layer].write(block_layers[layer], 1, window=block_window)
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                # bounded number of blocks in flight, so finished blocks don't pile up in memory
+                max_in_flight = 2 * (n_workers or os.cpu_count() or 1)
+                pending = set()
+                for window, block_transform, project_indices in blocks:
+                    if len(pending) >= max_in_flight:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        write_blocks(done)
+                    pending.add(executor.submit(_coverage_block, 
+                                                self.project_geometries.values[project_indices], 
+                                                self.project_years[project_indices], 
+                                                block_transform, int(window.height), int(window.width), 
+                                                window))
+                write_blocks(wait(pending)[0])
+        finally:
+            for dataset in datasets.values():
+                dataset.close()
+
+        # convert to COGs, the driver adds the internal overviews
+        for layer in layers:
+            rio_copy(tmp_paths[layer], cog_paths[layer], driver='COG', compress='DEFLATE', 
+                     predictor='2', blocksize=512, overview_resampling='nearest', BIGTIFF='IF_SAFER')
+            os.remove(tmp_paths[layer])
+        return cog_paths
     
     def _display_raster(self, raster, transform, 
                                     cmap='viridis',
@@ -266,14 +393,43 @@ class ProjectDensityGrid():
         #plt.clf()
         return fig, ax
 
+def _coverage_block(geometries, years, transform, height:int, width:int, window):
+    '''
+    Density, oldest and newest year for one block (run in a worker process).
+    Args:
+    geometries: project geometries intersecting the block
+    years (np.ndarray): year of each project
+    transform: affine transform of the block
+    height, width (int): size of the block in pixels
+    window: window of the block in the full raster (passed through for writing)
+    '''
+    out_shape = (height, width)
+    density = rasterize(((geometry, 1) for geometry in geometries), out_shape=out_shape, 
+                        fill=0, transform=transform, merge_alg=MergeAlg.add, dtype=np.uint16)
+    order = np.argsort(years, kind='stable')
+    newest = rasterize(((geometries[i], int(years[i])) for i in order), out_shape=out_shape, 
+                       fill=0, transform=transform, dtype=np.uint16)
+    oldest = rasterize(((geometries[i], int(years[i])) for i in order[::-1]), out_shape=out_shape, 
+                       fill=0, transform=transform, dtype=np.uint16)
+    return window, {'density': density, 'oldest': oldest, 'newest': newest}
+
 #%% actually plot
 if __name__ == "__main__":
-    # Get the root directory of the project
-    root_dir = Path(__file__).resolve().parents[3]
+    parser = argparse.ArgumentParser(description='Coverage maps of the orthophoto projects')
+    parser.add_argument('--export_cogs', action='store_true',
+                        help='write the coverage as COGs instead of plotting the 500 m maps')
+    parser.add_argument('--res', required=False, type=float, default=20,
+                        help='resolution of the COGs in meters per pixel')
+    parser.add_argument('--block_size', required=False, type=int, default=4096)
+    parser.add_argument('--n_workers', required=False, type=int, default=None)
+    parser.add_argument('--output_dir', required=False, type=str,
+                        default=data_path / 'figures' / 'orthophoto_metadata' / 'coverage_cogs')
+    args = parser.parse_args()
+
     # add path to Norway shapes in data to path
-    path_to_shape = root_dir / 'data'/'raw'/'maps'/'Norway_boundaries'/'NOR_adm0.shp'
+    path_to_shape = data_path / 'raw'/'maps'/'Norway_boundaries'/'NOR_adm0.shp'
 
-    path_to_data = root_dir / 'data' / 'raw' / 'orthophoto'
+    path_to_data = data_path / 'raw' / 'orthophoto'
     # list all files (not directories) in the path
     metadata_files = [f for f in os.listdir(path_to_data) if os.path.isfile(os.path.join(path_to_data, f))]
     # the last digits in the file name is the date and time of the metadata, we want the latest
@@ -295,46 +451,58 @@ if __name__ == "__main__":
     with open(path_to_data / newest_file, 'r') as f:
         metadata_all_projects = json.load(f)
 
-    # create the density grid
-    resolution = 500
-    figsize = (10,10)
-    Norway_density = ProjectDensityGrid(metadata_all_projects['ProjectMetadata'], 
-                                                                region_shape_file = path_to_shape, 
-                                                                resolution=resolution, region='Norway')
-    fig, axs = plt.subplots(1, 2, figsize=(14, 9))
-    plt.subplots_adjust(wspace=0)
-    # plot the density grid
-    density_cmap = 'gist_heat_r'
-    fig, ax = Norway_density._display_raster(Norway_density.density_grid, Norway_density.transform, 
-                                                        cmap=density_cmap, plot_boundaries=False, plot_colorbar=True,
-                                                        #save_as=f'density_project_map_res{resolution}_cmap{density_cmap}.png',
-                                                        color_bar_label='# of projects', 
-                                                        fig = fig, ax = axs[0], show_plot=False)
-    axs[0].text(0.04, 0.96, 'a)', transform=axs[0].transAxes, fontsize=16, verticalalignment='top')
+    if args.export_cogs:
+        # only the blocks are rasterized, at the resolution of the COGs
+        Norway_coverage = ProjectDensityGrid(metadata_all_projects['ProjectMetadata'],
+                                             region_shape_file = path_to_shape,
+                                             resolution=args.res, region='Norway',
+                                             compute_grids=False)
+        cog_paths = Norway_coverage.export_coverage_cogs(args.output_dir, resolution=args.res,
+                                                         block_size=args.block_size,
+                                                         n_workers=args.n_workers)
+        for layer, cog_path in cog_paths.items():
+            print(f'{layer}: {cog_path}')
+    else:
+        # create the density grid
+        resolution = 500
+        figsize = (10,10)
+        Norway_density = ProjectDensityGrid(metadata_all_projects['ProjectMetadata'], 
+                                                                    region_shape_file = path_to_shape, 
+                                                                    resolution=resolution, region='Norway')
+        fig, axs = plt.subplots(1, 2, figsize=(14, 9))
+        plt.subplots_adjust(wspace=0)
+        # plot the density grid
+        density_cmap = 'gist_heat_r'
+        fig, ax = Norway_density._display_raster(Norway_density.density_grid, Norway_density.transform, 
+                                                            cmap=density_cmap, plot_boundaries=False, plot_colorbar=True,
+                                                            #save_as=f'density_project_map_res{resolution}_cmap{density_cmap}.png',
+                                                            color_bar_label='# of projects', 
+                                                            fig = fig, ax = axs[0], show_plot=False)
+        axs[0].text(0.04, 0.96, 'a)', transform=axs[0].transAxes, fontsize=16, verticalalignment='top')
     
-    # plot the oldest project grid
-    cmap_colors = [(1, 1, 1), 
-                (0.12137254901960784, 0.58823529411764706, 0.7196078431372549),
-                (0.06137254901960784, 0.38823529411764706, 0.5196078431372549),
-                (0.04137254901960784, 0.26823529411764706, 0.4396078431372549), 
-                (0.04137254901960784, 0.20823529411764706, 0.3996078431372549), 
-                (0.09,0.09,0.09)]
-    cmap_colors.reverse()
-    # Create a custom colormap from the defined colors
-    CustomBlues = mcolors.LinearSegmentedColormap.from_list("CustomBlues", cmap_colors)
-    oldest_cmaps =  ['copper', 'Blues_r', CustomBlues]#'pink'#'copper'
-    oldest_cmap = oldest_cmaps[-1]
-    fig, ax = Norway_density._display_raster(Norway_density.oldest_grid, Norway_density.transform,
-                                                        cmap=oldest_cmap, plot_boundaries=False, plot_colorbar=True, 
-                                                        ignore_zero=True, 
-                                                        #save_as=f'oldest_project_map_res{resolution}_cmap{oldest_cmap}.png',
-                                                        color_bar_label='Oldest project', 
-                                                        fig = fig, ax = axs[1], show_plot=False)
-    axs[1].text(0.04, 0.96, 'b)', transform=axs[1].transAxes, fontsize=14, verticalalignment='top')
-    if type(oldest_cmap) != str:
-        oldest_cmap = oldest_cmap.name
-    plt.savefig(root_dir/f'data/figures/orthophoto_metadata/Norway_coverage_map_res{resolution}_cmaps_{density_cmap}_{oldest_cmap}.png', 
-                        dpi = 300, bbox_inches='tight')
-    plt.show()
+        # plot the oldest project grid
+        cmap_colors = [(1, 1, 1), 
+                    (0.12137254901960784, 0.58823529411764706, 0.7196078431372549),
+                    (0.06137254901960784, 0.38823529411764706, 0.5196078431372549),
+                    (0.04137254901960784, 0.26823529411764706, 0.4396078431372549), 
+                    (0.04137254901960784, 0.20823529411764706, 0.3996078431372549), 
+                    (0.09,0.09,0.09)]
+        cmap_colors.reverse()
+        # Create a custom colormap from the defined colors
+        CustomBlues = mcolors.LinearSegmentedColormap.from_list("CustomBlues", cmap_colors)
+        oldest_cmaps =  ['copper', 'Blues_r', CustomBlues]#'pink'#'copper'
+        oldest_cmap = oldest_cmaps[-1]
+        fig, ax = Norway_density._display_raster(Norway_density.oldest_grid, Norway_density.transform,
+                                                            cmap=oldest_cmap, plot_boundaries=False, plot_colorbar=True, 
+                                                            ignore_zero=True, 
+                                                            #save_as=f'oldest_project_map_res{resolution}_cmap{oldest_cmap}.png',
+                                                            color_bar_label='Oldest project', 
+                                                            fig = fig, ax = axs[1], show_plot=False)
+        axs[1].text(0.04, 0.96, 'b)', transform=axs[1].transAxes, fontsize=14, verticalalignment='top')
+        if type(oldest_cmap) != str:
+            oldest_cmap = oldest_cmap.name
+        plt.savefig(data_path/f'figures/orthophoto_metadata/Norway_coverage_map_res{resolution}_cmaps_{density_cmap}_{oldest_cmap}.png', 
+                            dpi = 300, bbox_inches='tight')
+        plt.show()
 # %%
 
@@ -8,10 +8,14 @@ import numpy as np
 import pandas as pd
 from datetime import datetime
 
+from HOME.get_data_path import get_data_path
+
 # Get the root directory of the project
 root_dir = Path(__file__).resolve().parents[3]
+# get the data path (might change)
+data_path = get_data_path(root_dir)
 
-path_to_data = root_dir / "data" / "raw" / "orthophoto"
+path_to_data = data_path / "raw" / "orthophoto"
 # list all files (not directories) in the path
 metadata_files = [
     f for f in os.listdir(path_to_data) if os.path.isfile(os.path.join(path_to_data, f))
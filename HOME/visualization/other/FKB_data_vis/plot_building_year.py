@@ -31,16 +31,24 @@ bbox = [10.4081, 63.4305, 10.4101, 63.4325]
 bygning_omrader_4326 = bygning_omrader.to_crs("EPSG:4326")
 bbox_bygning_omrader = bygning_omrader_4326.cx[bbox[0] : bbox[2], bbox[1] : bbox[3]]
 bbox_bygning_omrader.reset_index(drop=True, inplace=True)
-# %% load the matrikkel data - a csv in data/raw/FKB_bygning
+# %% load the building years from the matrikkel building table
 import pandas as pd
+from HOME.data_acquisition.matrikkel.building_table import load_building_table
 
-# Assuming the CSV file name is known and is 'matrikkel_data.csv'
-matrikkel_file = root_dir / "data/raw/FKB_bygning/buildings.csv"
-# Load the CSV data into a DataFrame
-matrikkel_data = pd.read_csv(matrikkel_file)
-
-# Display the first few rows of the DataFrame
+# indexed by bygningsnummer, see building_table.py
+matrikkel_data = load_building_table(columns=["first_status_year"])
 print(matrikkel_data.head())
+
+# join the building years to the polygons (bygningsnummer is float with NaNs)
+bbox_bygning_omrader["bygningsnummer"] = bbox_bygning_omrader[
+    "bygningsnummer"
+].astype("Int64")
+bbox_bygning_years = bbox_bygning_omrader.join(
+    matrikkel_data, on="bygningsnummer", how="inner"
+)
+bbox_bygning_years = bbox_bygning_years[
+    bbox_bygning_years["first_status_year"].notna()
+]
 # %% plot
 # plot in simple folium map
 m = folium.Map(location=[63.4005, 10.3951], zoom_start=13)
@@ -49,27 +57,19 @@ folium.GeoJson(
     box(*bbox), style_function=lambda x: {"color": "blue", "fill": False}
 ).add_to(m)
 
-m_numbers = [int(m) for m in matrikkel_data["Building Number"]]
-for _, row in bbox_bygning_omrader.iterrows():
-    b_number = row["bygningsnummer"]
-    if not pd.isna(b_number):
-        b_number = int(b_number)
-        if b_number in m_numbers:
-            cohort_index = m_numbers.index(b_number)
-            cohort = matrikkel_data.iloc[cohort_index]["Building Year"]
-            # print the shape in the map and print the building year in the center of the shape
-            folium_geojson = folium.GeoJson(
-                row.geometry, style_function=lambda x: {"color": "red"}
-            ).add_to(m)
+for _, row in bbox_bygning_years.iterrows():
+    cohort = row["first_status_year"]
+    # print the shape in the map and print the building year in the center of the shape
+    folium_geojson = folium.GeoJson(
+        row.geometry, style_function=lambda x: {"color": "red"}
+    ).add_to(m)
 
-            # Calculate the centroid of the geometry and place a marker with the building year
-            centroid = row.geometry.centroid
-            folium.Marker(
-                [centroid.y, centroid.x],  # folium uses (lat, lon) order
-                icon=folium.DivIcon(html=f'<div style="font-size: 8pt">{cohort}</div>'),
-            ).add_to(m)
-            # folium.GeoJson(row.geometry, style_function=lambda x: {"color": "red"}).add_to(m)
-    # folium.GeoJson(row.geometry, style_function=lambda x: {"color": "red"}).add_to(m)
+    # Calculate the centroid of the geometry and place a marker with the building year
+    centroid = row.geometry.centroid
+    folium.Marker(
+        [centroid.y, centroid.x],  # folium uses (lat, lon) order
+        icon=folium.DivIcon(html=f'<div style="font-size: 8pt">{cohort}</div>'),
+    ).add_to(m)
 m
 
 # %%